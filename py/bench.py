@@ -0,0 +1,322 @@
+"""Benchmarks for the scoring kernel and the window pipeline
+
+Workloads come in three sizes:
+    micro   -- a single `edit_distance` call on short, medium and long strings
+    meso    -- `score_pair` and `score_block` throughput over real domains, for
+               every similarity metric
+    macro   -- `process_windows` on `data/domains.in` and synthetic corpora
+
+Results (pairs/sec, peak RSS and per-phase times) are written as JSON and can
+be compared against a stored baseline, e.g.
+
+    > python bench.py --out bench.json --baseline baseline.json
+
+exits with status 1 if a metric regressed by more than `--threshold`.
+"""
+
+import argparse
+from contextlib import nullcontext
+from itertools import combinations, islice
+from multiprocessing import get_context
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+
+import edit_distance
+from edit_distance import PatternMask, pack_domains, score_block, score_pair
+from win_domains import DomainStore
+import win_proc
+from win_stat import Metrics
+from win_util import fetch_lines, profiled
+
+DOMAINS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                       "data", "domains.in")
+
+# metrics where a lower value is better, every other metric is a throughput
+LOWER_IS_BETTER = ("elapsed", "peak_rss_kb")
+
+def peak_rss_kb():
+    """Peak resident set size of the calling process in KiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def best_of(function, repeat: int = 5):
+    """Best wall time of `function()` over `repeat` runs
+
+    Positional Arguments:
+    function    -- callable to time
+
+    Keyword Arguments:
+    repeat      -- number of runs
+
+    Returns:
+    seconds of the fastest run
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+def synthetic_corpus(n: int, seed: int = 0):
+    """Deterministic corpus of `n` subdomains shaped like `data/domains.in`
+
+    Each subdomain is a real one with up to four random single character
+    edits, so the corpus keeps realistic lengths and near duplicates.
+
+    Positional Arguments:
+    n       -- number of subdomains
+
+    Keyword Arguments:
+    seed    -- random seed
+
+    Returns:
+    list of subdomains (bytes)
+    """
+    rng = random.Random(seed)
+    base = list(fetch_lines(DOMAINS))
+    alphabet = b"abcdefghijklmnopqrstuvwxyz0123456789-."
+
+    corpus = []
+    for _ in range(n):
+        domain = bytearray(rng.choice(base))
+        for _ in range(rng.randint(0, 4)):
+            pos = rng.randrange(len(domain) + 1)
+            domain[pos:pos + 1] = bytes([rng.choice(alphabet)])
+        corpus.append(bytes(domain))
+
+    return corpus
+
+def bench_micro(repeat: int = 5):
+    """`edit_distance` on short, medium and long strings, both backends
+
+    Returns:
+    dict of benchmark name to its metrics
+    """
+    rng = random.Random(0)
+    results = {}
+    for name,length in (("short", 8), ("medium", 32), ("long", 128)):
+        src = bytes(rng.choice(b"abcdefgh") for _ in range(length))
+        dst = bytes(rng.choice(b"abcdefgh") for _ in range(length))
+        calls = max(1000, 200000 // length)
+
+        def dp():
+            for _ in range(calls):
+                edit_distance.edit_distance(src, dst)
+
+        mask = PatternMask(src)
+        def bit_parallel():
+            for _ in range(calls):
+                mask.distance(dst)
+
+        for backend,function in (("dp", dp), ("bit_parallel", bit_parallel)):
+            elapsed = best_of(function, repeat)
+            results[f"micro/{name}/{backend}"] = {
+                "elapsed": elapsed,
+                "pairs_per_sec": calls / elapsed,
+            }
+
+    return results
+
+def bench_meso(repeat: int = 5):
+    """`score_pair` and `score_block` throughput over `data/domains.in`, the
+    latter with every metric of `edit_distance.METRICS`
+
+    Returns:
+    dict of benchmark name to its metrics
+    """
+    domains = list(fetch_lines(DOMAINS))
+    pairs = list(islice(combinations(domains, 2), 200000))
+    results = {}
+
+    def pair_loop():
+        for pair in pairs:
+            score_pair(pair, 0.5)
+
+    elapsed = best_of(pair_loop, repeat)
+    results["meso/score_pair"] = {
+        "elapsed": elapsed,
+        "pairs_per_sec": len(pairs) / elapsed,
+    }
+
+    packed, lengths = pack_domains(domains)
+    n_pairs = len(domains) * (len(domains) - 1) // 2
+    for backend in (edit_distance.BACKEND_DP,
+                    edit_distance.BACKEND_BIT_PARALLEL):
+        elapsed = best_of(lambda: score_block(packed, lengths, packed, lengths,
+                                              0.5, backend, upper=True),
+                          repeat)
+        name = "dp" if backend == edit_distance.BACKEND_DP else "bit_parallel"
+        results[f"meso/score_block/{name}"] = {
+            "elapsed": elapsed,
+            "pairs_per_sec": n_pairs / elapsed,
+        }
+
+    # the other metrics, to pick the fastest one that is accurate enough
+    for name,metric in edit_distance.METRICS.items():
+        if metric == edit_distance.METRIC_LEVENSHTEIN:
+            continue
+        elapsed = best_of(lambda: score_block(packed, lengths, packed, lengths,
+                                              0.5, upper=True, metric=metric),
+                          repeat)
+        results[f"meso/score_block/{name}"] = {
+            "elapsed": elapsed,
+            "pairs_per_sec": n_pairs / elapsed,
+        }
+
+    return results
+
+def run_windows(size, threshold, workers):
+    """Run `process_windows` once and summarize its metrics, meant to
+    run in a fresh process so its peak RSS is its own
+
+    Positional Arguments:
+    size        -- synthetic corpus size, None for `data/domains.in`
+    threshold   -- minimum score to keep
+    workers     -- number of scoring processes
+
+    Returns:
+    dict of metrics
+    """
+    domains = DomainStore.from_file(DOMAINS) if size is None \
+              else DomainStore.from_domains(synthetic_corpus(size))
+
+    metrics = Metrics()
+    start = time.perf_counter()
+    win_proc.process_windows(domains, len(domains), threshold, 0,
+                             workers=workers, reporter=None, metrics=metrics)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "elapsed": elapsed,
+        "pairs_per_sec": metrics.get("generated") / elapsed
+                         if elapsed > 0 else 0.0,
+        "peak_rss_kb": peak_rss_kb(),
+        "n_pairs": metrics.get("generated"),
+        "n_scored": metrics.get("scored"),
+        "n_kept": metrics.get("kept"),
+        "phase_times": metrics.phase_times,
+    }
+
+def bench_macro(sizes=(10000, 100000), threshold: float = 0.8,
+                workers: int = 1):
+    """`process_windows` on `data/domains.in` and synthetic corpora, each in
+    its own process
+
+    Keyword Arguments:
+    sizes       -- synthetic corpus sizes
+    threshold   -- minimum score to keep
+    workers     -- number of scoring processes
+
+    Returns:
+    dict of benchmark name to its metrics
+    """
+    results = {}
+    context = get_context("spawn")
+    for size in (None,) + tuple(sizes):
+        with context.Pool(1) as pool:
+            name = "domains.in" if size is None else f"synthetic_{size}"
+            results[f"macro/{name}"] = pool.apply(run_windows,
+                                                  (size, threshold, workers))
+
+    return results
+
+def compare(results: dict, baseline: dict, threshold: float = 0.10):
+    """Find metrics that regressed against a baseline
+
+    Throughputs regress when they drop, times and memory when they grow,
+    by more than `threshold` (relative). Counts and phase times are not
+    compared.
+
+    Positional Arguments:
+    results     -- benchmark name to metrics, as run now
+    baseline    -- benchmark name to metrics, as stored
+
+    Keyword Arguments:
+    threshold   -- tolerated relative change
+
+    Returns:
+    list of (benchmark, metric, baseline value, current value)
+    """
+    regressions = []
+    for name,metrics in results.items():
+        for metric,value in metrics.items():
+            if metric not in LOWER_IS_BETTER and metric != "pairs_per_sec":
+                continue
+            old = baseline.get(name, {}).get(metric)
+            if not old:
+                continue
+
+            if metric in LOWER_IS_BETTER:
+                regressed = value > old * (1 + threshold)
+            else:
+                regressed = value < old * (1 - threshold)
+            if regressed:
+                regressions.append((name, metric, old, value))
+
+    return regressions
+
+def main():
+    """Run the selected suites, write their results and check the baseline"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--suite", nargs="+", default=["micro", "meso", "macro"],
+                        choices=["micro", "meso", "macro"])
+    parser.add_argument("--sizes", nargs="*", type=int, default=[10000, 100000],
+                        help="synthetic corpus sizes of the macro suite")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--baseline", help="results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="tolerated relative regression")
+    parser.add_argument("--profile", metavar="PROF",
+                        help="dump cProfile stats of the micro and meso "
+                             "suites to PROF (macro runs in subprocesses)")
+    args = parser.parse_args()
+
+    if args.profile and not edit_distance.PROFILED:
+        print("note: edit_distance was built without profiling hooks, "
+              "rebuild with TBSP_PROFILE=1 to see the kernels")
+
+    results = {}
+    with profiled(args.profile) if args.profile else nullcontext():
+        if "micro" in args.suite:
+            results.update(bench_micro(args.repeat))
+        if "meso" in args.suite:
+            results.update(bench_meso(args.repeat))
+    if "macro" in args.suite:
+        results.update(bench_macro(args.sizes, workers=args.workers))
+
+    record = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as outfile:
+        json.dump(record, outfile, indent=2)
+
+    for name,metrics in results.items():
+        print(f"{name:<32} {metrics['pairs_per_sec']:>14,.0f} pairs/sec")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as infile:
+            baseline = json.load(infile)["results"]
+
+        regressions = compare(results, baseline, args.threshold)
+        for name,metric,old,new in regressions:
+            print(f"REGRESSION: {name} {metric} {old:.4g} -> {new:.4g}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
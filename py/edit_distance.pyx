@@ -1,61 +1,1343 @@
 import cython
 
-from libc.string cimport strlen, memset
+from libc.stdint cimport int32_t, int64_t, uint16_t, uint64_t
+from libc.stdlib cimport calloc, malloc, realloc, free
+from libc.string cimport memcmp, memcpy, memset
 
-DEF E_CAP = 16384 
+import numpy as np
 
-ctypedef (char*, char*) StrPair
+# rows up to this many cells live on the stack, longer ones are malloc'd
+DEF ROW_CAP = 256
 
-cpdef unsigned int edit_distance(char* src, char* dst):
-    cdef Py_ssize_t src_len = strlen(src)
-    cdef Py_ssize_t dst_len = strlen(dst)
+# whether the module was built with profiling hooks, see setup.py
+PROFILED = PROFILE_BUILD
 
-    if src_len == 0:
-        return dst_len
+# scoring backends, see `score_pair`
+BACKEND_DP = 0
+BACKEND_BIT_PARALLEL = 1
+
+# similarity metrics, the backends only apply to Levenshtein
+DEF M_LEVENSHTEIN = 0
+DEF M_DAMERAU = 1
+DEF M_JARO_WINKLER = 2
+DEF M_QGRAM_JACCARD = 3
+
+METRIC_LEVENSHTEIN = M_LEVENSHTEIN
+METRIC_DAMERAU = M_DAMERAU
+METRIC_JARO_WINKLER = M_JARO_WINKLER
+METRIC_QGRAM_JACCARD = M_QGRAM_JACCARD
+
+# metric registry, a name is accepted wherever a metric is
+METRICS = {
+    "levenshtein": METRIC_LEVENSHTEIN,
+    "damerau": METRIC_DAMERAU,
+    "jaro_winkler": METRIC_JARO_WINKLER,
+    "qgram_jaccard": METRIC_QGRAM_JACCARD,
+}
+
+# Jaro-Winkler prefix scale and longest rewarded common prefix
+DEF WINKLER_SCALE = 0.1
+DEF WINKLER_PREFIX = 4
+
+def metric_id(metric):
+    """Resolve a metric name of `METRICS` or a `METRIC_*` constant to the
+    constant, raising `ValueError` for unknown metrics"""
+    if isinstance(metric, str):
+        if metric not in METRICS:
+            raise ValueError(f"unknown metric {metric!r}, expected one of "
+                             f"{', '.join(METRICS)}")
+        return METRICS[metric]
+
+    if metric not in METRICS.values():
+        raise ValueError(f"unknown metric {metric!r}")
+
+    return int(metric)
+
+cdef Py_ssize_t _edit_distance(const unsigned char* src, Py_ssize_t src_len,
+                               const unsigned char* dst, Py_ssize_t dst_len,
+                               Py_ssize_t k) noexcept nogil:
+    """Levenshtein distance of `src` and `dst` using two rolling rows
+
+    Only the diagonal band |i - j| <= k is computed and the computation stops
+    once every cell of a row exceeds `k`, in which case `k + 1` is returned.
+    Returns -1 if the rows could not be allocated.
+    """
+    cdef const unsigned char* tmp
+    cdef Py_ssize_t tmp_len
+
+    # keep the rows as short as possible, distance is symmetric
+    if dst_len > src_len:
+        tmp, tmp_len = src, src_len
+        src, src_len = dst, dst_len
+        dst, dst_len = tmp, tmp_len
+
+    if src_len - dst_len > k:
+        return k + 1
     if dst_len == 0:
         return src_len
 
-    cdef unsigned int E[E_CAP]
-    memset(E, 0, E_CAP * sizeof(unsigned int))
+    cdef Py_ssize_t stack_rows[2 * ROW_CAP]
+    cdef Py_ssize_t* heap_rows = NULL
+    cdef Py_ssize_t* prev
+    cdef Py_ssize_t* curr
+    cdef Py_ssize_t* swap
 
-    cdef Py_ssize_t i = 0
-    cdef Py_ssize_t j = 0
+    if dst_len + 1 <= ROW_CAP:
+        prev = stack_rows
+    else:
+        heap_rows = <Py_ssize_t*> malloc(2 * (dst_len + 1) * sizeof(Py_ssize_t))
+        if heap_rows == NULL:
+            return -1
+        prev = heap_rows
+    curr = prev + dst_len + 1
 
-    for i in range(dst_len + 1):
-        E[i] = i
+    cdef Py_ssize_t over = k + 1
+    cdef Py_ssize_t i, j, lo, hi
+    cdef Py_ssize_t a, b, c, row_min
+    cdef unsigned char s
 
-    for i in range(src_len + 1):
-        E[i*(dst_len + 1)] = i
+    for j in range(dst_len + 1):
+        prev[j] = j if j <= k else over
 
-    cdef unsigned int a, b, c
     for i in range(1, src_len + 1):
-        for j in range(1, dst_len + 1):
+        lo = i - k if i > k else 1
+        hi = i + k if i + k < dst_len else dst_len
+
+        curr[lo - 1] = i if lo == 1 else over
+        row_min = curr[lo - 1]
+        s = src[i - 1]
+        for j in range(lo, hi + 1):
             # delete
-            a = E[((i - 1) * (dst_len + 1)) + j] + 1
+            a = prev[j] + 1
             # insertion
-            b = E[(i * (dst_len + 1)) + (j - 1)] + 1
+            b = curr[j - 1] + 1
             # substitution
-            c = E[((i - 1) * (dst_len + 1)) + (j - 1)]
-            if src[i - 1] != dst[j - 1]:
+            c = prev[j - 1]
+            if s != dst[j - 1]:
                 c += 1
 
-            E[(i * (dst_len + 1)) + j] = min(a, b, c)
+            if b < a:
+                a = b
+            if c < a:
+                a = c
+            if a > over:
+                a = over
+
+            curr[j] = a
+            if a < row_min:
+                row_min = a
+
+        # cells right of the band are out of reach for the next row
+        if hi < dst_len:
+            curr[hi + 1] = over
+
+        if row_min > k:
+            free(heap_rows)
+            return over
+
+        swap = prev
+        prev = curr
+        curr = swap
+
+    a = prev[dst_len]
+    free(heap_rows)
+
+    return a
+
+cdef Py_ssize_t _checked(Py_ssize_t distance) except -1:
+    if distance < 0:
+        raise MemoryError("unable to allocate edit distance rows")
+
+    return distance
+
+cpdef Py_ssize_t edit_distance(bytes src, bytes dst) except -1:
+    """Levenshtein distance between two byte strings"""
+    cdef const unsigned char* s = src
+    cdef const unsigned char* d = dst
+    cdef Py_ssize_t s_len = len(src)
+    cdef Py_ssize_t d_len = len(dst)
+    cdef Py_ssize_t distance
+
+    with nogil:
+        distance = _edit_distance(s, s_len, d, d_len,
+                                  s_len if s_len > d_len else d_len)
+
+    return _checked(distance)
+
+cpdef Py_ssize_t edit_distance_bounded(bytes src, bytes dst,
+                                       Py_ssize_t k) except -1:
+    """Levenshtein distance between two byte strings if it is at most `k`,
+    otherwise `k + 1`"""
+    cdef const unsigned char* s = src
+    cdef const unsigned char* d = dst
+    cdef Py_ssize_t s_len = len(src)
+    cdef Py_ssize_t d_len = len(dst)
+    cdef Py_ssize_t distance
+
+    if k < 0:
+        k = 0
+
+    with nogil:
+        distance = _edit_distance(s, s_len, d, d_len, k)
+
+    return _checked(distance)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _bit_parallel(const uint64_t* peq, Py_ssize_t stride,
+                              uint64_t* vp, uint64_t* vn, Py_ssize_t m,
+                              const unsigned char* dst, Py_ssize_t dst_len,
+                              Py_ssize_t k) noexcept nogil:
+    """Bit-parallel (Myers/Hyyro) Levenshtein distance between a source of
+    length `m`, given by its match masks `peq` (`stride` words per character),
+    and `dst`
+
+    `vp` and `vn` are scratch vectors of at least ceil(m / 64) words each.
+    Returns the distance if it is at most `k`, otherwise `k + 1`.
+    """
+    cdef Py_ssize_t words = (m + 63) // 64
+    cdef Py_ssize_t dist = m
+    cdef Py_ssize_t j, w
+    cdef uint64_t last, x, d0, hp, hn, pv, nv
+    cdef uint64_t hp_carry, hn_carry, hp_in, hn_in
+    cdef const uint64_t* eq
+
+    if m == 0 or dst_len == 0:
+        dist = m + dst_len
+        return dist if dist <= k else k + 1
+    if m - dst_len > k or dst_len - m > k:
+        return k + 1
+
+    last = (<uint64_t> 1) << ((m - 1) % 64)
+
+    if words == 1:
+        pv = ~(<uint64_t> 0)
+        nv = 0
+        for j in range(dst_len):
+            x = peq[dst[j] * stride]
+            d0 = (((x & pv) + pv) ^ pv) | x | nv
+            hp = nv | ~(d0 | pv)
+            hn = d0 & pv
+            if hp & last:
+                dist += 1
+            elif hn & last:
+                dist -= 1
+            # every remaining column lowers the distance by at most one
+            if dist - (dst_len - j - 1) > k:
+                return k + 1
+            hp = (hp << 1) | 1
+            hn = hn << 1
+            pv = hn | ~(d0 | hp)
+            nv = hp & d0
+
+        return dist if dist <= k else k + 1
+
+    for w in range(words):
+        vp[w] = ~(<uint64_t> 0)
+        vn[w] = 0
+
+    for j in range(dst_len):
+        eq = peq + dst[j] * stride
+        # the top row grows by one per column
+        hp_carry = 1
+        hn_carry = 0
+        for w in range(words):
+            pv = vp[w]
+            nv = vn[w]
+            x = eq[w] | hn_carry
+            d0 = (((x & pv) + pv) ^ pv) | x | nv
+            hp = nv | ~(d0 | pv)
+            hn = d0 & pv
+
+            hp_in = hp_carry
+            hn_in = hn_carry
+            if w < words - 1:
+                hp_carry = hp >> 63
+                hn_carry = hn >> 63
+            else:
+                hp_carry = (hp & last) != 0
+                hn_carry = (hn & last) != 0
+
+            hp = (hp << 1) | hp_in
+            hn = (hn << 1) | hn_in
+            vp[w] = hn | ~(d0 | hp)
+            vn[w] = hp & d0
+
+        dist += <Py_ssize_t> hp_carry - <Py_ssize_t> hn_carry
+        if dist - (dst_len - j - 1) > k:
+            return k + 1
+
+    return dist if dist <= k else k + 1
+
+cdef void _set_masks(uint64_t* peq, Py_ssize_t stride,
+                     const unsigned char* src, Py_ssize_t m,
+                     bint clear) noexcept nogil:
+    """Set (or clear again) the match masks of `src`, laid out as
+    peq[char * stride + word]"""
+    cdef Py_ssize_t i
+    cdef uint64_t* mask
+
+    for i in range(m):
+        mask = peq + src[i] * stride + i // 64
+        if clear:
+            mask[0] = 0
+        else:
+            mask[0] |= (<uint64_t> 1) << (i % 64)
+
+cdef class PatternMask:
+    """Bit-parallel (Myers/Hyyro) Levenshtein distance from a fixed source
+
+    The match masks of the source are computed once on construction, so a
+    domain can be compared against a whole window without rebuilding them.
+    Sources of up to 64 bytes fit a single machine word, longer ones are
+    split across 64-bit blocks.
+    """
+    cdef uint64_t* peq
+    cdef uint64_t* vp
+    cdef uint64_t* vn
+    cdef Py_ssize_t words
+    cdef readonly Py_ssize_t length
+    cdef readonly bytes source
+
+    def __cinit__(self, bytes source):
+        cdef const unsigned char* src = source
+
+        self.source = source
+        self.length = len(source)
+        self.words = (self.length + 63) // 64
+
+        # laid out as peq[char * words + word]
+        self.peq = <uint64_t*> calloc(256 * self.words + 1, sizeof(uint64_t))
+        self.vp = <uint64_t*> malloc((self.words + 1) * sizeof(uint64_t))
+        self.vn = <uint64_t*> malloc((self.words + 1) * sizeof(uint64_t))
+        if self.peq == NULL or self.vp == NULL or self.vn == NULL:
+            raise MemoryError("unable to allocate pattern masks")
+
+        _set_masks(self.peq, self.words, src, self.length, False)
+
+    def __dealloc__(self):
+        free(self.peq)
+        free(self.vp)
+        free(self.vn)
+
+    cdef Py_ssize_t _distance(self, const unsigned char* dst, Py_ssize_t dst_len,
+                              Py_ssize_t k) noexcept nogil:
+        """Distance to `dst` if it is at most `k`, otherwise `k + 1`"""
+        return _bit_parallel(self.peq, self.words, self.vp, self.vn,
+                             self.length, dst, dst_len, k)
+
+    cpdef Py_ssize_t distance(self, bytes dst):
+        """Levenshtein distance between the source and `dst`"""
+        cdef const unsigned char* d = dst
+        cdef Py_ssize_t d_len = len(dst)
+        cdef Py_ssize_t distance
+
+        with nogil:
+            distance = self._distance(d, d_len,
+                                      self.length if self.length > d_len
+                                      else d_len)
+
+        return distance
 
-    return E[(src_len)*(dst_len + 1) + (dst_len)]
+    cpdef Py_ssize_t distance_bounded(self, bytes dst, Py_ssize_t k):
+        """Distance to `dst` if it is at most `k`, otherwise `k + 1`"""
+        cdef const unsigned char* d = dst
+        cdef Py_ssize_t d_len = len(dst)
+        cdef Py_ssize_t distance
+
+        if k < 0:
+            k = 0
+
+        with nogil:
+            distance = self._distance(d, d_len, k)
+
+        return distance
 
 @cython.cdivision(True)
-cdef float score(unsigned int distance, unsigned int max_distance):
+cdef float score(Py_ssize_t distance, Py_ssize_t max_distance) noexcept nogil:
+    # identical strings, also covers two empty ones (max_distance == 0)
     if distance == 0:
-        return 0.0
-    
+        return 1.0
+
     return 1 - (distance / float(max_distance))
 
-cpdef (StrPair, float) score_pair(StrPair pair):
-    len_f0 = strlen(pair[0])
-    len_f1 = strlen(pair[1])
+@cython.cdivision(True)
+cdef Py_ssize_t max_distance(Py_ssize_t max_len,
+                             double threshold) noexcept nogil:
+    """Largest distance whose score can still exceed `threshold`"""
+    if threshold <= 0.0:
+        return max_len
+
+    # the slack keeps float error from cutting the bound below the boundary
+    return <Py_ssize_t> ((1.0 - threshold) * max_len + 1e-6)
+
+cdef Py_ssize_t _damerau(const unsigned char* src, Py_ssize_t src_len,
+                         const unsigned char* dst, Py_ssize_t dst_len,
+                         Py_ssize_t k) noexcept nogil:
+    """Optimal string alignment distance of `src` and `dst`, i.e.
+    Levenshtein plus transpositions of adjacent characters, using three
+    rolling rows
+
+    Banded and stopped early like `_edit_distance`: a transposition into a
+    row starts from a cell of at most `k - 1` two rows up, so the row in
+    between already holds a cell of at most `k`. Returns `k + 1` past `k`
+    and -1 if the rows could not be allocated.
+    """
+    cdef const unsigned char* tmp
+    cdef Py_ssize_t tmp_len
+
+    if dst_len > src_len:
+        tmp, tmp_len = src, src_len
+        src, src_len = dst, dst_len
+        dst, dst_len = tmp, tmp_len
+
+    if src_len - dst_len > k:
+        return k + 1
+    if dst_len == 0:
+        return src_len
+
+    cdef Py_ssize_t stack_rows[3 * ROW_CAP]
+    cdef Py_ssize_t* heap_rows = NULL
+    cdef Py_ssize_t* before
+    cdef Py_ssize_t* prev
+    cdef Py_ssize_t* curr
+    cdef Py_ssize_t* swap
+
+    if dst_len + 1 <= ROW_CAP:
+        before = stack_rows
+    else:
+        heap_rows = <Py_ssize_t*> malloc(3 * (dst_len + 1) * sizeof(Py_ssize_t))
+        if heap_rows == NULL:
+            return -1
+        before = heap_rows
+    prev = before + dst_len + 1
+    curr = prev + dst_len + 1
+
+    cdef Py_ssize_t over = k + 1
+    cdef Py_ssize_t i, j, lo, hi
+    cdef Py_ssize_t a, b, c, row_min
+    cdef unsigned char s
+
+    for j in range(dst_len + 1):
+        prev[j] = j if j <= k else over
+
+    for i in range(1, src_len + 1):
+        lo = i - k if i > k else 1
+        hi = i + k if i + k < dst_len else dst_len
+
+        curr[lo - 1] = i if lo == 1 else over
+        row_min = curr[lo - 1]
+        s = src[i - 1]
+        for j in range(lo, hi + 1):
+            a = prev[j] + 1
+            b = curr[j - 1] + 1
+            c = prev[j - 1]
+            if s != dst[j - 1]:
+                c += 1
+
+            if b < a:
+                a = b
+            if c < a:
+                a = c
+            # transposition, cell (i - 2, j - 2) lies in that row's band
+            if i > 1 and j > 1 and s == dst[j - 2] and src[i - 2] == dst[j - 1]:
+                b = before[j - 2] + 1
+                if b < a:
+                    a = b
+            if a > over:
+                a = over
+
+            curr[j] = a
+            if a < row_min:
+                row_min = a
+
+        if hi < dst_len:
+            curr[hi + 1] = over
+
+        if row_min > k:
+            free(heap_rows)
+            return over
+
+        swap = before
+        before = prev
+        prev = curr
+        curr = swap
+
+    a = prev[dst_len]
+    free(heap_rows)
+
+    return a
+
+@cython.cdivision(True)
+cdef float _jaro_winkler(const unsigned char* src, Py_ssize_t src_len,
+                         const unsigned char* dst,
+                         Py_ssize_t dst_len) noexcept nogil:
+    """Jaro-Winkler similarity of `src` and `dst`, -1 if the match flags
+    could not be allocated"""
+    if src_len == 0 and dst_len == 0:
+        return 1.0
+    if src_len == 0 or dst_len == 0:
+        return 0.0
+
+    cdef unsigned char stack_flags[2 * ROW_CAP]
+    cdef unsigned char* heap_flags = NULL
+    cdef unsigned char* src_flags
+    cdef unsigned char* dst_flags
+
+    if src_len + dst_len <= 2 * ROW_CAP:
+        src_flags = stack_flags
+    else:
+        heap_flags = <unsigned char*> malloc(src_len + dst_len)
+        if heap_flags == NULL:
+            return -1.0
+        src_flags = heap_flags
+    dst_flags = src_flags + src_len
+    memset(src_flags, 0, src_len + dst_len)
+
+    cdef Py_ssize_t window = (src_len if src_len > dst_len else dst_len) // 2 - 1
+    cdef Py_ssize_t i, j, lo, hi
+    cdef Py_ssize_t matches = 0, half_transpositions = 0, prefix = 0
+    cdef double jaro
+
+    if window < 0:
+        window = 0
+
+    # characters match if equal and at most `window` positions apart
+    for i in range(src_len):
+        lo = i - window if i > window else 0
+        hi = i + window + 1 if i + window + 1 < dst_len else dst_len
+        for j in range(lo, hi):
+            if not dst_flags[j] and src[i] == dst[j]:
+                src_flags[i] = 1
+                dst_flags[j] = 1
+                matches += 1
+                break
+
+    if matches == 0:
+        free(heap_flags)
+        return 0.0
+
+    # matched characters out of order, every transposition counts twice
+    j = 0
+    for i in range(src_len):
+        if src_flags[i]:
+            while not dst_flags[j]:
+                j += 1
+            if src[i] != dst[j]:
+                half_transpositions += 1
+            j += 1
+    free(heap_flags)
+
+    jaro = (matches / <double> src_len + matches / <double> dst_len
+            + (matches - half_transpositions / 2.0) / matches) / 3.0
+
+    while prefix < WINKLER_PREFIX and prefix < src_len and prefix < dst_len \
+          and src[prefix] == dst[prefix]:
+        prefix += 1
+
+    return <float> (jaro + prefix * WINKLER_SCALE * (1.0 - jaro))
+
+cdef Py_ssize_t _qgrams(const unsigned char* src, Py_ssize_t src_len,
+                        uint16_t* grams) noexcept nogil:
+    """Write the sorted bigram codes of `src` to `grams`, which has room
+    for `src_len - 1` of them, and return their count"""
+    cdef Py_ssize_t count = src_len - 1 if src_len > 1 else 0
+    cdef Py_ssize_t p, q
+    cdef uint16_t gram
+
+    for p in range(count):
+        gram = (src[p] << 8) | src[p + 1]
+        # insertion sort, domains are short
+        q = p
+        while q > 0 and grams[q - 1] > gram:
+            grams[q] = grams[q - 1]
+            q -= 1
+        grams[q] = gram
+
+    return count
+
+@cython.cdivision(True)
+cdef float _qgram_jaccard(const unsigned char* src, Py_ssize_t src_len,
+                          const unsigned char* dst, Py_ssize_t dst_len,
+                          const uint16_t* grams_src, Py_ssize_t n_src,
+                          const uint16_t* grams_dst,
+                          Py_ssize_t n_dst) noexcept nogil:
+    """Jaccard similarity of the bigram multisets of `src` and `dst`, given
+    sorted by `_qgrams`"""
+    cdef Py_ssize_t a = 0, b = 0, shared = 0
+
+    # strings without a bigram only match themselves
+    if n_src == 0 or n_dst == 0:
+        return 1.0 if src_len == dst_len \
+                      and memcmp(src, dst, src_len) == 0 else 0.0
+
+    while a < n_src and b < n_dst:
+        if grams_src[a] == grams_dst[b]:
+            shared += 1
+            a += 1
+            b += 1
+        elif grams_src[a] < grams_dst[b]:
+            a += 1
+        else:
+            b += 1
+
+    return shared / <float> (n_src + n_dst - shared)
+
+cdef struct QGramTable:
+    Py_ssize_t width
+    uint16_t* grams
+    Py_ssize_t* counts
+
+cdef int _qgram_table(QGramTable* table, const unsigned char* packed,
+                      Py_ssize_t width, const int32_t* lengths,
+                      Py_ssize_t n) noexcept nogil:
+    """Sorted bigrams of every packed domain, built once per tile so pairs
+    only merge them. Returns -1 if the table could not be allocated."""
+    cdef Py_ssize_t i
+
+    table.width = width
+    table.grams = <uint16_t*> malloc((n * width + 1) * sizeof(uint16_t))
+    table.counts = <Py_ssize_t*> malloc((n + 1) * sizeof(Py_ssize_t))
+    if table.grams == NULL or table.counts == NULL:
+        return -1
+
+    for i in range(n):
+        table.counts[i] = _qgrams(packed + i * width, lengths[i],
+                                  table.grams + i * width)
+
+    return 0
+
+@cython.cdivision(True)
+cdef float _similarity(int metric, const unsigned char* src,
+                       Py_ssize_t src_len, const unsigned char* dst,
+                       Py_ssize_t dst_len, QGramTable* grams_src,
+                       Py_ssize_t row_src, QGramTable* grams_dst,
+                       Py_ssize_t row_dst, double threshold) noexcept nogil:
+    """Score a pair by a metric other than Levenshtein, -1 if a kernel could
+    not allocate
+
+    Pairs that cannot score above `threshold` may stop early and receive a
+    score that is at most `threshold`. The bigrams of `METRIC_QGRAM_JACCARD`
+    are rows `row_src` and `row_dst` of the tables.
+    """
+    cdef Py_ssize_t max_len = src_len if src_len > dst_len else dst_len
+    cdef Py_ssize_t distance, n_src, n_dst
+    cdef float bound
+    cdef double jaro
+
+    if metric == M_DAMERAU:
+        distance = _damerau(src, src_len, dst, dst_len,
+                            max_distance(max_len, threshold))
+        if distance < 0:
+            return -1.0
+        return score(distance, max_len)
+
+    if metric == M_JARO_WINKLER:
+        # at most min_len matches, all in order and behind a full prefix
+        if src_len > 0 and dst_len > 0 and threshold > 0.0:
+            distance = src_len if src_len < dst_len else dst_len
+            jaro = (distance / <double> src_len + distance / <double> dst_len
+                    + 1.0) / 3.0
+            if jaro + WINKLER_PREFIX * WINKLER_SCALE * (1.0 - jaro) \
+               < threshold - 1e-6:
+                return 0.0
+        return _jaro_winkler(src, src_len, dst, dst_len)
+
+    # the smaller multiset bounds the intersection, rounded like the score
+    n_src = grams_src.counts[row_src]
+    n_dst = grams_dst.counts[row_dst]
+    if n_src > 0 and n_dst > 0 and n_src != n_dst:
+        bound = n_src / <float> n_dst if n_src < n_dst \
+                else n_dst / <float> n_src
+        if bound <= threshold:
+            return 0.0
+
+    return _qgram_jaccard(src, src_len, dst, dst_len,
+                          grams_src.grams + row_src * grams_src.width, n_src,
+                          grams_dst.grams + row_dst * grams_dst.width, n_dst)
+
+cdef float _pair_similarity(int metric, bytes src, bytes dst,
+                            double threshold) except? -1:
+    """`_similarity` of two byte strings"""
+    cdef const unsigned char* s = src
+    cdef const unsigned char* d = dst
+    cdef int32_t lengths[2]
+    cdef Py_ssize_t width = max(len(src), len(dst), 1)
+    cdef QGramTable grams = QGramTable(0, NULL, NULL)
+    cdef unsigned char* packed = NULL
+    cdef float result = -1.0
+    cdef bint ready = True
+
+    lengths[0] = len(src)
+    lengths[1] = len(dst)
+    if metric == M_QGRAM_JACCARD:
+        packed = <unsigned char*> calloc(2 * width, 1)
+        if packed == NULL:
+            raise MemoryError("unable to allocate scoring buffers")
+        memcpy(packed, s, lengths[0])
+        memcpy(packed + width, d, lengths[1])
+        ready = _qgram_table(&grams, packed, width, lengths, 2) == 0
+
+    if ready:
+        with nogil:
+            result = _similarity(metric, s, lengths[0], d, lengths[1],
+                                 &grams, 0, &grams, 1, threshold)
+
+    free(packed)
+    free(grams.grams)
+    free(grams.counts)
+    if result < 0:
+        raise MemoryError("unable to allocate scoring buffers")
+
+    return result
+
+cpdef Py_ssize_t damerau_distance(bytes src, bytes dst) except -1:
+    """Optimal string alignment distance between two byte strings, i.e.
+    Levenshtein with transpositions of adjacent characters"""
+    cdef const unsigned char* s = src
+    cdef const unsigned char* d = dst
+    cdef Py_ssize_t s_len = len(src)
+    cdef Py_ssize_t d_len = len(dst)
+    cdef Py_ssize_t distance
+
+    with nogil:
+        distance = _damerau(s, s_len, d, d_len,
+                            s_len if s_len > d_len else d_len)
+
+    return _checked(distance)
+
+def similarity(bytes src, bytes dst, metric=METRIC_LEVENSHTEIN):
+    """Similarity of two byte strings in [0, 1] by any metric of `METRICS`,
+    1.0 for identical strings"""
+    cdef int m = metric_id(metric)
+    cdef Py_ssize_t max_len = max(len(src), len(dst))
+
+    if m == M_LEVENSHTEIN:
+        return score(edit_distance(src, dst), max_len)
+
+    return _pair_similarity(m, src, dst, 0.0)
+
+cdef Py_ssize_t _bounded(PatternMask mask, bytes src, bytes dst,
+                         Py_ssize_t k, int backend) except -1:
+    """Dispatch a bounded distance to the selected backend"""
+    if backend == BACKEND_BIT_PARALLEL:
+        if mask is None:
+            mask = PatternMask(src)
+        return mask.distance_bounded(dst, k)
+
+    return edit_distance_bounded(src, dst, k)
+
+cpdef tuple score_pair(tuple pair, double threshold=0.0,
+                       int backend=BACKEND_DP, metric=METRIC_LEVENSHTEIN):
+    """Score a pair of byte strings by normalized edit distance, or by
+    another metric of `METRICS`
+
+    Pairs that cannot score above `threshold` stop early and receive a score
+    that is at most `threshold`. `backend` is one of `BACKEND_DP` or
+    `BACKEND_BIT_PARALLEL`.
+    """
+    cdef bytes src = pair[0]
+    cdef bytes dst = pair[1]
+    cdef Py_ssize_t len_f0 = len(src)
+    cdef Py_ssize_t len_f1 = len(dst)
+    cdef int m = M_LEVENSHTEIN if metric == M_LEVENSHTEIN \
+                 else metric_id(metric)
+
+    if m != M_LEVENSHTEIN:
+        return (pair, _pair_similarity(m, src, dst, threshold))
 
     max_len = len_f0 if len_f0 > len_f1 else len_f1
-    distance = edit_distance(pair[0], pair[1])
+    distance = _bounded(None, src, dst, max_distance(max_len, threshold),
+                        backend)
 
     return (pair, score(distance, max_len))
 
+def pack_domains(domains):
+    """Pack byte strings into the fixed-width layout of `score_block`
+
+    Positional Arguments:
+    domains -- sequence of byte strings
+
+    Returns:
+    (`uint8` array of shape (len(domains), max length) with every domain
+    left-aligned and zero padded, `int32` array of lengths)
+    """
+    lengths = np.fromiter((len(domain) for domain in domains), dtype=np.int32,
+                          count=len(domains))
+    width = max(1, int(lengths.max())) if len(lengths) else 1
+    packed = np.zeros((len(lengths), width), dtype=np.uint8)
+
+    flat = np.frombuffer(b"".join(domains), dtype=np.uint8)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    starts = np.cumsum(lengths, dtype=np.int64) - lengths
+    packed[rows, np.arange(len(flat)) - np.repeat(starts, lengths)] = flat
+
+    return packed, lengths
+
+# buckets of the character histograms of the count filter, see `score_block`
+DEF HIST_WIDTH = 64
+
+# bucket of every byte, the characters of domain names get one each and the
+# rest share the others, merged buckets only make the filter prune less
+cdef unsigned char SYMBOLS[256]
+_alphabet = b"abcdefghijklmnopqrstuvwxyz0123456789-._"
+for _byte in range(256):
+    SYMBOLS[_byte] = _alphabet.index(_byte) if _byte in _alphabet \
+                     else len(_alphabet) + _byte % (HIST_WIDTH - len(_alphabet))
+
+cdef unsigned char* _char_hists(const unsigned char* packed, Py_ssize_t width,
+                                const int32_t* lengths,
+                                Py_ssize_t n) noexcept nogil:
+    """`HIST_WIDTH` character counts of every packed domain, saturating at
+    255. Returns NULL if they could not be allocated."""
+    cdef Py_ssize_t i, t
+    cdef unsigned char* hist
+    cdef unsigned char* hists = <unsigned char*> calloc(n * HIST_WIDTH + 1,
+                                                        sizeof(unsigned char))
+    if hists == NULL:
+        return NULL
+
+    for i in range(n):
+        hist = hists + i * HIST_WIDTH
+        for t in range(lengths[i]):
+            if hist[SYMBOLS[packed[i * width + t]]] < 255:
+                hist[SYMBOLS[packed[i * width + t]]] += 1
+
+    return hists
+
+cdef inline Py_ssize_t _hist_distance(const unsigned char* a,
+                                      const unsigned char* b) noexcept nogil:
+    """L1 distance of two character histograms"""
+    cdef int total = 0
+    cdef int t, d
+    for t in range(HIST_WIDTH):
+        d = <int> a[t] - <int> b[t]
+        total += d if d >= 0 else -d
+    return total
+
+cdef inline bint _ruled_out(Py_ssize_t src_len, Py_ssize_t dst_len,
+                            double threshold, const unsigned char* hist_a,
+                            const unsigned char* hist_b) noexcept nogil:
+    """Length and character count filters of `score_block`, True if the
+    pair cannot pass `threshold`"""
+    cdef Py_ssize_t max_len = src_len if src_len > dst_len else dst_len
+    cdef Py_ssize_t k = max_distance(max_len, threshold)
+    cdef Py_ssize_t diff = src_len - dst_len if src_len > dst_len \
+                           else dst_len - src_len
+
+    return diff > k or _hist_distance(hist_a, hist_b) > 2 * k - diff
+
+cdef struct Triplets:
+    Py_ssize_t size
+    Py_ssize_t capacity
+    int64_t* i
+    int64_t* j
+    float* score
+
+cdef int _push(Triplets* out, Py_ssize_t i, Py_ssize_t j,
+               float s) noexcept nogil:
+    """Append a triplet, growing the buffers geometrically. Returns -1 if
+    they could not be grown."""
+    cdef Py_ssize_t capacity
+    cdef void* grown
+
+    if out.size == out.capacity:
+        capacity = 2 * out.capacity if out.capacity > 0 else 1024
+        grown = realloc(out.i, capacity * sizeof(int64_t))
+        if grown == NULL:
+            return -1
+        out.i = <int64_t*> grown
+        grown = realloc(out.j, capacity * sizeof(int64_t))
+        if grown == NULL:
+            return -1
+        out.j = <int64_t*> grown
+        grown = realloc(out.score, capacity * sizeof(float))
+        if grown == NULL:
+            return -1
+        out.score = <float*> grown
+        out.capacity = capacity
+
+    out.i[out.size] = i
+    out.j[out.size] = j
+    out.score[out.size] = s
+    out.size += 1
+
+    return 0
+
+cdef tuple _triplet_arrays(Triplets* out):
+    """Copy the triplets into NumPy arrays and release the buffers"""
+    i = np.empty(out.size, dtype=np.int64)
+    j = np.empty(out.size, dtype=np.int64)
+    scores = np.empty(out.size, dtype=np.float32)
+
+    cdef int64_t[::1] i_view = i
+    cdef int64_t[::1] j_view = j
+    cdef float[::1] score_view = scores
+    if out.size > 0:
+        memcpy(&i_view[0], out.i, out.size * sizeof(int64_t))
+        memcpy(&j_view[0], out.j, out.size * sizeof(int64_t))
+        memcpy(&score_view[0], out.score, out.size * sizeof(float))
+
+    free(out.i)
+    free(out.j)
+    free(out.score)
+
+    return (i, j, scores)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def score_block(const unsigned char[:, ::1] domains_a,
+                const int32_t[::1] lengths_a,
+                const unsigned char[:, ::1] domains_b,
+                const int32_t[::1] lengths_b,
+                double threshold=0.0, int backend=BACKEND_BIT_PARALLEL,
+                bint upper=False, metric=METRIC_LEVENSHTEIN,
+                bint prune=False, int64_t[::1] n_scored=None):
+    """Score a whole tile of packed domains (see `pack_domains`) without
+    the GIL
+
+    Every domain of `domains_a` is scored against every domain of
+    `domains_b`. With `upper` the two are the same domains and only pairs
+    j > i are scored. `metric` is any metric of `METRICS`, `backend` only
+    applies to Levenshtein.
+
+    With `prune`, Levenshtein and Damerau pairs are first put through the
+    length filter and the character count filter: within distance k, the
+    L1 distance of two character histograms is at most 2k - |len_a - len_b|,
+    so a pair over it cannot pass and is skipped. The number of pairs
+    actually scored is added to `n_scored[0]` if given.
+
+    Returns:
+    (i, j, score) NumPy arrays of the pairs scoring above `threshold`
+    """
+    cdef Py_ssize_t n_a = domains_a.shape[0]
+    cdef Py_ssize_t n_b = domains_b.shape[0]
+    cdef Py_ssize_t words = (domains_a.shape[1] + 63) // 64
+    cdef int metric_c = metric_id(metric)
+    cdef bint levenshtein = metric_c == M_LEVENSHTEIN
+    cdef bint bit_parallel = levenshtein and backend == BACKEND_BIT_PARALLEL
+    cdef bint filtered = prune and (levenshtein or metric_c == M_DAMERAU)
+    cdef Py_ssize_t i, j, m, dst_len, max_len, distance
+    cdef Py_ssize_t scored = 0
+    cdef const unsigned char* src
+    cdef float s
+    cdef bint failed = False
+    cdef Triplets out = Triplets(0, 0, NULL, NULL, NULL)
+    cdef QGramTable grams_a = QGramTable(0, NULL, NULL)
+    cdef QGramTable grams_b = QGramTable(0, NULL, NULL)
+    cdef unsigned char* hists_a = NULL
+    cdef unsigned char* hists_b = NULL
+
+    if n_scored is not None and n_scored.shape[0] < 1:
+        raise ValueError("n_scored needs at least one element")
+
+    if words == 0:
+        words = 1
+    cdef uint64_t* peq = <uint64_t*> calloc(256 * words, sizeof(uint64_t))
+    cdef uint64_t* vp = <uint64_t*> malloc(words * sizeof(uint64_t))
+    cdef uint64_t* vn = <uint64_t*> malloc(words * sizeof(uint64_t))
+
+    if n_a > 0 and n_b > 0 and peq != NULL and vp != NULL and vn != NULL:
+        with nogil:
+            if metric_c == M_QGRAM_JACCARD:
+                failed = _qgram_table(&grams_a, &domains_a[0, 0],
+                                      domains_a.shape[1], &lengths_a[0],
+                                      n_a) < 0 \
+                         or _qgram_table(&grams_b, &domains_b[0, 0],
+                                         domains_b.shape[1], &lengths_b[0],
+                                         n_b) < 0
+            if filtered and not failed:
+                hists_a = _char_hists(&domains_a[0, 0], domains_a.shape[1],
+                                      &lengths_a[0], n_a)
+                hists_b = _char_hists(&domains_b[0, 0], domains_b.shape[1],
+                                      &lengths_b[0], n_b)
+                failed = hists_a == NULL or hists_b == NULL
+
+            for i in range(n_a if not failed else 0):
+                src = &domains_a[i, 0]
+                m = lengths_a[i]
+                if bit_parallel:
+                    _set_masks(peq, words, src, m, False)
+
+                for j in range(i + 1 if upper else 0, n_b):
+                    dst_len = lengths_b[j]
+                    max_len = m if m > dst_len else dst_len
+                    if filtered and \
+                       _ruled_out(m, dst_len, threshold,
+                                  hists_a + i * HIST_WIDTH,
+                                  hists_b + j * HIST_WIDTH):
+                        continue
+                    scored += 1
+
+                    if not levenshtein:
+                        s = _similarity(metric_c, src, m, &domains_b[j, 0],
+                                        dst_len, &grams_a, i, &grams_b, j,
+                                        threshold)
+                        distance = 0 if s >= 0 else -1
+                    elif bit_parallel:
+                        distance = _bit_parallel(peq, words, vp, vn, m,
+                                                 &domains_b[j, 0], dst_len,
+                                                 max_distance(max_len,
+                                                              threshold))
+                        s = score(distance, max_len)
+                    else:
+                        distance = _edit_distance(src, m, &domains_b[j, 0],
+                                                  dst_len,
+                                                  max_distance(max_len,
+                                                               threshold))
+                        s = score(distance, max_len)
+
+                    if distance < 0 or \
+                       (s > threshold and _push(&out, i, j, s) < 0):
+                        failed = True
+                        break
+
+                if bit_parallel:
+                    _set_masks(peq, words, src, m, True)
+                if failed:
+                    break
+    elif n_a > 0 and n_b > 0:
+        failed = True
+
+    free(peq)
+    free(vp)
+    free(vn)
+    free(grams_a.grams)
+    free(grams_a.counts)
+    free(grams_b.grams)
+    free(grams_b.counts)
+    free(hists_a)
+    free(hists_b)
+
+    result = _triplet_arrays(&out)
+    if failed:
+        raise MemoryError("unable to allocate scoring buffers")
+    if n_scored is not None:
+        n_scored[0] += scored
+
+    return result
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def score_pairs(const unsigned char[:, ::1] domains,
+                const int32_t[::1] lengths,
+                const int64_t[::1] rows, const int64_t[::1] cols,
+                double threshold=0.0, int backend=BACKEND_BIT_PARALLEL,
+                metric=METRIC_LEVENSHTEIN, bint prune=False,
+                int64_t[::1] n_scored=None):
+    """Score explicit pairs (rows[p], cols[p]) of packed domains (see
+    `pack_domains`) without the GIL
+
+    Pairs sharing a row should be adjacent, so that the pattern masks of the
+    row are built once. `metric` is any metric of `METRICS`, `backend` only
+    applies to Levenshtein. `prune` and `n_scored` are those of
+    `score_block`.
+
+    Returns:
+    (i, j, score) NumPy arrays of the pairs scoring above `threshold`
+    """
+    cdef Py_ssize_t n_pairs = rows.shape[0]
+    cdef Py_ssize_t words = (domains.shape[1] + 63) // 64
+    cdef int metric_c = metric_id(metric)
+    cdef bint levenshtein = metric_c == M_LEVENSHTEIN
+    cdef bint bit_parallel = levenshtein and backend == BACKEND_BIT_PARALLEL
+    cdef bint filtered = prune and (levenshtein or metric_c == M_DAMERAU)
+    cdef QGramTable grams = QGramTable(0, NULL, NULL)
+    cdef Py_ssize_t p, i, j, m = 0, dst_len, max_len, distance
+    cdef Py_ssize_t masked = -1
+    cdef Py_ssize_t scored = 0
+    cdef const unsigned char* src = NULL
+    cdef float s
+    cdef bint failed = False
+    cdef Triplets out = Triplets(0, 0, NULL, NULL, NULL)
+    cdef unsigned char* hists = NULL
+
+    if cols.shape[0] != n_pairs:
+        raise ValueError("rows and cols differ in length")
+    if n_scored is not None and n_scored.shape[0] < 1:
+        raise ValueError("n_scored needs at least one element")
+
+    if words == 0:
+        words = 1
+    cdef uint64_t* peq = <uint64_t*> calloc(256 * words, sizeof(uint64_t))
+    cdef uint64_t* vp = <uint64_t*> malloc(words * sizeof(uint64_t))
+    cdef uint64_t* vn = <uint64_t*> malloc(words * sizeof(uint64_t))
+
+    if n_pairs > 0 and peq != NULL and vp != NULL and vn != NULL:
+        with nogil:
+            if metric_c == M_QGRAM_JACCARD:
+                failed = _qgram_table(&grams, &domains[0, 0],
+                                      domains.shape[1], &lengths[0],
+                                      domains.shape[0]) < 0
+            if filtered and not failed:
+                hists = _char_hists(&domains[0, 0], domains.shape[1],
+                                    &lengths[0], domains.shape[0])
+                failed = hists == NULL
+
+            for p in range(n_pairs if not failed else 0):
+                i = rows[p]
+                j = cols[p]
+                if filtered and \
+                   _ruled_out(lengths[i], lengths[j], threshold,
+                              hists + i * HIST_WIDTH, hists + j * HIST_WIDTH):
+                    continue
+                scored += 1
+
+                if i != masked:
+                    if bit_parallel and masked >= 0:
+                        _set_masks(peq, words, src, m, True)
+                    src = &domains[i, 0]
+                    m = lengths[i]
+                    if bit_parallel:
+                        _set_masks(peq, words, src, m, False)
+                    masked = i
+
+                dst_len = lengths[j]
+                max_len = m if m > dst_len else dst_len
+                if not levenshtein:
+                    s = _similarity(metric_c, src, m, &domains[j, 0], dst_len,
+                                    &grams, i, &grams, j, threshold)
+                    distance = 0 if s >= 0 else -1
+                elif bit_parallel:
+                    distance = _bit_parallel(peq, words, vp, vn, m,
+                                             &domains[j, 0], dst_len,
+                                             max_distance(max_len, threshold))
+                    s = score(distance, max_len)
+                else:
+                    distance = _edit_distance(src, m, &domains[j, 0], dst_len,
+                                              max_distance(max_len, threshold))
+                    s = score(distance, max_len)
+
+                if distance < 0 or \
+                   (s > threshold and _push(&out, i, j, s) < 0):
+                    failed = True
+                    break
+    elif n_pairs > 0:
+        failed = True
+
+    free(peq)
+    free(vp)
+    free(vn)
+    free(grams.grams)
+    free(grams.counts)
+    free(hists)
+
+    result = _triplet_arrays(&out)
+    if failed:
+        raise MemoryError("unable to allocate scoring buffers")
+    if n_scored is not None:
+        n_scored[0] += scored
+
+    return result
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def bk_search(PatternMask mask, const unsigned char[::1] buffer,
+              const int64_t[::1] offsets, const int64_t[::1] child_ptr,
+              const int32_t[::1] child_edge, const int64_t[::1] child_node,
+              const int32_t[::1] max_edge, const int64_t[::1] roots,
+              Py_ssize_t radius, double threshold=-1.0):
+    """Radius query over a flattened BK-tree forest
+
+    Node i holds buffer[offsets[i]:offsets[i + 1]], its children are
+    child_node[child_ptr[i]:child_ptr[i + 1]] at distances child_edge[...],
+    and `max_edge[i]` is its largest child edge. The arrays may be read-only,
+    e.g. memory-mapped.
+
+    Positional Arguments:
+    mask        -- `PatternMask` of the query
+    buffer      -- concatenated node domains
+    offsets     -- node domain offsets into `buffer`
+    child_ptr   -- per node start of its children
+    child_edge  -- edge distance of every child
+    child_node  -- node index of every child
+    max_edge    -- per node largest child edge
+    roots       -- root node of every tree in the forest
+    radius      -- largest distance to report
+
+    Keyword Arguments:
+    threshold   -- only report nodes scoring above it
+
+    Returns:
+    (`int64` array of nodes, `int64` array of their distances, `float32`
+    array of their scores)
+    """
+    cdef Triplets out
+    cdef int64_t* stack
+    cdef void* grown
+    cdef Py_ssize_t top = 0, capacity = max(16, roots.shape[0])
+    cdef Py_ssize_t m = mask.length
+    cdef Py_ssize_t node, length, bound, distance, c, edge
+    cdef const unsigned char* base = NULL
+    cdef float s
+    cdef bint failed = False
+
+    out.size = 0
+    out.capacity = 0
+    out.i = NULL
+    out.j = NULL
+    out.score = NULL
+
+    if radius < 0:
+        return _triplet_arrays(&out)
+    if buffer.shape[0] > 0:
+        base = &buffer[0]
+
+    stack = <int64_t*> malloc(capacity * sizeof(int64_t))
+    if stack == NULL:
+        raise MemoryError("unable to allocate search stack")
+    for c in range(roots.shape[0]):
+        stack[top] = roots[c]
+        top += 1
+
+    with nogil:
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            length = offsets[node + 1] - offsets[node]
+
+            # a subtree can only match if its root is within radius plus
+            # its farthest edge, which the length difference may rule out
+            bound = radius + max_edge[node]
+            if length - m > bound or m - length > bound:
+                continue
+            distance = mask._distance(base + offsets[node], length, bound)
+            if distance > bound:
+                continue
+
+            if distance <= radius:
+                s = score(distance, m if m > length else length)
+                if s > threshold and _push(&out, node, distance, s) < 0:
+                    failed = True
+                    break
+
+            for c in range(child_ptr[node], child_ptr[node + 1]):
+                edge = child_edge[c]
+                if edge - distance > radius or distance - edge > radius:
+                    continue
+                if top == capacity:
+                    grown = realloc(stack, 2 * capacity * sizeof(int64_t))
+                    if grown == NULL:
+                        failed = True
+                        break
+                    stack = <int64_t*> grown
+                    capacity *= 2
+                stack[top] = child_node[c]
+                top += 1
+            if failed:
+                break
+
+    free(stack)
+    if failed:
+        free(out.i)
+        free(out.j)
+        free(out.score)
+        raise MemoryError("unable to grow search buffers")
+
+    return _triplet_arrays(&out)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def bk_build(const unsigned char[::1] buffer, const int64_t[::1] offsets):
+    """Build a BK-tree over the domains buffer[offsets[i]:offsets[i + 1]],
+    inserted in order, without the GIL
+
+    The tree is the one `win_index.BKTree` builds from the same domains,
+    flattened into the layout walked by `bk_search` (children by edge).
+
+    Positional Arguments:
+    buffer      -- concatenated domains
+    offsets     -- domain offsets into `buffer`
+
+    Returns:
+    (`int64` child_ptr, `int32` child_edge, `int64` child_node, `int32`
+    max_edge), see `bk_search`
+    """
+    cdef Py_ssize_t n = max(0, offsets.shape[0] - 1)
+    cdef Py_ssize_t i, node, c, p, q, m, length, distance, longest = 0
+    cdef const unsigned char* base = NULL
+    cdef const unsigned char* src
+    cdef int32_t edge
+    cdef int64_t child
+
+    for i in range(n):
+        longest = max(longest, offsets[i + 1] - offsets[i])
+    cdef Py_ssize_t words = max(1, (longest + 63) // 64)
+
+    first_child_arr = np.full(n, -1, dtype=np.int64)
+    next_sibling_arr = np.full(n, -1, dtype=np.int64)
+    edges_arr = np.zeros(n, dtype=np.int32)
+    max_edge_arr = np.zeros(n, dtype=np.int32)
+    child_ptr_arr = np.zeros(n + 1, dtype=np.int64)
+    child_edge_arr = np.zeros(max(0, n - 1), dtype=np.int32)
+    child_node_arr = np.zeros(max(0, n - 1), dtype=np.int64)
+    cdef int64_t[::1] first_child = first_child_arr
+    cdef int64_t[::1] next_sibling = next_sibling_arr
+    cdef int32_t[::1] edges = edges_arr
+    cdef int32_t[::1] max_edge = max_edge_arr
+    cdef int64_t[::1] child_ptr = child_ptr_arr
+    cdef int32_t[::1] child_edge = child_edge_arr
+    cdef int64_t[::1] child_node = child_node_arr
+
+    cdef uint64_t* peq = <uint64_t*> calloc(256 * words, sizeof(uint64_t))
+    cdef uint64_t* vp = <uint64_t*> malloc(words * sizeof(uint64_t))
+    cdef uint64_t* vn = <uint64_t*> malloc(words * sizeof(uint64_t))
+    if peq == NULL or vp == NULL or vn == NULL:
+        free(peq)
+        free(vp)
+        free(vn)
+        raise MemoryError("unable to allocate pattern masks")
+    if buffer.shape[0] > 0:
+        base = &buffer[0]
+
+    with nogil:
+        # === INSERT, children as linked lists of siblings ===
+        for i in range(1, n):
+            src = base + offsets[i]
+            m = offsets[i + 1] - offsets[i]
+            _set_masks(peq, words, src, m, False)
+
+            node = 0
+            while True:
+                length = offsets[node + 1] - offsets[node]
+                distance = _bit_parallel(peq, words, vp, vn, m,
+                                         base + offsets[node], length,
+                                         m + length)
+                c = first_child[node]
+                while c >= 0 and edges[c] != distance:
+                    c = next_sibling[c]
+                if c < 0:
+                    edges[i] = <int32_t> distance
+                    next_sibling[i] = first_child[node]
+                    first_child[node] = i
+                    child_ptr[node + 1] += 1
+                    if distance > max_edge[node]:
+                        max_edge[node] = <int32_t> distance
+                    break
+                node = c
+
+            _set_masks(peq, words, src, m, True)
+
+        # === FLATTEN, every node's children sorted by edge ===
+        for node in range(n):
+            child_ptr[node + 1] += child_ptr[node]
+        for node in range(n):
+            p = child_ptr[node]
+            c = first_child[node]
+            while c >= 0:
+                # insertion sort, nodes have few children
+                q = p
+                while q > child_ptr[node] and child_edge[q - 1] > edges[c]:
+                    child_edge[q] = child_edge[q - 1]
+                    child_node[q] = child_node[q - 1]
+                    q -= 1
+                child_edge[q] = edges[c]
+                child_node[q] = c
+                p += 1
+                c = next_sibling[c]
+
+    free(peq)
+    free(vp)
+    free(vn)
+
+    return child_ptr_arr, child_edge_arr, child_node_arr, max_edge_arr
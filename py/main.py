@@ -1,48 +1,36 @@
 """Runner module for sliding windows implementation"""
-import numpy as np
 import matplotlib.pyplot as plt
-from scipy.ndimage import gaussian_filter
-from scipy.sparse import lil_matrix
 
 import win_proc
-from win_util import fetch_lines
+from win_domains import DomainStore
 from win_stat import StatType
+from win_viz import density_grid, plot_heatmap, smooth_grid
 
 def main():
     """Sample run of processing sliding windows of domains"""
-    n = 1744 # total length of input file
     THRESHOLD = 0.500
 
-    domain_list = fetch_lines("../data/domains.in")
+    domains = DomainStore.from_file("../data/domains.in")
+    n = len(domains) # total length of input file
     FLAGS = StatType.MAX.value     \
             | StatType.MIN.value   \
             | StatType.TOP_K.value \
             | StatType.MEAN.value  \
             | StatType.STD_DEV.value
 
-    sim_mat = win_proc.process_windows(domain_list, n, THRESHOLD, FLAGS)
-    sim_mat_dense = sim_mat.toarray()
-    sim_mat_filtered = gaussian_filter(sim_mat_dense, sigma=5, mode="constant",
-                                       cval=0.0)
-    sim_mat = lil_matrix(sim_mat_filtered)
+    sim_mat,_ = win_proc.process_windows(domains, n, THRESHOLD, FLAGS)
+
+    # bin into a fixed size grid instead of densifying the n x n matrix
+    grid = smooth_grid(density_grid(sim_mat, resolution=2048), sigma=5, n=n)
 
     PLOT=True
     if PLOT:
         # plot the matrix as a heatmap
-        fig, ax = plt.subplots()
-        im = ax.imshow(sim_mat.toarray(), cmap='hot')
-        
-        # add a colorbar legend
-        cbar = ax.figure.colorbar(im, ax=ax)
-        
-        # set the axis labels
-        ax.set_xticks(np.arange(n, 1000))
-        ax.set_yticks(np.arange(n, 1000))
-        ax.set_title("Similarity Matrix Viz")
-        
+        plot_heatmap(grid, n)
+
         # show the plot
         print("Plot is shown")
         plt.show()
-    
+
 if __name__ == "__main__":
     main()
@@ -2,6 +2,8 @@
 implementation
 """
 
+from math import sqrt
+
 import win_util
 
 class SlidingWindow:
@@ -67,7 +69,7 @@ class SlidingWindow:
 
         self.set_size(candidate_window)
 
-    def slide(self, corpus, n, n_processed, elapsed):
+    def slide(self, corpus, n, n_processed, elapsed, controller=None):
         """Move window given an amount to advance by
 
         Positional Arguments:
@@ -75,9 +77,191 @@ class SlidingWindow:
         n           -- total amount of data in corpus
         n_processed -- total amount of data read so far
         elapsed     -- total amount of time to compute current window
+
+        Keyword Arguments:
+        controller  -- `WindowController` choosing the next size, None falls
+                       back to a 10s target on `elapsed`
         """
-        request = int(self.get_size() * win_util.modified_tanh(0.1,
-                                                               elapsed, 10))
+        if controller is None:
+            request = int(self.get_size() * win_util.modified_tanh(0.1,
+                                                                   elapsed,
+                                                                   10))
+        else:
+            request = controller.next_size(self.get_size(), n_processed) \
+                      - self.get_size()
 
         self.resize(n, n_processed, request)
         self.set_data(win_util.take(corpus, self.get_size()))
+
+class WindowController:
+    """Wall-clock driven window size controller
+
+    The controller keeps an exponential moving average of the pair throughput
+    (unique pairs covered per second of wall time, across all phases) and
+    picks the window size whose predicted latency meets `target_latency`.
+    Steps are shaped by `win_util.modified_tanh`, limited to `max_step` of the
+    current size and ignored inside a `deadband` around the target, so the
+    size settles instead of oscillating between the window limits.
+    """
+    def __init__(self, target_latency=10.0, target_rate=None,
+                 memory_budget=None, bytes_per_pair=16, smoothing=0.5,
+                 max_step=0.25, deadband=0.05, steepness=1.0):
+        """Non-default constructor
+
+        Keyword Arguments:
+        target_latency  -- wall time SLO per window, in seconds
+        target_rate     -- minimum pairs/sec, windows grow to amortize fixed
+                           per-window costs while below it (within the
+                           latency SLO)
+        memory_budget   -- bytes a window may spend on pairs, None for no cap
+        bytes_per_pair  -- bytes of pair bookkeeping per unique pair
+        smoothing       -- weight of the newest observation in the average
+        max_step        -- largest relative change of the size per window
+        deadband        -- relative distance from the target that is
+                           tolerated without resizing
+        steepness       -- `k` of `win_util.modified_tanh`
+        """
+        self.target_latency = target_latency
+        self.target_rate = target_rate
+        self.memory_budget = memory_budget
+        self.bytes_per_pair = bytes_per_pair
+        self.smoothing = smoothing
+        self.max_step = max_step
+        self.deadband = deadband
+        self.steepness = steepness
+        self.cross_window = True
+        self.rate = None
+
+    def set_cross_window(self, cross_window):
+        """Setter, whether windows are also scored against earlier ones"""
+        self.cross_window = cross_window
+
+    def get_rate(self):
+        """Getter, smoothed pairs/sec or None before the first window"""
+        return self.rate
+
+    def observe(self, n_pairs, elapsed):
+        """Record a processed window
+
+        Positional Arguments:
+        n_pairs -- unique pairs the window covered
+        elapsed -- wall time the window took, in seconds
+        """
+        if elapsed <= 0 or n_pairs <= 0:
+            return
+
+        rate = n_pairs / elapsed
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate += self.smoothing * (rate - self.rate)
+
+    def n_pairs(self, size, n_processed):
+        """Unique pairs a window of `size` covers after `n_processed`
+        domains"""
+        pairs = size * (size - 1) / 2
+        if self.cross_window:
+            pairs += size * n_processed
+
+        return pairs
+
+    def memory_cap(self):
+        """Largest window whose own pairs fit into the memory budget
+
+        Tiles against earlier windows are streamed in bounded row blocks, so
+        only the window's pairs with itself count against the budget.
+        """
+        if self.memory_budget is None:
+            return None
+
+        n_pairs = self.memory_budget / self.bytes_per_pair
+        return max(1, int(0.5 + sqrt(0.25 + 2 * n_pairs)))
+
+    def size_for(self, n_pairs, n_processed):
+        """Largest window covering at most `n_pairs` unique pairs"""
+        offset = n_processed - 0.5 if self.cross_window else -0.5
+
+        # positive root of size^2 / 2 + offset * size - n_pairs = 0
+        return int(-offset + sqrt(offset * offset + 2 * n_pairs))
+
+    def next_size(self, size, n_processed):
+        """Choose the size of the next window
+
+        Positional Arguments:
+        size        -- size of the current window
+        n_processed -- total amount of data read so far
+
+        Returns:
+        size of the next window, before the window's min/max clamping
+        """
+        if self.rate is None:
+            return size
+
+        latency = self.n_pairs(size, n_processed) / self.rate
+        ratio = latency / self.target_latency
+
+        if self.target_rate is not None and self.rate < self.target_rate \
+           and ratio < 1:
+            # below the rate floor, grow while the SLO allows it
+            step = self.max_step * min(1.0, 1 - ratio)
+        elif abs(ratio - 1) <= self.deadband:
+            step = 0.0
+        else:
+            # ratio > 1 shrinks, ratio < 1 grows
+            step = self.max_step * win_util.modified_tanh(self.steepness,
+                                                          ratio, 1)
+
+        candidate = int(round(size * (1 + step)))
+        if candidate == size and step != 0:
+            candidate += 1 if step > 0 else -1
+
+        # never overshoot the size that exactly meets the SLO
+        ideal = self.size_for(self.target_latency * self.rate, n_processed)
+        if step > 0 and candidate > ideal >= size:
+            candidate = ideal
+        elif step < 0 and candidate < ideal <= size:
+            candidate = ideal
+
+        cap = self.memory_cap()
+        if cap is not None and candidate > cap:
+            candidate = cap
+
+        return max(1, candidate)
+
+class TileSchedule:
+    """Upper triangle tiling of the similarity matrix over the windows
+
+    Every window becomes a block of consecutive rows/columns. When a block is
+    added, it is tiled against itself and against every earlier block, so
+    pairs that straddle window boundaries are covered too. Tiles come out in a
+    fixed order (by column block, then row block), so a run can be resumed
+    from the number of tiles completed.
+    """
+    def __init__(self):
+        """Default constructor"""
+        self.blocks = []
+
+    def get_blocks(self):
+        """Getter"""
+        return self.blocks
+
+    def add_block(self, offset, size):
+        """Register the next window and list the tiles it completes
+
+        Positional Arguments:
+        offset  -- global index of the window's first domain
+        size    -- number of domains in the window
+
+        Returns:
+        list of (row block, column block) index pairs, the diagonal tile of
+        the new block first
+        """
+        self.blocks.append((offset, size))
+        col = len(self.blocks) - 1
+
+        return [(col, col)] + [(row, col) for row in range(col)]
+
+    def n_tiles(self):
+        """Number of tiles covering the blocks added so far"""
+        n_blocks = len(self.blocks)
+        return n_blocks * (n_blocks + 1) // 2
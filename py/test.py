@@ -1,10 +1,34 @@
+from itertools import combinations
+import asyncio
+import contextlib
+import io
+import json
+from multiprocessing import Pool, active_children
 import os
+import shutil
 import unittest
 
-from edit_distance import edit_distance
-from sliding_window import SlidingWindow
+import numpy as np
+from scipy.sparse.csgraph import connected_components
+
+from edit_distance import BACKEND_BIT_PARALLEL, BACKEND_DP, METRICS, \
+                          PatternMask, damerau_distance, edit_distance, \
+                          edit_distance_bounded, metric_id, pack_domains, \
+                          score_block, score_pair, score_pairs, similarity
+from sliding_window import SlidingWindow, TileSchedule, WindowController
+import bench
+import win_cluster
+import win_domains
+import win_incr
+import win_index
+import win_lsh
+import win_matrix
+import win_proc
 import win_util
+import win_viz
 import win_stat
+import win_service
+import win_store
 
 class TestTbsp(unittest.TestCase):
     def setUp(self):
@@ -36,6 +60,8 @@ class TestTbsp(unittest.TestCase):
 
         m = 2
         self.assertEqual(len(list(win_util.take(xs, m))), m)
+        # consecutive takes continue where the last one stopped
+        self.assertListEqual(list(win_util.take(xs, m)), [2, 3])
 
     def test_remove_tld(self):
         domain = "dns1.google.com"
@@ -48,6 +74,27 @@ class TestTbsp(unittest.TestCase):
     def test_fetch_lines(self):
         self.assertEqual(len(list(win_util.fetch_lines(fn))), n)
 
+    def test_load_domains(self):
+        buffer, offsets = win_util.load_domains(fn)
+
+        self.assertEqual(len(offsets) - 1, n)
+        self.assertListEqual(list(win_util.iter_domains(buffer, offsets)),
+                             list(win_util.fetch_lines(fn)))
+
+    def test_load_domains_public_suffixes(self):
+        psl = "psl.txt"
+        with open(psl, "wb") as fp:
+            fp.write(b"// comment\nuk\nco.uk\n*.ck\n")
+        with open(fn, "wb") as fp:
+            fp.write(b"www.bbc.co.uk\r\n  nike.com\nlocalhost\n\nco.uk")
+
+        buffer, offsets = win_util.load_domains(
+            fn, win_util.load_public_suffixes(psl))
+        os.unlink(psl)
+
+        self.assertListEqual(list(win_util.iter_domains(buffer, offsets)),
+                             [b"www.bbc", b"nike", b"localhost", b"", b"co"])
+
     def test_sliding_window_get_data(self):
         window_len = 6
 
@@ -142,6 +189,88 @@ class TestTbsp(unittest.TestCase):
         # k is set at 5
         self.assertListEqual(list(window_top_k), [1, 2, 3, 4, 5])
 
+    def test_stat_accumulator(self):
+        scores = range(6)
+        stats = win_stat.StatAccumulator(win_stat.StatType.TOP_K.value, k=3)
+
+        pairs = [((b"a", b"b"), score) for score in scores]
+        self.assertListEqual(list(stats.observe(pairs)), pairs)
+
+        self.assertEqual(stats.count, 6)
+        self.assertEqual(stats.min[1], 0)
+        self.assertEqual(stats.max[1], 5)
+        self.assertEqual(stats.mean, win_stat.win_mean(scores))
+        self.assertEqual(round(stats.variance() ** 0.5, 3), 1.871)
+        self.assertListEqual(sorted(score for score,_,_ in stats.top_k),
+                             [3, 4, 5])
+
+        # blocks of arrays agree with pair by pair updates
+        rng = np.random.default_rng(0)
+        scores = np.round(rng.random(200), 2)
+        rows = np.arange(200)
+        cols = rows + 1
+        flags = sum(stat.value for stat in win_stat.StatType)
+        expected = win_stat.StatAccumulator(flags, k=4)
+        for i,j,score in zip(rows.tolist(), cols.tolist(), scores.tolist()):
+            expected.update((i, j), score)
+        actual = win_stat.StatAccumulator(flags, k=4)
+        blocks = [(rows[a:a + 30], cols[a:a + 30], scores[a:a + 30])
+                  for a in range(0, 200, 30)]
+        self.assertEqual(len(list(actual.observe_blocks(blocks))), 7)
+        self.assertEqual(actual.count, expected.count)
+        self.assertAlmostEqual(actual.mean, expected.mean)
+        self.assertAlmostEqual(actual.variance(), expected.variance())
+        self.assertEqual(actual.min, expected.min)
+        self.assertEqual(actual.max, expected.max)
+        self.assertListEqual(sorted(actual.top_k), sorted(expected.top_k))
+
+        # the console header follows `k`
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            win_stat.print_stats(stats.result())
+        self.assertIn("Top 3 Scores:", output.getvalue())
+        self.assertEqual(output.getvalue().count(" | "), 6)
+
+    def test_process_windows_stats(self):
+        corpus = win_util.fetch_lines(fn)
+        flags = win_stat.StatType.TOP_K.value | win_stat.StatType.MAX.value
+
+        lines = io.StringIO()
+        _,window_stats = win_proc.process_windows(
+            corpus, n, 0.2, flags,
+            reporter=win_stat.JsonLinesReporter(lines))
+
+        self.assertEqual(len(window_stats), 1)
+        stats = window_stats[0]
+        self.assertEqual(stats.size, n)
+        self.assertEqual(stats.n_pairs, n * (n - 1) // 2)
+        self.assertEqual(stats.n_pairs, stats.n_pruned + stats.n_scored)
+        self.assertEqual(stats.n_kept, 8)
+        self.assertEqual(stats.max[1], stats.top_k[-1][1])
+        self.assertIsNone(stats.mean)
+
+        record = json.loads(lines.getvalue())
+        self.assertEqual(record["n_kept"], 8)
+        self.assertEqual(record["n_inserted"], 8)
+        self.assertIsInstance(record["max"][0], str)
+
+    def test_metrics(self):
+        corpus = list(win_util.fetch_lines(fn))
+        metrics = win_stat.Metrics()
+
+        _,window_stats = win_proc.process_windows(
+            iter(corpus), n, 0.2, 0, reporter=None, metrics=metrics,
+            win_min=3, win_max=4)
+
+        self.assertEqual(metrics.get("windows"), len(window_stats))
+        self.assertEqual(metrics.get("generated"), n * (n - 1) // 2)
+        self.assertEqual(metrics.get("generated"),
+                         metrics.get("pruned") + metrics.get("scored"))
+        self.assertEqual(metrics.get("kept"), 8)
+        self.assertEqual(metrics.get("inserted"), 8)
+        self.assertSetEqual(set(metrics.to_dict()["phase_times"]),
+                            {"prune", "score", "stats", "matrix"})
+
     def test_sliding_window_resize(self):
         corpus = win_util.fetch_lines(fn)
 
@@ -174,6 +303,43 @@ class TestTbsp(unittest.TestCase):
 
         self.assertEqual(window.get_size(), 1)
 
+    def test_window_controller_converges(self):
+        # constant 1M pairs/sec, a 1s SLO fits a ~1414 domain window
+        controller = WindowController(target_latency=1.0)
+        controller.set_cross_window(False)
+
+        size = 200
+        sizes = []
+        for _ in range(30):
+            n_pairs = controller.n_pairs(size, 0)
+            controller.observe(n_pairs, n_pairs / 1e6)
+            size = controller.next_size(size, 0)
+            sizes.append(size)
+
+        # grows monotonically, never past the target, and settles
+        self.assertListEqual(sizes, sorted(sizes))
+        self.assertLessEqual(abs(sizes[-1] - 1414), 1414 * 0.05)
+        self.assertEqual(sizes[-1], sizes[-2])
+
+    def test_window_controller_memory_cap(self):
+        # 16 bytes per pair, 800 bytes fit 50 pairs, i.e. 10 domains
+        controller = WindowController(target_latency=1.0, memory_budget=800)
+        controller.observe(1, 1e-6)
+
+        self.assertEqual(controller.memory_cap(), 10)
+        self.assertEqual(controller.next_size(10, 0), 10)
+
+    def test_sliding_window_slide_controller(self):
+        corpus = win_util.fetch_lines(fn)
+
+        window_len = 3
+        window = SlidingWindow(corpus, window_len, 0, window_len)
+        controller = WindowController()
+
+        # no observation yet, the size is kept and clamped to what is left
+        window.slide(corpus, n, 9, 0, controller)
+        self.assertEqual(window.get_size(), 1)
+
     def test_edit_distance(self):
         subdomain1 = b"google"
         subdomain2 = b"dns.google"
@@ -183,5 +349,792 @@ class TestTbsp(unittest.TestCase):
         # add 4 characters to beginning of `subdomain1` to equal `subodmain2`
         self.assertEqual(ed, 4)
 
+    def test_edit_distance_long(self):
+        # (m + 1) * (n + 1) is well past the old 16384 cell table
+        subdomain1 = b"a" * 300
+        subdomain2 = b"b" + b"a" * 299 + b"c" * 50
+
+        self.assertEqual(edit_distance(subdomain1, subdomain2), 51)
+
+    def test_edit_distance_bounded(self):
+        subdomain1 = b"google"
+        subdomain2 = b"dns.google"
+
+        self.assertEqual(edit_distance_bounded(subdomain1, subdomain2, 4), 4)
+        # distance is 4, so anything above a bound of 2 is reported as 3
+        self.assertEqual(edit_distance_bounded(subdomain1, subdomain2, 2), 3)
+
+    def test_score_pair_threshold(self):
+        pair = (b"google", b"dns.google")
+
+        _,score = score_pair(pair)
+        _,bounded_score = score_pair(pair, 0.5)
+        self.assertEqual(bounded_score, score)
+
+        # the bound cuts the computation short, score still filtered out
+        _,bounded_score = score_pair(pair, 0.9)
+        self.assertLessEqual(bounded_score, 0.9)
+
+    def test_row_blocks(self):
+        blocks = list(win_proc.row_blocks(10, 8))
+
+        # blocks are contiguous and cover every row of the window
+        self.assertEqual(blocks[0][0], 0)
+        self.assertEqual(blocks[-1][1], 10)
+        for prev, nxt in zip(blocks, blocks[1:]):
+            self.assertEqual(prev[1], nxt[0])
+
+    def test_multiprocessed_work(self):
+        corpus = list(win_util.fetch_lines(fn))
+
+        expected = list(win_proc.uniprocessed_work(score_pair,
+                                                   combinations(corpus, 2),
+                                                   0.2))
+        with Pool(2) as pool:
+            actual = list(win_proc.named_pairs(corpus,
+                win_proc.multiprocessed_work(pool, corpus, 0.2,
+                                             chunk_size=4)))
+
+        self.assertListEqual(actual, expected)
+
+    def test_multiprocessed_work_in_process(self):
+        corpus = list(win_util.fetch_lines(fn))
+
+        expected = list(win_proc.uniprocessed_work(score_pair,
+                                                   combinations(corpus, 2),
+                                                   0.2))
+        actual = list(win_proc.named_pairs(corpus,
+            win_proc.multiprocessed_work(None, corpus, 0.2,
+                                         backend=BACKEND_DP)))
+
+        self.assertListEqual(actual, expected)
+
+    def test_candidate_pairs(self):
+        corpus = list(win_util.fetch_lines(fn))
+        threshold = 0.25
+
+        candidates, n_candidates = win_proc.candidate_pairs(corpus,
+                                                            threshold)
+        self.assertLess(n_candidates, n * (n - 1) // 2)
+
+        # pruning never drops a pair that passes the threshold
+        kept = [pair for pair,_ in
+                win_proc.multiprocessed_work(None, corpus, threshold)]
+        self.assertTrue(kept)
+        for i,j in kept:
+            self.assertIn(j, candidates[i])
+
+    def test_multiprocessed_work_candidates(self):
+        corpus = list(win_util.fetch_lines(fn))
+
+        candidates,_ = win_proc.candidate_pairs(corpus, 0.2)
+        expected = list(win_proc.multiprocessed_work(None, corpus, 0.2))
+        actual = list(win_proc.multiprocessed_work(None, corpus, 0.2,
+                                                   candidates=candidates))
+
+        self.assertListEqual(actual, expected)
+
+        # candidates still go through the kernel filters
+        scored = np.zeros(1, dtype=np.int64)
+        narrowed = np.zeros(1, dtype=np.int64)
+        candidates,_ = win_proc.candidate_pairs(corpus, 0.5, q=2)
+        expected = list(win_proc.multiprocessed_work(
+            None, corpus, 0.5, prune=True, n_scored=scored))
+        actual = list(win_proc.multiprocessed_work(
+            None, corpus, 0.5, candidates=candidates, prune=True,
+            n_scored=narrowed))
+        self.assertListEqual(actual, expected)
+        self.assertLessEqual(narrowed[0], scored[0])
+
+        # at 0.5 bigram counts cannot rule out any pair
+        lengths = np.arange(1, 64)
+        self.assertFalse((win_proc.qgram_bound(lengths, 0.5, 2) > 0).any())
+        self.assertTrue((win_proc.qgram_bound(lengths, 0.8, 2) > 0).any())
+
+    def test_matrix_builder(self):
+        builder = win_matrix.MatrixBuilder(n, capacity=1)
+
+        builder.add_pairs([((0, 1), 0.5), ((1, 2), 0.75)])
+        builder.add_pairs([((0, 2), 0.25)], offset=5)
+        self.assertEqual(builder.add_blocks(
+            [(np.array([0]), np.array([3]), np.array([0.125])),
+             (np.array([1, 2]), np.array([2, 3]), np.array([0.5, 0.625]))],
+            offset=1), 3)
+
+        sim_mat = builder.to_csr()
+        self.assertEqual(builder.get_size(), 6)
+        self.assertEqual(sim_mat.shape, (n, n))
+        self.assertEqual(sim_mat[0, 1], 0.5)
+        self.assertEqual(sim_mat[1, 2], 0.75)
+        self.assertEqual(sim_mat[5, 7], 0.25)
+        self.assertEqual(sim_mat[1, 4], 0.125)
+        self.assertEqual(sim_mat[3, 4], 0.625)
+
+    def test_process_windows_matrix(self):
+        corpus = win_util.fetch_lines(fn)
+        domains = list(win_util.fetch_lines(fn))
+
+        sim_mat,_ = win_proc.process_windows(corpus, n, 0.2, 0,
+                                             reporter=None)
+
+        # every kept pair sits at the indices of its domains
+        expected = win_proc.uniprocessed_work(score_pair,
+                                              combinations(domains, 2), 0.2)
+        for (a,b),score in expected:
+            self.assertAlmostEqual(sim_mat[domains.index(a),
+                                           domains.index(b)], score)
+        self.assertEqual(sim_mat.nnz, 8)
+
+    def test_process_windows_dedup(self):
+        domains = list(win_util.fetch_lines(fn))
+        duplicated = domains[:4] + domains[:2] + domains[4:] + domains[1:2]
+
+        unique, inverse, counts = win_domains.DomainStore.from_domains(
+            duplicated).dedup()
+        self.assertListEqual(list(unique), domains)
+        self.assertListEqual([unique[i] for i in inverse], duplicated)
+        self.assertListEqual(counts[:3].tolist(), [2, 3, 1])
+
+        # duplicates are mapped back as if every copy had been scored
+        expected,_ = win_proc.process_windows(
+            iter(duplicated), len(duplicated), 0.2, 0, reporter=None,
+            dedup=False)
+        sim_mat,window_stats = win_proc.process_windows(
+            iter(duplicated), len(duplicated), 0.2, 0, reporter=None)
+        self.assertEqual(sim_mat.shape, expected.shape)
+        self.assertEqual(abs(sim_mat - expected).max(), 0)
+        self.assertEqual(sim_mat[0, 4], 1.0)
+        self.assertEqual(window_stats[0].size, n)
+
+    def test_shard_sink(self):
+        domains = list(win_util.fetch_lines(fn))
+        duplicated = domains + domains[:3]
+        path = "shards"
+
+        expected,_ = win_proc.process_windows(
+            iter(duplicated), len(duplicated), 0.2, 0, reporter=None,
+            win_min=3, win_max=4)
+        try:
+            sim_mat,_ = win_proc.process_windows(
+                iter(duplicated), len(duplicated), 0.2, 0, reporter=None,
+                win_min=3, win_max=4,
+                sink=win_store.ShardWriter(path, len(duplicated),
+                                           shard_size=4))
+            self.assertGreater(len(sim_mat.shards), 1)
+            self.assertEqual(sim_mat.nnz, expected.nnz)
+            self.assertEqual(abs(sim_mat.to_csr() - expected).max(), 0)
+
+            # lazily read back from disk
+            reader = win_store.ShardedMatrix(path)
+            self.assertEqual(abs(reader.rows(2, 7) - expected[2:7]).max(), 0)
+            self.assertEqual(abs(reader.block(0, 5, 5, 13)
+                                 - expected[0:5, 5:13]).max(), 0)
+            self.assertEqual(reader.get_domain(n + 1), duplicated[n + 1])
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def test_density_grid(self):
+        corpus = list(win_util.fetch_lines(fn))
+        sim_mat,_ = win_proc.process_windows(iter(corpus), n, 0.2, 0,
+                                             reporter=None)
+        dense = sim_mat.toarray()
+
+        # small matrices map one to one
+        self.assertEqual(abs(win_viz.density_grid(sim_mat) - dense).max(), 0)
+
+        # cells average the block they cover, 10 domains over 3 cells
+        grid = win_viz.density_grid(sim_mat, resolution=3)
+        self.assertEqual(grid.shape, (3, 3))
+        self.assertAlmostEqual(grid[0, 1], dense[0:4, 4:7].mean())
+        self.assertAlmostEqual(grid[2, 2], dense[7:, 7:].mean())
+
+        smoothed = win_viz.smooth_grid(grid, sigma=1, n=n)
+        self.assertEqual(smoothed.shape, grid.shape)
+
+    def test_clusterer(self):
+        clusters = win_cluster.Clusterer()
+        clusters.union_arrays([5, 1], [6, 2], [0.5, 0.9])
+        clusters.union_arrays([6, 2], [7, 5], [0.8, 0.7])
+        clusters.grow(9)
+
+        self.assertListEqual(clusters.labels().tolist(),
+                             [0, 1, 1, 3, 4, 1, 1, 1, 8])
+        # ids are the lowest member, representatives the best connected
+        self.assertListEqual(clusters.clusters(),
+                             [win_cluster.Cluster(1, 5, [2, 6, 5])])
+        self.assertEqual(len(clusters.clusters(min_size=1)), 5)
+
+    def test_process_windows_clusters(self):
+        domains = list(win_util.fetch_lines(fn))
+        duplicated = domains + domains[:1]
+        clusters = win_cluster.Clusterer()
+
+        sim_mat,window_stats = win_proc.process_windows(
+            iter(duplicated), len(duplicated), 0.4, 0, reporter=None,
+            win_min=3, win_max=4, clusters=clusters)
+
+        # the same partition as the components of the matrix
+        _,expected = connected_components(sim_mat, directed=False)
+        labels = clusters.labels()
+        self.assertEqual(len(labels), n + 1)
+        self.assertEqual(len(set(zip(expected.tolist(), labels.tolist()))),
+                         len(set(labels.tolist())))
+        self.assertEqual(labels[n], labels[0])
+        self.assertIn("cluster", window_stats[0].phase_times)
+
+    def test_process_windows_pool_cleanup(self):
+        domains = list(win_util.fetch_lines(fn))
+
+        class Interrupted(Exception):
+            pass
+
+        def reporter(result):
+            raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            win_proc.process_windows(iter(domains), n, 0.2, 0, workers=2,
+                                     reporter=reporter, win_min=3, win_max=4)
+        self.assertEqual(active_children(), [])
+
+    def test_process_windows_resume(self):
+        domains = list(win_util.fetch_lines(fn))
+        path = "windows.ckpt"
+        expected,expected_stats = win_proc.process_windows(
+            iter(domains), n, 0.2, 0, reporter=None, win_min=3, win_max=4)
+
+        class Interrupted(Exception):
+            pass
+
+        def reporter(result):
+            if result.window == 3:
+                raise Interrupted()
+
+        reported = []
+        clusters = win_cluster.Clusterer()
+        try:
+            with self.assertRaises(Interrupted):
+                win_proc.process_windows(
+                    iter(domains), n, 0.2, 0, reporter=reporter, win_min=3,
+                    win_max=4, checkpoint=path, checkpoint_interval=0,
+                    clusters=win_cluster.Clusterer())
+
+            # stopped after the last tile of window 3, before reporting it
+            state = win_proc.load_checkpoint(path)
+            self.assertEqual(state["current_window"], 3)
+            self.assertEqual(state["tiles_done"], 3)
+
+            sim_mat,window_stats = win_proc.process_windows(
+                iter(domains), n, 0.2, 0, reporter=reported.append,
+                win_min=3, win_max=4, checkpoint=path, resume=True,
+                clusters=clusters)
+            self.assertEqual(abs(sim_mat - expected).max(), 0)
+            self.assertEqual(len(window_stats), len(expected_stats))
+            self.assertEqual([result.window for result in reported],
+                             list(range(3, len(expected_stats) + 1)))
+            self.assertEqual(sum(result.n_inserted for result in window_stats),
+                             expected.nnz)
+            _,labels = connected_components(expected, directed=False)
+            self.assertEqual(len(set(zip(labels.tolist(),
+                                         clusters.labels().tolist()))),
+                             len(set(labels.tolist())))
+
+            # a finished checkpoint resumes to the same result
+            sim_mat,_ = win_proc.process_windows(
+                iter(domains), n, 0.2, 0, reporter=None, win_min=3,
+                win_max=4, checkpoint=path, resume=True)
+            self.assertEqual(abs(sim_mat - expected).max(), 0)
+
+            with self.assertRaises(ValueError):
+                win_proc.process_windows(iter(domains), n, 0.3, 0,
+                                         reporter=None, checkpoint=path,
+                                         resume=True)
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_scoring_service(self):
+        with open(fn, "rb") as fp:
+            lines = fp.read()
+        domains = list(win_util.fetch_lines(fn))
+        expected,_ = win_proc.process_windows(iter(domains), n, 0.2, 0,
+                                              reporter=None)
+
+        # small batches and a short window still see every earlier domain
+        for history in [n, 4]:
+            service = win_service.ScoringService(threshold=0.2,
+                                                 history=history,
+                                                 batch_size=3, max_delay=0.01,
+                                                 workers=2)
+            out = io.BytesIO()
+
+            async def run():
+                scorer = asyncio.create_task(service.run())
+                await service.serve_stdin(io.BytesIO(lines), out)
+                scorer.cancel()
+
+            asyncio.run(run())
+            matches = [json.loads(line)
+                       for line in out.getvalue().splitlines()]
+            found = {(domains.index(match["match"].encode()),
+                      domains.index(match["domain"].encode()))
+                     for match in matches}
+
+            # a domain sees at least the `history` before its batch
+            coo = expected.tocoo()
+            pairs = set(zip(coo.row.tolist(), coo.col.tolist()))
+            self.assertTrue(found <= pairs)
+            self.assertTrue({(i, j) for i,j in pairs if j - i <= history}
+                            <= found)
+
+    def test_scoring_service_errors(self):
+        lines = b"abcdefgh.com\nabcdefgx.com\n\xff\xfeabcdefg.com\n"
+        out = io.BytesIO()
+
+        def make_service():
+            service = win_service.ScoringService(threshold=0.5,
+                                                 max_delay=0.01, workers=1)
+            serve_stdin = service.serve_stdin
+            service.serve_stdin = lambda: serve_stdin(io.BytesIO(lines), out)
+            return service
+
+        # non UTF-8 domains are replied to instead of stopping the scorer
+        asyncio.run(win_service.serve(make_service()))
+        matches = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(matches), 3)
+        self.assertEqual(matches[-1]["domain"], "\ufffd\ufffdabcdefg")
+
+        # a failing scorer is raised instead of waited on forever
+        async def fail(batch):
+            raise ValueError("scorer failed")
+        service = make_service()
+        service.score_batch = fail
+        with self.assertRaisesRegex(ValueError, "scorer failed"):
+            asyncio.run(win_service.serve(service))
+
+    def test_minhash_signatures(self):
+        domains = [b"paypal", b"paypal", b"paypa1", b"x", b""]
+        signatures = win_lsh.minhash_signatures(domains, 256)
+
+        self.assertEqual(signatures.shape, (5, 256))
+        self.assertTrue((signatures[0] == signatures[1]).all())
+        # the share of equal hashes estimates the q-gram Jaccard similarity
+        agreement = (signatures[0] == signatures[2]).mean()
+        self.assertAlmostEqual(agreement,
+                               similarity(b"paypal", b"paypa1",
+                                          "qgram_jaccard"), delta=0.15)
+        self.assertGreater(win_lsh.collision_probability(0.8, 32, 4),
+                           win_lsh.collision_probability(0.2, 32, 4))
+
+        rows, cols = win_lsh.lsh_pairs(signatures, 32, 4)
+        self.assertIn((0, 1), set(zip(rows.tolist(), cols.tolist())))
+        self.assertTrue((rows < cols).all())
+        with self.assertRaises(ValueError):
+            win_lsh.lsh_pairs(signatures, 64, 8)
+
+    def test_process_lsh(self):
+        domains = list(win_util.fetch_lines(fn))
+        duplicated = domains + domains[:2]
+        expected,_ = win_proc.process_windows(iter(duplicated),
+                                              len(duplicated), 0.2, 0,
+                                              reporter=None)
+
+        sim_mat,stats = win_lsh.process_lsh(iter(duplicated), len(duplicated),
+                                            0.2, bands=64, rows=1,
+                                            recall_sample=n)
+        # every kept score is exact, only pairs may be missing
+        self.assertEqual(sim_mat.shape, expected.shape)
+        self.assertEqual(abs(sim_mat - expected.multiply(sim_mat > 0)).max(),
+                         0)
+        self.assertEqual(sim_mat[0, n], 1.0)
+        self.assertEqual(stats.n, n)
+        self.assertEqual(stats.n_kept, sim_mat[:n, :n].nnz)
+        unique = expected[:n, :n]
+        self.assertEqual(stats.recall,
+                         (sim_mat[:n, :n] > 0).multiply(unique > 0).nnz
+                         / unique.nnz)
+
+        # a sink keeps only the sampled pairs, recall is unchanged
+        path = "lsh.shards"
+        try:
+            _,sampled = win_lsh.process_lsh(iter(duplicated), len(duplicated),
+                                            0.2, bands=64, rows=1,
+                                            recall_sample=3)
+            sharded,streamed = win_lsh.process_lsh(
+                iter(duplicated), len(duplicated), 0.2, bands=64, rows=1,
+                recall_sample=3, sink=win_store.ShardWriter(path, n))
+            self.assertEqual(abs(sharded.to_csr() - sim_mat).max(), 0)
+            self.assertEqual(streamed.n_kept, stats.n_kept)
+            self.assertEqual(streamed.recall, sampled.recall)
+            self.assertEqual(streamed.recall_pairs, sampled.recall_pairs)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def test_process_increment(self):
+        corpus = list(win_util.fetch_lines(fn))
+        state = "state.npz"
+
+        try:
+            # repeats within a batch are added once
+            _, _, n_added = win_incr.process_increment(
+                state, corpus[:6] + corpus[1:3], 0.2)
+            self.assertEqual(n_added, 6)
+            domains, sim_mat, n_added = win_incr.process_increment(
+                state, win_domains.DomainStore.from_domains(corpus[4:]), 0.2)
+
+            # known domains are skipped
+            self.assertEqual(n_added, n - 6)
+            self.assertListEqual(list(domains), corpus)
+
+            expected,_ = win_proc.process_windows(iter(corpus), n, 0.2, 0,
+                                                  reporter=None)
+            self.assertEqual(abs(sim_mat - expected).max(), 0)
+
+            # the state round trips through disk
+            domains, stored, threshold = win_incr.load_state(state)
+            self.assertListEqual(list(domains), corpus)
+            self.assertEqual(abs(stored - sim_mat).max(), 0)
+            self.assertEqual(threshold, 0.2)
+
+            _, unchanged, n_added = win_incr.process_increment(
+                state, corpus[::2], 0.2)
+            self.assertEqual(n_added, 0)
+            self.assertEqual(abs(unchanged - sim_mat).max(), 0)
+
+            with self.assertRaises(ValueError):
+                win_incr.process_increment(state, [b"foo"], 0.5)
+        finally:
+            os.unlink(state)
+
+    def test_tile_schedule(self):
+        schedule = TileSchedule()
+
+        self.assertListEqual(schedule.add_block(0, 4), [(0, 0)])
+        self.assertListEqual(schedule.add_block(4, 3), [(1, 1), (0, 1)])
+        self.assertListEqual(schedule.add_block(7, 3),
+                             [(2, 2), (0, 2), (1, 2)])
+        self.assertEqual(schedule.n_tiles(), 6)
+
+    def test_process_windows_cross_window(self):
+        domains = list(win_util.fetch_lines(fn))
+
+        expected,_ = win_proc.process_windows(iter(domains), n, 0.2, 0,
+                                              reporter=None)
+        # windows of 3 to 4 domains, pairs straddle their boundaries
+        sim_mat,window_stats = win_proc.process_windows(
+            iter(domains), n, 0.2, 0, reporter=None, win_min=3, win_max=4)
+        self.assertGreater(len(window_stats), 1)
+        self.assertEqual(abs(sim_mat - expected).max(), 0)
+        self.assertEqual(sum(stats.n_pairs for stats in window_stats),
+                         n * (n - 1) // 2)
+
+        # without cross window tiles the matrix is block diagonal
+        sim_mat,_ = win_proc.process_windows(
+            iter(domains), n, 0.2, 0, reporter=None, cross_window=False,
+            win_min=3, win_max=4)
+        self.assertLess(sim_mat.nnz, expected.nnz)
+
+    def test_bk_tree_search(self):
+        domains = list(win_util.fetch_lines(fn))
+        tree = win_index.BKTree(domains)
+
+        self.assertEqual(tree.get_size(), n)
+        for query in [b"google", b"goggle", b"www.thebike"]:
+            expected = sorted((i, edit_distance(query, domain))
+                              for i,domain in enumerate(domains)
+                              if edit_distance(query, domain) <= 4)
+            self.assertListEqual(sorted(tree.search(query, 4)), expected)
+
+    def test_build_forest(self):
+        domains = list(win_util.fetch_lines(fn)) + [b"", b"google", b"x" * 70]
+
+        # the kernel builds the tree inserting one domain at a time does
+        tree = win_index.BKTree()
+        for domain in domains:
+            tree.insert(domain)
+        expected = tree.to_arrays()
+        arrays = win_index.build_forest(domains)
+        for name in win_index.FOREST_ARRAYS:
+            self.assertListEqual(arrays[name].tolist(),
+                                 expected[name].tolist())
+        self.assertListEqual(win_index.BKTree(domains).children,
+                             tree.children)
+
+    def test_metric_index(self):
+        domains = list(win_util.fetch_lines(fn))
+        path = "index"
+
+        index = win_index.MetricIndex(domains[:6])
+        for domain in domains[6:]:
+            self.assertEqual(index.insert(domain), domains.index(domain))
+
+        def check(index):
+            self.assertEqual(index.get_size(), n)
+            for query in [b"google", b"goggle", b"www.thebike", b""]:
+                expected = sorted((edit_distance(query, domain), i)
+                                  for i,domain in enumerate(domains)
+                                  if edit_distance(query, domain) <= 3)
+                self.assertListEqual(index.search(query, 3),
+                                     [(i, d) for d,i in expected])
+
+                expected = sorted((-round(score_pair((query, domain))[1], 3),
+                                   i) for i,domain in enumerate(domains)
+                                  if score_pair((query, domain))[1] > 0.5)
+                self.assertListEqual(index.search_threshold(query, 0.5),
+                                     [(i, -score) for score,i in expected])
+
+        try:
+            check(index)
+            index.save(path)
+
+            # 4 inserts next to a tree of 6 are rebuilt into it
+            loaded = win_index.load_index(path)
+            self.assertEqual(len(loaded.arrays["roots"]), 1)
+            self.assertEqual(loaded.get_domain(7), domains[7])
+            check(loaded)
+
+            # small freezes keep a tree each until they add up
+            index = win_index.MetricIndex(domains[:8])
+            index.insert(domains[8])
+            index.freeze()
+            self.assertEqual(index.arrays["roots"].tolist(), [0, 8])
+            index.insert(domains[9])
+            index.freeze()
+            self.assertEqual(index.arrays["roots"].tolist(), [0, 8])
+            check(index)
+            index.compact()
+            self.assertEqual(index.arrays["roots"].tolist(), [0])
+            check(index)
+
+            self.assertEqual(loaded.insert(b"gooogle"), n)
+            self.assertEqual(loaded.search(b"gooogle", 0), [(n, 0)])
+            loaded.save(path)
+            self.assertEqual(win_index.load_index(path).get_size(), n + 1)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def test_nearest_neighbors(self):
+        domains = list(win_util.fetch_lines(fn))
+        k = 3
+
+        indices,scores = win_proc.nearest_neighbors(domains, k, threshold=0.2)
+        self.assertEqual(indices.shape, (n, k))
+
+        for i,query in enumerate(domains):
+            expected = sorted((-score_pair((query, domain))[1], j)
+                              for j,domain in enumerate(domains) if j != i)
+            expected = [(j, round(-score, 3)) for score,j in expected[:k]
+                        if -score > 0.2]
+            got = [(j, score) for j,score in zip(indices[i].tolist(),
+                                                 scores[i].tolist())
+                   if j >= 0]
+            self.assertListEqual([j for j,_ in got], [j for j,_ in expected])
+            for (_,score),(_,exp_score) in zip(got, expected):
+                self.assertAlmostEqual(score, exp_score, places=3)
+
+        # outside queries may match any corpus domain
+        indices,scores = win_proc.nearest_neighbors(domains, 1,
+                                                    queries=[b"g00gle"])
+        self.assertEqual(indices[0, 0], 0)
+        self.assertAlmostEqual(scores[0, 0], 0.667, places=3)
+
+    def test_bench_compare(self):
+        baseline = {"macro/x": {"pairs_per_sec": 100.0, "peak_rss_kb": 1000,
+                                "n_pairs": 10}}
+        results = {"macro/x": {"pairs_per_sec": 95.0, "peak_rss_kb": 1200,
+                               "n_pairs": 20},
+                   "macro/new": {"pairs_per_sec": 1.0}}
+
+        self.assertListEqual(bench.compare(results, baseline, 0.10),
+                             [("macro/x", "peak_rss_kb", 1000, 1200)])
+        self.assertEqual(len(bench.compare(results, baseline, 0.01)), 2)
+
+    def test_score_identical(self):
+        self.assertEqual(score_pair((b"google", b"google"))[1], 1.0)
+        self.assertEqual(score_pair((b"", b""))[1], 1.0)
+
+    def test_pattern_mask(self):
+        subdomain1 = b"google"
+        mask = PatternMask(subdomain1)
+
+        for subdomain2 in [b"dns.google", b"", b"goggle", b"g" * 100]:
+            self.assertEqual(mask.distance(subdomain2),
+                             edit_distance(subdomain1, subdomain2))
+
+    def test_pattern_mask_multi_word(self):
+        # longer than one 64-bit block
+        subdomain1 = b"onedscolprdude02.usdodeast.cloudapp.usgovcloudapi" * 2
+        subdomain2 = b"onedscolprdude03.usdodeast.cloudapp.usgovcloudapi"
+        mask = PatternMask(subdomain1)
+
+        self.assertEqual(mask.distance(subdomain2),
+                         edit_distance(subdomain1, subdomain2))
+
+    def test_score_pair_backend(self):
+        pair = (b"google", b"dns.google")
+
+        self.assertEqual(score_pair(pair, 0.5, BACKEND_BIT_PARALLEL),
+                         score_pair(pair, 0.5, BACKEND_DP))
+
+    def test_pack_domains(self):
+        packed, lengths = pack_domains([b"ab", b"", b"c"])
+
+        self.assertListEqual(lengths.tolist(), [2, 0, 1])
+        self.assertListEqual(packed.tolist(), [[97, 98], [0, 0], [99, 0]])
+
+    def test_score_block(self):
+        corpus = list(win_util.fetch_lines(fn))
+        packed, lengths = pack_domains(corpus)
+
+        expected = [((corpus.index(a), corpus.index(b)), score)
+                    for (a,b),score in win_proc.uniprocessed_work(
+                        lambda pair,t: score_pair(pair, t),
+                        combinations(corpus, 2), 0.2)]
+
+        for backend in [BACKEND_DP, BACKEND_BIT_PARALLEL]:
+            i,j,scores = score_block(packed, lengths, packed, lengths, 0.2,
+                                     backend, upper=True)
+            self.assertListEqual([((a, b), round(score, 3)) for a,b,score in
+                                  zip(i.tolist(), j.tolist(),
+                                      scores.tolist())], expected)
+
+    def test_score_block_prune(self):
+        corpus = list(win_util.fetch_lines(fn)) \
+                 + [b"nikke", b"\xff\xfegoogle", b"x" * 300, b"y" * 300]
+        packed, lengths = pack_domains(corpus)
+        n_pairs = len(corpus) * (len(corpus) - 1) // 2
+
+        # the filters only skip pairs that could not have been kept
+        for metric in ["levenshtein", "damerau"]:
+            for threshold in [0.0, 0.2, 0.5, 0.8]:
+                expected = score_block(packed, lengths, packed, lengths,
+                                       threshold, upper=True, metric=metric)
+                n_scored = np.zeros(1, dtype=np.int64)
+                actual = score_block(packed, lengths, packed, lengths,
+                                     threshold, upper=True, metric=metric,
+                                     prune=True, n_scored=n_scored)
+                for expected_array,actual_array in zip(expected, actual):
+                    self.assertListEqual(actual_array.tolist(),
+                                         expected_array.tolist())
+                self.assertLessEqual(n_scored[0], n_pairs)
+                if threshold == 0.0:
+                    self.assertEqual(n_scored[0], n_pairs)
+                if threshold == 0.8:
+                    self.assertLess(n_scored[0], n_pairs)
+
+    def test_score_pairs(self):
+        corpus = list(win_util.fetch_lines(fn))
+        packed, lengths = pack_domains(corpus)
+
+        i,j,scores = score_block(packed, lengths, packed, lengths, 0.2,
+                                 upper=True)
+        # only the first two pairs are asked for
+        pair_i,pair_j,pair_scores = score_pairs(packed, lengths, i[:2], j[:2],
+                                                0.2)
+
+        self.assertListEqual(pair_i.tolist(), i[:2].tolist())
+        self.assertListEqual(pair_j.tolist(), j[:2].tolist())
+        self.assertListEqual(pair_scores.tolist(), scores[:2].tolist())
+
+    def test_similarity_metrics(self):
+        # a transposition is a single edit
+        self.assertEqual(damerau_distance(b"paypal", b"paypla"), 1)
+        self.assertEqual(edit_distance(b"paypal", b"paypla"), 2)
+        self.assertEqual(damerau_distance(b"ca", b"abc"), 3)
+        self.assertAlmostEqual(similarity(b"martha", b"marhta",
+                                          "jaro_winkler"), 0.9611, places=4)
+        # bigrams {ab, bc, cd} and {ab, bc, ce}
+        self.assertAlmostEqual(similarity(b"abcd", b"abce", "qgram_jaccard"),
+                               0.5)
+        for metric in METRICS:
+            self.assertEqual(similarity(b"domain", b"domain", metric), 1.0)
+        with self.assertRaises(ValueError):
+            metric_id("soundex")
+
+    def test_score_block_metrics(self):
+        corpus = list(win_util.fetch_lines(fn))
+        packed, lengths = pack_domains(corpus)
+
+        for metric in METRICS:
+            expected = [((corpus.index(a), corpus.index(b)), score)
+                        for (a,b),score in win_proc.uniprocessed_work(
+                            lambda pair,t: score_pair(pair, t, metric=metric),
+                            combinations(corpus, 2), 0.2)]
+
+            i,j,scores = score_block(packed, lengths, packed, lengths, 0.2,
+                                     upper=True, metric=metric)
+            self.assertListEqual([((a, b), round(score, 3)) for a,b,score in
+                                  zip(i.tolist(), j.tolist(),
+                                      scores.tolist())], expected)
+
+            pair_i,pair_j,pair_scores = score_pairs(packed, lengths, i, j,
+                                                    0.2, metric=metric)
+            self.assertListEqual(pair_scores.tolist(), scores.tolist())
+
+    def test_process_windows_metric(self):
+        domains = list(win_util.fetch_lines(fn))
+
+        for metric in ["damerau", "jaro_winkler", "qgram_jaccard"]:
+            sim_mat,_ = win_proc.process_windows(iter(domains), n, 0.2, 0,
+                                                 reporter=None, win_min=3,
+                                                 win_max=4, metric=metric)
+            expected = {(a, b): round(similarity(domains[a], domains[b],
+                                                 metric), 3)
+                        for a,b in combinations(range(n), 2)
+                        if similarity(domains[a], domains[b], metric) > 0.2}
+            coo = sim_mat.tocoo()
+            self.assertDictEqual(
+                {(a, b): round(score, 3) for a,b,score in
+                 zip(coo.row.tolist(), coo.col.tolist(), coo.data.tolist())},
+                expected)
+
+    def test_domain_store(self):
+        domains = list(win_util.fetch_lines(fn))
+        duplicated = domains + domains[2:5] + [b""]
+
+        store = win_domains.DomainStore.from_file(fn)
+        self.assertEqual(len(store), n)
+        self.assertListEqual(list(store), domains)
+        self.assertEqual(store.get_domain(3), domains[3])
+        self.assertEqual(store.starts.dtype, "int32")
+        self.assertListEqual(list(store[2:5]), domains[2:5])
+        self.assertListEqual(store.take([4, 0]).get_domains([0, 1]),
+                             [domains[4], domains[0]])
+        self.assertListEqual(
+            list(win_domains.DomainStore.concatenate((store[7:], store[:2]))),
+            domains[7:] + domains[:2])
+
+        packed, lengths = store[1:6].pack()
+        expected_packed, expected_lengths = pack_domains(domains[1:6])
+        self.assertEqual(packed.tolist(), expected_packed.tolist())
+        self.assertEqual(lengths.tolist(), expected_lengths.tolist())
+
+        store = win_domains.DomainStore.from_domains(duplicated)
+        unique, inverse, counts = store.dedup()
+        index = {}
+        expected = [index.setdefault(domain, len(index))
+                    for domain in duplicated]
+        self.assertListEqual(list(unique), list(index))
+        self.assertListEqual(inverse.tolist(), expected)
+        self.assertListEqual(counts.tolist(),
+                             [expected.count(i) for i in range(len(index))])
+
+    def test_process_windows_domain_store(self):
+        domains = list(win_util.fetch_lines(fn))
+        duplicated = domains + domains[:3]
+        store = win_domains.DomainStore.from_domains(duplicated)
+
+        expected,expected_stats = win_proc.process_windows(
+            iter(duplicated), len(duplicated), 0.2, 31, reporter=None)
+        sim_mat,window_stats = win_proc.process_windows(
+            store, len(store), 0.2, 31, reporter=None)
+        self.assertEqual(abs(sim_mat - expected).max(), 0)
+        self.assertListEqual(window_stats[0].top_k, expected_stats[0].top_k)
+        self.assertEqual(window_stats[0].max, expected_stats[0].max)
+
+        sim_mat,_ = win_proc.process_windows(store, len(store), 0.2, 0,
+                                             reporter=None, win_min=3,
+                                             win_max=4)
+        self.assertEqual(abs(sim_mat - expected).max(), 0)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,226 @@
+"""Clustering of similar domains from the scored pair stream
+
+Every kept pair joins its two domains, so clusters are the connected
+components of the thresholded similarity graph. They are maintained with a
+union-find over domain indices, fed pair by pair as windows are scored, so
+the matrix itself is never needed.
+"""
+
+from dataclasses import dataclass, field
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+@dataclass
+class Cluster:
+    """A group of transitively similar domains
+
+    The id is the index of the cluster's earliest domain, so it does not
+    depend on the order pairs were scored in.
+    """
+    id: int = 0
+    size: int = 0
+    # best connected members first (highest summed score)
+    representatives: list = field(default_factory=list)
+
+class Clusterer:
+    """Incremental union-find over domain indices
+
+    Grows with the largest index it sees, so it can follow a stream of
+    unknown length. Pairs are buffered and merged in bulk.
+    """
+    def __init__(self, n=0):
+        """Non-default constructor
+
+        Keyword Arguments:
+        n -- number of domains known up front
+        """
+        self.parent = np.arange(n, dtype=np.int64)
+        # summed score of every pair a domain takes part in
+        self.strength = np.zeros(n, dtype=np.float64)
+
+    def get_size(self):
+        """Getter"""
+        return len(self.parent)
+
+    def get_state(self):
+        """Union-find arrays, for checkpoints (see `set_state`)"""
+        return {"parent": self.parent.copy(),
+                "strength": self.strength.copy()}
+
+    def set_state(self, state):
+        """Replace the clusters with those of `get_state`
+
+        Positional Arguments:
+        state -- dict returned by `get_state`
+        """
+        self.parent = np.array(state["parent"], dtype=np.int64)
+        self.strength = np.array(state["strength"], dtype=np.float64)
+
+    def grow(self, n):
+        """Make room for domains [0, n) as singletons
+
+        Positional Arguments:
+        n -- number of domains
+        """
+        old = len(self.parent)
+        if n <= old:
+            return
+
+        self.parent = np.concatenate((self.parent,
+                                      np.arange(old, n, dtype=np.int64)))
+        self.strength = np.concatenate((self.strength, np.zeros(n - old)))
+
+    def find_all(self, nodes):
+        """Cluster root of every node, compressing their paths
+
+        Positional Arguments:
+        nodes -- domain indices
+
+        Returns:
+        `int64` array of roots
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        roots = self.parent[nodes]
+        while True:
+            up = self.parent[roots]
+            if np.array_equal(up, roots):
+                break
+            roots = up
+        self.parent[nodes] = roots
+
+        return roots
+
+    def union_arrays(self, rows, cols, scores=None):
+        """Join the domains of every pair
+
+        Positional Arguments:
+        rows    -- first domain of every pair
+        cols    -- second domain of every pair
+
+        Keyword Arguments:
+        scores  -- pair scores, added to both domains' strength
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        if len(rows) == 0:
+            return
+
+        self.grow(int(max(rows.max(), cols.max())) + 1)
+        if scores is not None:
+            scores = np.asarray(scores, dtype=np.float64)
+            np.add.at(self.strength, rows, scores)
+            np.add.at(self.strength, cols, scores)
+
+        a = self.find_all(rows)
+        b = self.find_all(cols)
+        joined = a != b
+        if not joined.any():
+            return
+
+        # merge the touched roots as one small graph, each component is
+        # rooted at its lowest index
+        roots, local = np.unique(np.concatenate((a[joined], b[joined])),
+                                 return_inverse=True)
+        half = joined.sum()
+        graph = coo_matrix((np.ones(half), (local[:half], local[half:])),
+                           shape=(len(roots), len(roots)))
+        _,labels = connected_components(graph, directed=False)
+
+        lowest = np.full(labels.max() + 1, np.iinfo(np.int64).max)
+        np.minimum.at(lowest, labels, roots)
+        self.parent[roots] = lowest[labels]
+
+    def observe_blocks(self, blocks):
+        """Pass an (i, j, score) block stream through, joining its pairs
+        once it is exhausted
+
+        Positional Arguments:
+        blocks -- (i, j, score) arrays with global domain indices
+
+        Returns:
+        Generator of the same blocks
+        """
+        parts = []
+        for block in blocks:
+            parts.append(block)
+            yield block
+
+        if parts:
+            self.union_arrays(*(np.concatenate(arrays)
+                                for arrays in zip(*parts)))
+
+    def observe(self, pair_scores):
+        """Pass a ((i, j), score) stream through, joining its pairs once it
+        is exhausted
+
+        Positional Arguments:
+        pair_scores -- ((i, j), score) with global domain indices
+
+        Returns:
+        Generator of the same items
+        """
+        rows = []
+        cols = []
+        scores = []
+        for pair_score in pair_scores:
+            (i,j),score = pair_score
+            rows.append(i)
+            cols.append(j)
+            scores.append(score)
+            yield pair_score
+
+        self.union_arrays(rows, cols, scores)
+
+    def expand(self, inverse):
+        """Map clusters over unique domains onto every original domain
+
+        Positional Arguments:
+        inverse -- representative index of every original domain (see
+                   `win_domains.DomainStore.dedup`)
+        """
+        inverse = np.asarray(inverse, dtype=np.int64)
+        self.grow(int(inverse.max()) + 1 if len(inverse) else 0)
+        roots = self.find_all(np.arange(len(self.parent)))
+
+        # earliest original occurrence of every unique domain
+        first = np.empty(len(self.parent), dtype=np.int64)
+        first[inverse[::-1]] = np.arange(len(inverse) - 1, -1, -1)
+
+        self.parent = first[roots[inverse]]
+        self.strength = self.strength[inverse]
+
+    def labels(self):
+        """Cluster id of every domain, singletons are their own cluster"""
+        return self.find_all(np.arange(len(self.parent)))
+
+    def clusters(self, min_size: int = 2, n_representatives: int = 3):
+        """Summarize the clusters found so far
+
+        Keyword Arguments:
+        min_size            -- smallest cluster to report
+        n_representatives   -- members listed per cluster
+
+        Returns:
+        list of `Cluster`, largest first, ties by id
+        """
+        labels = self.labels()
+        sizes = np.bincount(labels, minlength=len(labels))
+        ids = np.flatnonzero(sizes >= max(1, min_size))
+        if len(ids) == 0:
+            return []
+
+        # members grouped by cluster, strongest first within each
+        members = np.flatnonzero(sizes[labels] >= max(1, min_size))
+        order = np.lexsort((members, -self.strength[members],
+                            labels[members]))
+        members = members[order]
+        starts = np.searchsorted(labels[members], ids)
+
+        result = [Cluster(int(cluster), int(sizes[cluster]),
+                          members[start:start + n_representatives].tolist())
+                  for cluster,start in zip(ids.tolist(), starts.tolist())]
+        result.sort(key=lambda cluster: (-cluster.size, cluster.id))
+
+        return result
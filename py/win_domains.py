@@ -0,0 +1,306 @@
+"""Compact store of subdomains addressed by integer id
+
+Every subdomain lives in one contiguous `uint8` buffer and is located by an
+`int32` start and length (starts widen to `int64` once the buffer outgrows
+`int32`), so a corpus costs its raw bytes plus 8 bytes per domain instead of
+a Python `bytes` object each. Windows, pairs, statistics and matrix indices
+refer to domains by id, bytes are only rebuilt for reporting (see
+`DomainStore.get_domain`).
+"""
+
+from itertools import islice
+
+import numpy as np
+
+from win_util import load_domains
+
+INT32_MAX = np.iinfo(np.int32).max
+
+# multiplier of the polynomial hash `DomainStore.dedup` groups domains by
+HASH_BASE = np.uint64(0x100000001B3)
+
+class DomainStore:
+    """Subdomains packed into one buffer, subdomain i is
+    buffer[starts[i]:starts[i] + lengths[i]]
+
+    Slicing a store returns a view sharing its buffer, `take` copies the
+    chosen domains into a new compact one.
+    """
+    def __init__(self, buffer, starts, lengths):
+        """Non-default constructor, see `from_offsets` to build one from a
+        `win_util.load_domains` result
+
+        Positional Arguments:
+        buffer  -- `uint8` array of concatenated subdomains
+        starts  -- `int32` (or `int64`) start of every subdomain in `buffer`
+        lengths -- `int32` length of every subdomain
+        """
+        self.buffer = buffer
+        self.starts = starts
+        self.lengths = lengths
+
+    @classmethod
+    def from_offsets(cls, buffer, offsets):
+        """Build a store over a buffer where subdomain i is
+        buffer[offsets[i]:offsets[i + 1]]
+
+        Positional Arguments:
+        buffer  -- concatenated subdomains
+        offsets -- subdomain offsets into `buffer`, of length n + 1
+        """
+        buffer = np.ascontiguousarray(buffer, dtype=np.uint8)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        dtype = np.int32 if len(buffer) <= INT32_MAX else np.int64
+
+        return cls(buffer, offsets[:-1].astype(dtype),
+                   np.diff(offsets).astype(np.int32))
+
+    @classmethod
+    def from_file(cls, file_path: str, public_suffixes=None):
+        """Bulk load a domain file (see `win_util.load_domains`)
+
+        Positional Arguments:
+        file_path       -- path to file to be read
+
+        Keyword Arguments:
+        public_suffixes -- set of public suffixes stripped as a whole
+        """
+        return cls.from_offsets(*load_domains(file_path, public_suffixes))
+
+    @classmethod
+    def from_domains(cls, domains):
+        """Build a store from byte strings
+
+        Positional Arguments:
+        domains -- iterable of subdomains (bytes)
+        """
+        domains = list(domains)
+        lengths = np.fromiter((len(domain) for domain in domains),
+                              dtype=np.int64, count=len(domains))
+
+        return cls.from_offsets(np.frombuffer(b"".join(domains),
+                                              dtype=np.uint8),
+                                np.concatenate(([0], np.cumsum(lengths))))
+
+    @classmethod
+    def concatenate(cls, stores):
+        """Copy stores one after the other into a new compact store
+
+        Positional Arguments:
+        stores  -- `DomainStore`s, the domains of each follow the previous
+        """
+        buffers = []
+        offsets = [np.zeros(1, dtype=np.int64)]
+        size = 0
+        for store in stores:
+            buffer, store_offsets = store.to_offsets()
+            buffers.append(buffer)
+            offsets.append(store_offsets[1:] + size)
+            size += len(buffer)
+
+        return cls.from_offsets(np.concatenate(buffers) if buffers
+                                else np.empty(0, dtype=np.uint8),
+                                np.concatenate(offsets))
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, key):
+        """Subdomain `key` as bytes, or a view of the slice `key`"""
+        if isinstance(key, slice):
+            return DomainStore(self.buffer, self.starts[key],
+                               self.lengths[key])
+        return self.get_domain(key)
+
+    def __iter__(self):
+        """Yield every subdomain as bytes"""
+        raw = memoryview(self.buffer)
+        for start,length in zip(self.starts.tolist(), self.lengths.tolist()):
+            yield bytes(raw[start:start + length])
+
+    def get_domain(self, index: int):
+        """Getter
+
+        Positional Arguments:
+        index -- domain id
+        """
+        start = int(self.starts[index])
+        return self.buffer[start:start + int(self.lengths[index])].tobytes()
+
+    def get_domains(self, ids):
+        """Subdomains of `ids` as a list of bytes, for reporting
+
+        Positional Arguments:
+        ids -- domain ids
+        """
+        return [self.get_domain(i) for i in np.asarray(ids).tolist()]
+
+    def get_nbytes(self):
+        """Bytes held by the buffer and the index arrays"""
+        return self.buffer.nbytes + self.starts.nbytes + self.lengths.nbytes
+
+    def _gather(self, ids):
+        """Buffer positions of the concatenated subdomains `ids`, and their
+        `int64` offsets into that concatenation"""
+        lengths = self.lengths[ids].astype(np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        index = np.arange(offsets[-1], dtype=np.int64) \
+                + np.repeat(self.starts[ids].astype(np.int64) - offsets[:-1],
+                            lengths)
+
+        return index, offsets
+
+    def take(self, ids):
+        """Copy the subdomains `ids` into a new compact store
+
+        Positional Arguments:
+        ids -- domain ids, the new store numbers them in this order
+        """
+        index, offsets = self._gather(np.asarray(ids, dtype=np.int64))
+        return DomainStore.from_offsets(self.buffer[index], offsets)
+
+    def to_offsets(self):
+        """(`uint8` buffer, `int64` offsets) of the store in the layout of
+        `win_util.load_domains`"""
+        index, offsets = self._gather(np.arange(len(self)))
+        return self.buffer[index], offsets
+
+    def pack(self):
+        """Pack the store into the fixed-width layout of
+        `edit_distance.score_block`, like `edit_distance.pack_domains`
+        without building a `bytes` object per domain
+
+        Returns:
+        (`uint8` array of shape (len(self), max length) with every domain
+        left-aligned and zero padded, `int32` array of lengths)
+        """
+        lengths = np.ascontiguousarray(self.lengths, dtype=np.int32)
+        width = max(1, int(lengths.max())) if len(lengths) else 1
+        packed = np.zeros((len(lengths), width), dtype=np.uint8)
+
+        index, offsets = self._gather(np.arange(len(self)))
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        cols = np.arange(len(index)) - np.repeat(offsets[:-1], lengths)
+        packed[rows, cols] = self.buffer[index]
+
+        return packed, lengths
+
+    def qgram_codes(self, q: int = 2):
+        """Character q-grams of every domain as integers
+
+        Domains shorter than `q` are a single (zero padded) gram.
+
+        Keyword Arguments:
+        q       -- q-gram length, at most 8
+
+        Returns:
+        (`uint64` gram codes, `int64` start of every domain's grams, of
+        length len(self) + 1)
+        """
+        if not 1 <= q <= 8:
+            raise ValueError(f"q must be in [1, 8], not {q}")
+
+        flat, offsets = self.to_offsets()
+        buffer = np.concatenate((flat, np.zeros(q, dtype=np.uint8)))
+        lengths = np.diff(offsets)
+        starts = offsets[:-1]
+        ends = offsets[1:]
+
+        counts = np.maximum(lengths - q + 1, 1)
+        gram_starts = np.concatenate(([0], np.cumsum(counts)))
+        owner = np.repeat(np.arange(len(lengths)), counts)
+        positions = np.repeat(starts, counts) \
+                    + np.arange(gram_starts[-1]) - np.repeat(gram_starts[:-1],
+                                                             counts)
+
+        codes = np.zeros(len(positions), dtype=np.uint64)
+        for t in range(q):
+            index = positions + t
+            byte = np.where(index < ends[owner], buffer[index], 0)
+            codes = (codes << np.uint64(8)) | byte.astype(np.uint64)
+
+        return codes, gram_starts
+
+    def hashes(self, block_size: int = 1 << 16):
+        """64 bit polynomial hash of every domain's bytes
+
+        Keyword Arguments:
+        block_size  -- domains hashed at a time, bounds the temporary arrays
+        """
+        max_len = int(self.lengths.max()) if len(self) else 0
+        # wrapping products, the hash is taken mod 2^64
+        powers = np.cumprod(np.full(max_len + 1, HASH_BASE, dtype=np.uint64))
+
+        hashes = np.empty(len(self), dtype=np.uint64)
+        for start in range(0, len(self), block_size):
+            block = self[start:start + block_size]
+            flat, offsets = block.to_offsets()
+            position = np.arange(len(flat)) \
+                       - np.repeat(offsets[:-1], np.diff(offsets))
+            sums = np.concatenate((np.zeros(1, dtype=np.uint64),
+                                   np.cumsum(flat.astype(np.uint64)
+                                             * powers[position],
+                                             dtype=np.uint64)))
+            hashes[start:start + len(block)] = sums[offsets[1:]] \
+                                               - sums[offsets[:-1]]
+
+        return hashes
+
+    def dedup(self):
+        """Intern identical subdomains so each is scored once
+
+        Domains are grouped by length and `hashes`, then every duplicate is
+        compared against its group's first domain, a hash collision falls
+        back to grouping the bytes themselves.
+
+        Returns:
+        (`DomainStore` of the unique subdomains in order of first appearance,
+        `int64` array with the index into it of every subdomain, `int64`
+        array of each unique subdomain's multiplicity)
+        """
+        n = len(self)
+        hashes = self.hashes()
+        order = np.lexsort((hashes, self.lengths))
+        keys = (self.lengths[order], hashes[order])
+        new_group = np.ones(n, dtype=bool)
+        new_group[1:] = (keys[0][1:] != keys[0][:-1]) \
+                        | (keys[1][1:] != keys[1][:-1])
+
+        # lexsort is stable, so a group starts at its smallest id
+        firsts = order[new_group]
+        rank = np.empty(len(firsts), dtype=np.int64)
+        rank[np.argsort(firsts)] = np.arange(len(firsts))
+        inverse = np.empty(n, dtype=np.int64)
+        inverse[order] = rank[np.cumsum(new_group) - 1]
+        unique_ids = np.sort(firsts)
+
+        duplicates = np.flatnonzero(unique_ids[inverse] != np.arange(n))
+        a, _ = self._gather(duplicates)
+        b, _ = self._gather(unique_ids[inverse[duplicates]])
+        if not np.array_equal(self.buffer[a], self.buffer[b]):
+            index = {}
+            inverse = np.fromiter((index.setdefault(domain, len(index))
+                                   for domain in self), dtype=np.int64,
+                                  count=n)
+            _, unique_ids = np.unique(inverse, return_index=True)
+
+        return self.take(unique_ids), inverse, \
+               np.bincount(inverse, minlength=len(unique_ids))
+
+def as_store(domains, n: int = None):
+    """View any input of subdomains as a `DomainStore`
+
+    Positional Arguments:
+    domains -- `DomainStore` or iterable of subdomains (bytes)
+
+    Keyword Arguments:
+    n       -- only keep the first `n`, None keeps all
+
+    Returns:
+    `DomainStore`, `domains` itself (or a view of it) if it already is one
+    """
+    if isinstance(domains, DomainStore):
+        return domains if n is None else domains[:n]
+    if n is not None:
+        domains = islice(domains, n)
+    return DomainStore.from_domains(domains)
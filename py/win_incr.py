@@ -0,0 +1,181 @@
+"""Incremental (append-only) similarity processing
+
+The processed domains and their sparse similarity matrix are persisted to a
+single `.npz` file. When new domains arrive, only new x existing and new x new
+pairs are scored and merged into the stored matrix, so a batch costs
+O(new * total) instead of O(total^2).
+"""
+
+from multiprocessing import Pool
+import os
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+import edit_distance
+from win_domains import DomainStore, as_store
+from win_matrix import MatrixBuilder
+
+def save_state(path: str, domains, sim_mat, threshold: float):
+    """Atomically persist processed domains and their similarity matrix
+
+    Positional Arguments:
+    path        -- destination `.npz` file
+    domains     -- processed subdomains in matrix order, a
+                   `win_domains.DomainStore` or a sequence of bytes
+    sim_mat     -- `scipy.sparse` similarity matrix over `domains`
+    threshold   -- minimum score the matrix was built with
+    """
+    sim_mat = csr_matrix(sim_mat)
+    buffer, offsets = as_store(domains).to_offsets()
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as outfile:
+        np.savez(outfile, buffer=buffer, offsets=offsets,
+                 data=sim_mat.data, indices=sim_mat.indices,
+                 indptr=sim_mat.indptr, shape=np.array(sim_mat.shape),
+                 threshold=np.array(threshold))
+    os.replace(tmp_path, path)
+
+def load_state(path: str):
+    """Load state written by `save_state`
+
+    Positional Arguments:
+    path -- `.npz` file to read
+
+    Returns:
+    (`win_domains.DomainStore` of subdomains, `scipy.sparse.csr_matrix`,
+    threshold) or (empty store, empty matrix, None) if `path` does not exist
+    """
+    if not os.path.exists(path):
+        return DomainStore.from_domains([]), \
+               csr_matrix((0, 0), dtype=np.float32), None
+
+    with np.load(path) as state:
+        domains = DomainStore.from_offsets(state["buffer"], state["offsets"])
+        sim_mat = csr_matrix((state["data"], state["indices"],
+                              state["indptr"]),
+                             shape=tuple(state["shape"]))
+        threshold = float(state["threshold"])
+
+    return domains, sim_mat, threshold
+
+# packed domains of the running increment, shipped once per worker process
+_tile_arrays = None
+
+def init_tile_arrays(new_packed, new_lengths, old_packed, old_lengths):
+    """Pool initializer making the packed domains available to `score_tile`
+
+    Positional Arguments:
+    new_packed  -- packed new domains (see `edit_distance.pack_domains`)
+    new_lengths -- lengths of the new domains
+    old_packed  -- packed existing domains
+    old_lengths -- lengths of the existing domains
+    """
+    global _tile_arrays
+    _tile_arrays = (new_packed, new_lengths, old_packed, old_lengths)
+
+def score_tile(task):
+    """Score a tile of new domains against the existing ones and against the
+    new domains after them
+
+    Positional Arguments:
+    task -- (start, rows, threshold, backend), the tile covers new domains
+            [start, start + rows)
+
+    Returns:
+    (i, j, score) arrays in merged matrix indices, i < j
+    """
+    start, rows, threshold, backend = task
+    new_packed, new_lengths, old_packed, old_lengths = _tile_arrays
+    n_old = len(old_lengths)
+    tile = slice(start, start + rows)
+
+    # new x existing, the existing domain is the row
+    new_i, old_j, old_scores = edit_distance.score_block(
+        new_packed[tile], new_lengths[tile], old_packed, old_lengths,
+        threshold, backend)
+
+    # new x new, upper triangle of the tile's rows
+    tail = slice(start, None)
+    new_i2, new_j, new_scores = edit_distance.score_block(
+        new_packed[tile], new_lengths[tile], new_packed[tail],
+        new_lengths[tail], threshold, backend, upper=True)
+
+    return (np.concatenate((old_j, new_i2 + start + n_old)),
+            np.concatenate((new_i + start + n_old, new_j + start + n_old)),
+            np.concatenate((old_scores, new_scores)))
+
+def process_increment(path: str, new_domains, threshold: float,
+                      workers: int = 1, chunk_size: int = 65536,
+                      backend: int = edit_distance.BACKEND_BIT_PARALLEL):
+    """Merge a batch of new domains into the persisted state at `path`
+
+    Domains that were already processed (or repeat within the batch) are
+    skipped, with the same `win_domains.DomainStore.dedup` a batch run
+    interns duplicates with. New domains are appended after the existing
+    ones, so existing matrix indices never change.
+
+    Positional Arguments:
+    path        -- state file, created if it does not exist
+    new_domains -- new subdomains, a `win_domains.DomainStore` or an
+                   iterable of bytes
+    threshold   -- minimum score to keep, must match the stored state
+
+    Keyword Arguments:
+    workers     -- number of scoring processes, 1 scores in the calling process
+    chunk_size  -- approximate number of pairs per scoring task
+    backend     -- `edit_distance` backend used to score pairs
+
+    Returns:
+    (`win_domains.DomainStore` of all subdomains, `scipy.sparse.csr_matrix`,
+    number of domains added)
+    """
+    domains, sim_mat, stored_threshold = load_state(path)
+    if stored_threshold is not None and stored_threshold != threshold:
+        raise ValueError(f"state at {path} was built with threshold "
+                         f"{stored_threshold}, not {threshold}")
+
+    # the stored domains are unique, so the unique domains in order of first
+    # appearance are the stored ones followed by the added ones
+    n_old = len(domains)
+    domains, _, _ = DomainStore.concatenate((domains,
+                                             as_store(new_domains))).dedup()
+    added = domains[n_old:]
+    n_total = len(domains)
+
+    builder = MatrixBuilder(n_total, capacity=sim_mat.nnz + len(added))
+    old = sim_mat.tocoo()
+    builder.extend(old.row, old.col, old.data)
+
+    if len(added):
+        tile_arrays = added.pack() + domains[:n_old].pack()
+
+        # every new domain meets n_total - 1 others at most
+        rows_per_tile = max(1, chunk_size // max(1, n_total))
+        tasks = ((start, min(rows_per_tile, len(added) - start), threshold,
+                  backend)
+                 for start in range(0, len(added), rows_per_tile))
+
+        if workers > 1:
+            pool = Pool(workers, initializer=init_tile_arrays,
+                        initargs=tile_arrays)
+            tiles = pool.imap(score_tile, tasks)
+        else:
+            pool = None
+            init_tile_arrays(*tile_arrays)
+            tiles = map(score_tile, tasks)
+
+        try:
+            for i,j,scores in tiles:
+                builder.extend(i, j, np.round(scores.astype(np.float64), 3))
+        finally:
+            if pool is not None:
+                # like `with Pool`, every tile is consumed or of no use
+                pool.terminate()
+                pool.join()
+
+    sim_mat = builder.to_csr()
+    save_state(path, domains, sim_mat, threshold)
+
+    return domains, sim_mat, len(added)
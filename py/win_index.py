@@ -0,0 +1,519 @@
+"""Metric index over subdomains for nearest neighbor and online lookups
+
+A BK-tree keyed on Levenshtein distance: every child hangs off its parent by
+their distance, so by the triangle inequality a query only has to descend
+into children whose edge lies within its search radius of the distance to
+the parent.
+"""
+
+import heapq
+import os
+import shutil
+
+import numpy as np
+
+from edit_distance import PatternMask, bk_build, bk_search
+from win_domains import DomainStore, as_store
+
+# arrays of a flattened BK-tree forest, see `BKTree.to_arrays`
+FOREST_ARRAYS = ("buffer", "offsets", "child_ptr", "child_edge", "child_node",
+                 "max_edge", "roots")
+
+# `MetricIndex.freeze` rebuilds the newest trees into one while a tree holds
+# at most this many times the domains of all the trees after it
+MERGE_RATIO = 2
+
+def knn_radius(query_len: int, min_score: float):
+    """Largest distance at which a domain can still reach `min_score`
+
+    With `d <= (1 - s) * max(m, L)` and `L <= m + d`, any domain scoring at
+    least `s` against a query of length `m` lies within `(1 - s) * m / s`.
+
+    Positional Arguments:
+    query_len   -- length of the query
+    min_score   -- lowest score still of interest
+
+    Returns:
+    search radius, None when it is unbounded
+    """
+    if min_score <= 0.0:
+        return None
+
+    # the slack keeps float error from cutting the radius below the boundary
+    return int((1.0 - min_score) * query_len / min_score + 1e-6)
+
+def pair_score(distance: int, max_len: int):
+    """Score of a pair, as the `edit_distance` kernels compute it (float32)"""
+    if distance == 0:
+        return 1.0
+
+    return float(np.float32(1 - distance / max_len))
+
+def build_forest(domains):
+    """Build a BK-tree over `domains` with `edit_distance.bk_build`, the
+    same tree `BKTree` inserts one domain at a time
+
+    Positional Arguments:
+    domains -- `win_domains.DomainStore` or sequence of subdomains (bytes),
+               inserted in order
+
+    Returns:
+    dict of `FOREST_ARRAYS`, a forest of this single tree
+    """
+    buffer, offsets = as_store(domains).to_offsets()
+    child_ptr, child_edge, child_node, max_edge = bk_build(buffer, offsets)
+
+    return {
+        "buffer": buffer,
+        "offsets": offsets,
+        "child_ptr": child_ptr,
+        "child_edge": child_edge,
+        "child_node": child_node,
+        "max_edge": max_edge,
+        "roots": np.arange(min(1, len(offsets) - 1), dtype=np.int64),
+    }
+
+class BKTree:
+    """BK-tree over subdomains
+
+    Domains are identified by their insertion order, node i holds the i-th
+    inserted domain. The initial domains are inserted by the kernel (see
+    `build_forest`), later ones one at a time in Python.
+    """
+    def __init__(self, domains=()):
+        """Non-default constructor
+
+        Keyword Arguments:
+        domains -- initial subdomains (bytes), inserted in order
+        """
+        self.domains = list(domains)
+        # per node: {edge distance: child node}
+        self.children = []
+        # per node: largest edge below it, bounds how far a subtree reaches
+        self.max_edge = []
+
+        if self.domains:
+            arrays = build_forest(self.domains)
+            bounds = arrays["child_ptr"].tolist()
+            edges = arrays["child_edge"].tolist()
+            nodes = arrays["child_node"].tolist()
+            self.children = [dict(zip(edges[start:stop], nodes[start:stop]))
+                             for start,stop in zip(bounds[:-1], bounds[1:])]
+            self.max_edge = arrays["max_edge"].tolist()
+
+    def get_size(self):
+        """Getter"""
+        return len(self.domains)
+
+    def insert(self, domain: bytes):
+        """Add a subdomain
+
+        Positional Arguments:
+        domain -- subdomain to add
+
+        Returns:
+        node index of the domain
+        """
+        index = len(self.domains)
+        self.domains.append(domain)
+        self.children.append({})
+        self.max_edge.append(0)
+
+        if index == 0:
+            return index
+
+        mask = PatternMask(domain)
+        node = 0
+        while True:
+            distance = mask.distance(self.domains[node])
+            child = self.children[node].get(distance)
+            if child is None:
+                self.children[node][distance] = index
+                self.max_edge[node] = max(self.max_edge[node], distance)
+                return index
+            node = child
+
+    def to_arrays(self):
+        """Flatten the tree into the arrays walked by `edit_distance.bk_search`
+
+        Returns:
+        dict of `FOREST_ARRAYS`, a forest of this single tree
+        """
+        lengths = np.fromiter((len(domain) for domain in self.domains),
+                              dtype=np.int64, count=len(self.domains))
+        n_children = np.fromiter((len(children) for children in self.children),
+                                 dtype=np.int64, count=len(self.children))
+        edges = [sorted(children.items()) for children in self.children]
+
+        return {
+            "buffer": np.frombuffer(b"".join(self.domains), dtype=np.uint8),
+            "offsets": np.concatenate(([0], np.cumsum(lengths))),
+            "child_ptr": np.concatenate(([0], np.cumsum(n_children))),
+            "child_edge": np.fromiter((edge for children in edges
+                                       for edge,_ in children),
+                                      dtype=np.int32),
+            "child_node": np.fromiter((child for children in edges
+                                       for _,child in children),
+                                      dtype=np.int64),
+            "max_edge": np.asarray(self.max_edge, dtype=np.int32),
+            "roots": np.arange(min(1, len(self.domains)), dtype=np.int64),
+        }
+
+    def _distance(self, mask, node, radius):
+        """Distance from the query to `node` if its subtree can still hold a
+        match within `radius`, otherwise None
+
+        The length difference is a lower bound of the distance, so far away
+        nodes are dropped before running the kernel at all.
+        """
+        if radius is None:
+            return mask.distance(self.domains[node])
+
+        bound = radius + self.max_edge[node]
+        if abs(len(self.domains[node]) - mask.length) > bound:
+            return None
+
+        distance = mask.distance_bounded(self.domains[node], bound)
+        return None if distance > bound else distance
+
+    def search(self, query: bytes, radius: int):
+        """Find every subdomain within `radius` of `query`
+
+        Positional Arguments:
+        query   -- subdomain to look up
+        radius  -- largest distance to report
+
+        Returns:
+        list of (node index, distance), in no particular order
+        """
+        if not self.domains:
+            return []
+
+        mask = PatternMask(query)
+        found = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            distance = self._distance(mask, node, radius)
+            if distance is None:
+                continue
+            if distance <= radius:
+                found.append((node, distance))
+
+            for edge,child in self.children[node].items():
+                if abs(edge - distance) <= radius:
+                    stack.append(child)
+
+        return found
+
+    def nearest(self, query: bytes, k: int, threshold: float = 0.0,
+                exclude: int = None):
+        """Find the `k` most similar subdomains to `query`
+
+        The search radius starts from `threshold` and shrinks to the k-th
+        best score as the bounded heap of results fills up.
+
+        Positional Arguments:
+        query       -- subdomain to look up
+        k           -- number of neighbors
+
+        Keyword Arguments:
+        threshold   -- minimum score to keep
+        exclude     -- node index to skip, e.g. the query's own
+
+        Returns:
+        list of (node index, score), best first, ties by lowest index
+        """
+        if not self.domains or k <= 0:
+            return []
+
+        mask = PatternMask(query)
+        query_len = len(query)
+        # min-heap of (score, -index), the root is the worst kept neighbor
+        heap = []
+        # nodes by the lower bound of their distance, so close domains are
+        # met early and the radius shrinks before most of the tree is seen
+        frontier = [(0, 0)]
+        while frontier:
+            lower,node = heapq.heappop(frontier)
+            radius = knn_radius(query_len,
+                                heap[0][0] if len(heap) == k else threshold)
+            if radius is not None and lower > radius:
+                break
+            distance = self._distance(mask, node, radius)
+            if distance is None:
+                continue
+
+            if node != exclude:
+                score = pair_score(distance,
+                                   max(query_len, len(self.domains[node])))
+                if score > threshold:
+                    item = (score, -node)
+                    if len(heap) < k:
+                        heapq.heappush(heap, item)
+                    elif item > heap[0]:
+                        heapq.heapreplace(heap, item)
+                    radius = knn_radius(query_len, heap[0][0]
+                                        if len(heap) == k else threshold)
+
+            for edge,child in self.children[node].items():
+                lower = abs(edge - distance)
+                if radius is None or lower <= radius:
+                    heapq.heappush(frontier, (lower, child))
+
+        return [(-node, round(score, 3))
+                for score,node in sorted(heap, reverse=True)]
+
+def merge_forests(first, second):
+    """Concatenate two flattened forests, nodes of `second` are renumbered to
+    follow those of `first`
+
+    Positional Arguments:
+    first   -- dict of `FOREST_ARRAYS`
+    second  -- dict of `FOREST_ARRAYS`
+
+    Returns:
+    dict of `FOREST_ARRAYS`
+    """
+    n_first = len(first["offsets"]) - 1
+
+    return {
+        "buffer": np.concatenate((first["buffer"], second["buffer"])),
+        "offsets": np.concatenate((first["offsets"], second["offsets"][1:]
+                                   + first["offsets"][-1])),
+        "child_ptr": np.concatenate((first["child_ptr"],
+                                     second["child_ptr"][1:]
+                                     + first["child_ptr"][-1])),
+        "child_edge": np.concatenate((first["child_edge"],
+                                      second["child_edge"])),
+        "child_node": np.concatenate((first["child_node"],
+                                      second["child_node"] + n_first)),
+        "max_edge": np.concatenate((first["max_edge"], second["max_edge"])),
+        "roots": np.concatenate((first["roots"], second["roots"] + n_first)),
+    }
+
+def truncate_forest(forest, n: int):
+    """The trees of a flattened forest holding its first `n` domains, `n`
+    must be where a tree starts
+
+    Positional Arguments:
+    forest  -- dict of `FOREST_ARRAYS`
+    n       -- number of domains to keep
+
+    Returns:
+    dict of `FOREST_ARRAYS`
+    """
+    n_edges = int(forest["child_ptr"][n])
+    roots = np.asarray(forest["roots"])
+
+    return {
+        "buffer": forest["buffer"][:int(forest["offsets"][n])],
+        "offsets": forest["offsets"][:n + 1],
+        "child_ptr": forest["child_ptr"][:n + 1],
+        "child_edge": forest["child_edge"][:n_edges],
+        "child_node": forest["child_node"][:n_edges],
+        "max_edge": forest["max_edge"][:n],
+        "roots": roots[roots < n],
+    }
+
+class MetricIndex:
+    """Persistent BK-tree forest for online similarity lookups
+
+    Built trees are frozen into flat arrays that `edit_distance.bk_search`
+    walks without the GIL, and that can be saved and memory-mapped back.
+    Inserts go to an in-memory `BKTree` searched alongside the frozen trees,
+    which joins the forest as one more tree on the next `freeze` or `save`.
+    Every query walks every tree, so `freeze` rebuilds the newest trees into
+    one as they grow (see `MERGE_RATIO`), which keeps the forest at a
+    logarithmic number of trees, and `compact` rebuilds a single tree.
+    Domains are identified by their insertion order.
+
+    Open: measured on synthetic domains (`bench.synthetic_corpus`, one core)
+    and a single tree, the sub-millisecond target at 1M domains is only met
+    by radius 1 queries:
+
+        domains     build   radius 1    radius 2    score > 0.9  score > 0.8
+        200k        0.8s    0.27ms      1.6ms       0.76ms       6.3ms
+        1M          13s     0.91ms      7.4ms       3.3ms        35ms
+
+    (median query times, p95 is about twice the median)
+    """
+    def __init__(self, domains=(), arrays=None):
+        """Non-default constructor
+
+        Keyword Arguments:
+        domains -- subdomains to build the index over, a
+                   `win_domains.DomainStore` or a sequence of bytes
+        arrays  -- dict of `FOREST_ARRAYS` of an existing index, e.g. from
+                   `load_index`, used instead of `domains`
+        """
+        self.arrays = arrays if arrays is not None \
+                      else build_forest(domains)
+        self.pending = BKTree()
+
+    def get_size(self):
+        """Getter"""
+        return self.n_frozen() + self.pending.get_size()
+
+    def n_frozen(self):
+        """Number of domains in the frozen trees"""
+        return len(self.arrays["offsets"]) - 1
+
+    def get_domain(self, index: int):
+        """Getter
+
+        Positional Arguments:
+        index -- domain index
+        """
+        n_frozen = self.n_frozen()
+        if index >= n_frozen:
+            return self.pending.domains[index - n_frozen]
+
+        offsets = self.arrays["offsets"]
+        return self.arrays["buffer"][offsets[index]:offsets[index + 1]] \
+                   .tobytes()
+
+    def insert(self, domain: bytes):
+        """Add a subdomain without rebuilding the index
+
+        Positional Arguments:
+        domain -- subdomain to add
+
+        Returns:
+        index of the domain
+        """
+        return self.n_frozen() + self.pending.insert(domain)
+
+    def freeze(self):
+        """Move the inserted domains into the frozen forest as a new tree,
+        then rebuild the newest trees into one while a tree holds at most
+        `MERGE_RATIO` times the domains of the trees after it"""
+        if self.pending.get_size() == 0:
+            return
+
+        self.arrays = merge_forests(self.arrays, self.pending.to_arrays())
+        self.pending = BKTree()
+
+        starts = np.asarray(self.arrays["roots"]).tolist()
+        sizes = np.diff(starts + [self.n_frozen()]).tolist()
+        first = len(starts) - 1
+        newer = sizes[first]
+        while first > 0 and sizes[first - 1] <= MERGE_RATIO * newer:
+            first -= 1
+            newer += sizes[first]
+        if first < len(starts) - 1:
+            self._rebuild(starts[first])
+
+    def compact(self):
+        """Freeze the inserted domains and rebuild the whole forest as one
+        tree, the fastest to query"""
+        self.freeze()
+        if len(self.arrays["roots"]) > 1:
+            self._rebuild(0)
+
+    def _rebuild(self, start: int):
+        """Rebuild the trees holding domains [start, n_frozen) as one"""
+        offsets = np.asarray(self.arrays["offsets"][start:], dtype=np.int64)
+        tail = build_forest(DomainStore.from_offsets(
+            self.arrays["buffer"][offsets[0]:offsets[-1]],
+            offsets - offsets[0]))
+
+        self.arrays = merge_forests(truncate_forest(self.arrays, start), tail)
+
+    def _search(self, query, radius, threshold):
+        """(index, distance, score) of every domain within `radius` of `query`
+        scoring above `threshold`"""
+        mask = PatternMask(query)
+        a = self.arrays
+        nodes, distances, scores = bk_search(
+            mask, a["buffer"], a["offsets"], a["child_ptr"], a["child_edge"],
+            a["child_node"], a["max_edge"], a["roots"], radius, threshold)
+        found = list(zip(nodes.tolist(), distances.tolist(),
+                         np.round(scores.astype(np.float64), 3).tolist()))
+
+        n_frozen = self.n_frozen()
+        for node,distance in self.pending.search(query, radius):
+            score = pair_score(distance, max(len(query),
+                                             len(self.pending.domains[node])))
+            if score > threshold:
+                found.append((n_frozen + node, distance, round(score, 3)))
+
+        return found
+
+    def search(self, query: bytes, radius: int):
+        """Find every subdomain within edit distance `radius` of `query`
+
+        Positional Arguments:
+        query   -- subdomain to look up
+        radius  -- largest distance to report
+
+        Returns:
+        list of (index, distance), closest first
+        """
+        found = self._search(query, radius, -1.0)
+        return [(index, distance) for distance,index in
+                sorted((distance, index) for index,distance,_ in found)]
+
+    def search_threshold(self, query: bytes, threshold: float):
+        """Find every subdomain scoring above `threshold` against `query`
+
+        Positional Arguments:
+        query       -- subdomain to look up
+        threshold   -- minimum score to keep
+
+        Returns:
+        list of (index, score), best first
+        """
+        radius = knn_radius(len(query), threshold)
+        if radius is None:
+            radius = max(len(query), self.max_length())
+
+        found = self._search(query, radius, threshold)
+        return [(index, -score) for score,index in
+                sorted((-score, index) for index,_,score in found)]
+
+    def max_length(self):
+        """Length of the longest indexed domain"""
+        offsets = self.arrays["offsets"]
+        longest = int(np.diff(offsets).max()) if len(offsets) > 1 else 0
+        return max([longest] + [len(domain) for domain in self.pending.domains])
+
+    def save(self, path: str):
+        """Atomically write the index, inserted domains included, to the
+        directory `path` as one `.npy` file per array
+
+        Positional Arguments:
+        path -- destination directory
+        """
+        self.freeze()
+
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in FOREST_ARRAYS:
+            np.save(os.path.join(tmp_path, name + ".npy"), self.arrays[name])
+
+        # directories cannot be replaced in one step, move the old one aside
+        old_path = path + ".old"
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+def load_index(path: str, mmap: bool = True):
+    """Load an index written by `MetricIndex.save`
+
+    Positional Arguments:
+    path    -- index directory
+
+    Keyword Arguments:
+    mmap    -- memory-map the arrays instead of reading them into memory
+
+    Returns:
+    `MetricIndex`
+    """
+    mode = "r" if mmap else None
+    return MetricIndex(arrays={
+        name: np.load(os.path.join(path, name + ".npy"), mmap_mode=mode)
+        for name in FOREST_ARRAYS
+    })
@@ -0,0 +1,465 @@
+"""Approximate similarity search with MinHash and LSH banding
+
+Exact scoring is quadratic even with pruning. Here every domain gets a
+MinHash signature over its character q-grams, signatures are cut into
+`bands` bands of `rows` hashes each, and only domains sharing a whole band
+(colliding in an LSH bucket) become candidates. Candidates are verified with
+the exact `edit_distance` kernels, so every kept score is exact and only
+recall is traded for speed.
+
+Two domains with q-gram Jaccard similarity s collide with probability
+1 - (1 - s^rows)^bands (see `collision_probability`): more bands raise
+recall, more rows per band cut candidates. Recall is measured against exact
+scoring of a random sample of domains (see `measure_recall`).
+"""
+
+from dataclasses import dataclass, field
+from multiprocessing import Pool
+import time
+
+import numpy as np
+
+import edit_distance
+from win_matrix import MatrixBuilder, expand_duplicates
+from win_domains import as_store
+from win_proc import score_window_block
+from win_util import PhaseTimer
+
+# 2^64 / golden ratio, mixes gram codes before the per hash permutations
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+# band pairs buffered before they are merged into the unique candidates
+MERGE_SIZE = 1 << 24
+
+@dataclass
+class LshStats:
+    """Summary of an approximate run
+
+    `recall` is the share of the exact pairs of the sampled domains that were
+    found, None if the sample had no exact pairs or none was taken.
+    """
+    n: int = 0
+    bands: int = 0
+    rows: int = 0
+    q: int = 0
+    n_candidates: int = 0
+    n_kept: int = 0
+    recall: float = None
+    recall_sample: int = 0
+    recall_pairs: int = 0
+    elapsed: float = 0.0
+    phase_times: dict = field(default_factory=dict)
+
+def collision_probability(similarity, bands: int, rows: int):
+    """Probability that two domains of q-gram Jaccard `similarity` share a
+    band, i.e. become candidates
+
+    Positional Arguments:
+    similarity  -- Jaccard similarity (scalar or array)
+    bands       -- number of bands
+    rows        -- hashes per band
+    """
+    return 1 - (1 - np.asarray(similarity, dtype=np.float64) ** rows) ** bands
+
+def qgram_codes(domains, q: int = 2):
+    """Character q-grams of every domain as integers
+
+    Domains shorter than `q` are a single (zero padded) gram.
+
+    Positional Arguments:
+    domains -- `win_domains.DomainStore` or sequence of subdomains (bytes)
+
+    Keyword Arguments:
+    q       -- q-gram length, at most 8
+
+    Returns:
+    (`uint64` gram codes, `int64` start of every domain's grams, of length
+    len(domains) + 1)
+    """
+    return as_store(domains).qgram_codes(q)
+
+def minhash_signatures(domains, n_hashes: int = 128, q: int = 2,
+                       seed: int = 0, block_size: int = 1 << 16):
+    """MinHash signature of every domain's q-gram set
+
+    Each hash is a multiply-shift hash of the mixed gram code. Hashes are
+    tabulated once per distinct gram of a block and the minima are folded in
+    one gram position at a time, so every step is a contiguous NumPy pass.
+
+    Positional Arguments:
+    domains     -- `win_domains.DomainStore` or sequence of subdomains (bytes)
+
+    Keyword Arguments:
+    n_hashes    -- signature length
+    q           -- q-gram length
+    seed        -- seed of the hash functions
+    block_size  -- domains hashed at a time, bounds the temporary arrays
+                   (a block's distinct grams times `n_hashes`)
+
+    Returns:
+    `uint32` array of shape (len(domains), n_hashes)
+    """
+    rng = np.random.default_rng(seed)
+    # odd multipliers make x -> a * x a permutation of the 64 bit integers
+    multipliers = rng.integers(0, 1 << 63, n_hashes, dtype=np.uint64) \
+                  * np.uint64(2) + np.uint64(1)
+    offsets = rng.integers(0, 1 << 63, n_hashes, dtype=np.uint64)
+
+    domains = as_store(domains)
+    signatures = np.empty((len(domains), n_hashes), dtype=np.uint32)
+    for start in range(0, len(domains), block_size):
+        block = domains[start:start + block_size]
+        codes, gram_starts = block.qgram_codes(q)
+
+        # grams repeat across domains, so only distinct ones are hashed
+        distinct, index = np.unique(codes, return_inverse=True)
+        mixed = (distinct + np.uint64(q)) * GOLDEN
+        table = np.empty((len(distinct), n_hashes), dtype=np.uint32)
+        for first in range(0, len(distinct), 1 << 14):
+            table[first:first + (1 << 14)] = \
+                (mixed[first:first + (1 << 14), None] * multipliers
+                 + offsets) >> np.uint64(32)
+
+        # fold in the k-th gram of every domain that has one, domains sorted
+        # by gram count so they are a prefix and every step is contiguous
+        counts = np.diff(gram_starts)
+        order = np.argsort(-counts, kind="stable")
+        firsts = gram_starts[:-1][order]
+        active = np.searchsorted(-counts[order], -np.arange(counts.max()),
+                                 side="left")
+        minima = table[index[firsts]]
+        for k in range(1, len(active)):
+            m = active[k]
+            np.minimum(minima[:m], table[index[firsts[:m] + k]],
+                       out=minima[:m])
+        signatures[start + order] = minima
+
+    return signatures
+
+def _group_pairs(groups, window: int):
+    """Pairs of positions within runs of equal `groups`, every position
+    paired with at most `window` followers in its run
+
+    Returns:
+    (first, second) `int64` position arrays, first < second
+    """
+    n = len(groups)
+    if n < 2 or window < 1:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    breaks = np.flatnonzero(groups[1:] != groups[:-1]) + 1
+    run_starts = np.concatenate(([0], breaks))
+    run_ends = np.concatenate((breaks, [n]))
+    run_of = np.repeat(np.arange(len(run_starts)), run_ends - run_starts)
+
+    positions = np.arange(n)
+    counts = np.minimum(run_ends[run_of] - 1 - positions, window)
+    first = np.repeat(positions, counts)
+    second = first + 1 + np.arange(counts.sum()) \
+             - np.repeat(np.cumsum(counts) - counts, counts)
+
+    return first, second
+
+def _sorted_unique(values):
+    """Sorted unique values, sorting in place beats hashing here"""
+    values.sort()
+    if len(values) == 0:
+        return values
+
+    return values[np.concatenate(([True], values[1:] != values[:-1]))]
+
+def lsh_pairs(signatures, bands: int, rows: int, lengths=None,
+              max_bucket: int = 256):
+    """Candidate pairs of domains colliding in at least one band
+
+    Buckets larger than `max_bucket` (e.g. of a very common q-gram) would
+    add a quadratic number of pairs, so their members are only paired with
+    their `max_bucket - 1` nearest neighbours in length order.
+
+    Positional Arguments:
+    signatures  -- MinHash signatures, at least `bands * rows` hashes each
+    bands       -- number of bands
+    rows        -- hashes per band
+
+    Keyword Arguments:
+    lengths     -- domain lengths, orders the members of every bucket
+    max_bucket  -- largest bucket paired exhaustively
+
+    Returns:
+    (rows, cols) `int64` arrays of unique pairs i < j, sorted by (i, j)
+    """
+    n = len(signatures)
+    if n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if bands * rows > signatures.shape[1]:
+        raise ValueError(f"{bands} bands of {rows} rows need "
+                         f"{bands * rows} hashes, signatures have "
+                         f"{signatures.shape[1]}")
+    if lengths is None:
+        lengths = np.zeros(n, dtype=np.int64)
+
+    # similar domains collide in many bands, so band pairs are merged into
+    # the unique ones whenever enough are pending, not only at the end
+    codes = np.empty(0, dtype=np.int64)
+    pending = []
+    n_pending = 0
+    for band in range(bands):
+        columns = signatures[:, band * rows:(band + 1) * rows]
+        keys = np.zeros(n, dtype=np.uint64)
+        for column in columns.T:
+            keys = keys * GOLDEN + column.astype(np.uint64)
+
+        order = np.lexsort((lengths, keys))
+        first, second = _group_pairs(keys[order], max_bucket - 1)
+        a = order[first]
+        b = order[second]
+        pending.append(np.minimum(a, b) * n + np.maximum(a, b))
+        n_pending += len(a)
+
+        if n_pending >= max(MERGE_SIZE, len(codes)) or band == bands - 1:
+            codes = _sorted_unique(np.concatenate([codes] + pending))
+            pending = []
+            n_pending = 0
+
+    return codes // n, codes % n
+
+def verify_chunk(task):
+    """Score one chunk of `verify_pairs`
+
+    Positional Arguments:
+    task -- (ids, block task) where the block task is a
+            `win_proc.score_window_block` task over the packed domains `ids`
+
+    Returns:
+    (i, j, score) arrays of the kept pairs, indexed by domain, scores
+    rounded to 3 decimals
+    """
+    ids, block_task = task
+    i, j, scores, _ = score_window_block(block_task)
+
+    # rounded like the scores of `win_proc.process_windows`
+    return ids[i], ids[j], np.round(scores.astype(np.float64), 3)
+
+def verify_pairs(pool, domains, rows, cols, threshold: float,
+                 chunk_size: int = 65536,
+                 backend: int = edit_distance.BACKEND_BIT_PARALLEL,
+                 metric=edit_distance.METRIC_LEVENSHTEIN):
+    """Score candidate pairs exactly, a chunk of pairs at a time
+
+    Only the domains a chunk refers to are packed, so memory follows the
+    chunk and not the corpus.
+
+    Positional Arguments:
+    pool        -- `multiprocessing.Pool` to dispatch chunks to, None scores
+                   them in the calling process
+    domains     -- `win_domains.DomainStore` or sequence of subdomains (bytes)
+    rows        -- first domain of every pair, pairs sharing one adjacent
+    cols        -- second domain of every pair
+    threshold   -- minimum score to keep
+
+    Keyword Arguments:
+    chunk_size  -- pairs per chunk
+    backend     -- `edit_distance` backend used to score pairs
+    metric      -- `edit_distance.METRICS` metric used to score pairs
+
+    Returns:
+    iterator of (i, j, score) arrays of the kept pairs, one per chunk
+    """
+    domains = as_store(domains)
+    # domains of a chunk are marked instead of sorted, then numbered
+    marked = np.zeros(len(domains), dtype=bool)
+    local = np.zeros(len(domains), dtype=np.int64)
+
+    def tasks():
+        for start in range(0, len(rows), chunk_size):
+            chunk_rows = rows[start:start + chunk_size]
+            chunk_cols = cols[start:start + chunk_size]
+            marked[chunk_rows] = True
+            marked[chunk_cols] = True
+            ids = np.flatnonzero(marked)
+            marked[ids] = False
+            local[ids] = np.arange(len(ids))
+
+            packed, lengths = domains.take(ids).pack()
+            yield ids, (0, len(ids), packed, lengths, threshold, backend,
+                        metric, (local[chunk_rows], local[chunk_cols]),
+                        False)
+
+    return map(verify_chunk, tasks()) if pool is None \
+           else pool.imap(verify_chunk, tasks())
+
+def recall_sample_ids(n: int, sample: int = 200, seed: int = 0):
+    """Sorted ids of the domains `measure_recall` scores exactly
+
+    Positional Arguments:
+    n           -- total domains
+
+    Keyword Arguments:
+    sample      -- number of domains sampled
+    seed        -- sampling seed
+    """
+    return np.sort(np.random.default_rng(seed).choice(n, min(sample, n),
+                                                      replace=False))
+
+def measure_recall(domains, rows, cols, threshold: float, sample: int = 200,
+                   seed: int = 0, chunk_size: int = 65536,
+                   backend: int = edit_distance.BACKEND_BIT_PARALLEL,
+                   metric=edit_distance.METRIC_LEVENSHTEIN):
+    """Share of the exact pairs of a random sample of domains that an
+    approximate run found
+
+    Every sampled domain is scored exactly against the whole corpus, which
+    costs `sample * len(domains)` pairs.
+
+    Positional Arguments:
+    domains     -- `win_domains.DomainStore` or sequence of subdomains (bytes)
+    rows        -- first domain of every found pair, pairs without a
+                   domain of the sample (see `recall_sample_ids`) may be
+                   left out
+    cols        -- second domain of every found pair
+    threshold   -- minimum score the pairs were kept at
+
+    Keyword Arguments:
+    sample      -- number of domains sampled
+    seed        -- sampling seed
+    chunk_size  -- corpus domains scored against the sample at a time
+    backend     -- `edit_distance` backend used to score pairs
+    metric      -- `edit_distance.METRICS` metric used to score pairs
+
+    Returns:
+    (recall or None if the sample has no exact pairs, number of exact pairs)
+    """
+    domains = as_store(domains)
+    n = len(domains)
+    picked = recall_sample_ids(n, sample, seed)
+    if len(picked) == 0:
+        return None, 0
+
+    packed, lengths = domains.take(picked).pack()
+
+    exact = []
+    for start in range(0, n, chunk_size):
+        block_packed, block_lengths = domains[start:start
+                                              + chunk_size].pack()
+        i, j, _ = edit_distance.score_block(packed, lengths, block_packed,
+                                            block_lengths, threshold,
+                                            backend, metric=metric)
+        a = picked[i]
+        b = j + start
+        keep = a != b
+        exact.append(np.minimum(a, b)[keep] * n + np.maximum(a, b)[keep])
+    exact = np.unique(np.concatenate(exact))
+    if len(exact) == 0:
+        return None, 0
+
+    found = np.asarray(rows, dtype=np.int64) * n \
+            + np.asarray(cols, dtype=np.int64)
+
+    return float(np.isin(exact, found).mean()), len(exact)
+
+def process_lsh(domains, n: int, threshold: float, bands: int = 32,
+                rows: int = 4, q: int = 2, max_bucket: int = 256,
+                seed: int = 0, workers: int = 1, chunk_size: int = 65536,
+                backend: int = edit_distance.BACKEND_BIT_PARALLEL,
+                metric=edit_distance.METRIC_LEVENSHTEIN, dedup: bool = True,
+                recall_sample: int = 200, sink=None):
+    """Approximate counterpart of `win_proc.process_windows`
+
+    Positional Arguments:
+    domains     -- input subdomains, a `win_domains.DomainStore` or an
+                   iterable of bytes
+    n           -- total input subdomains
+    threshold   -- minimum score to keep
+
+    Keyword Arguments:
+    bands       -- LSH bands, more raise recall and candidates
+    rows        -- hashes per band, more cut candidates and recall
+    q           -- q-gram length of the signatures
+    max_bucket  -- largest bucket paired exhaustively (see `lsh_pairs`)
+    seed        -- seed of the hash functions and of the recall sample
+    workers     -- number of verifying processes, 1 verifies in the calling
+                   process
+    chunk_size  -- candidate pairs verified at a time
+    backend     -- `edit_distance` backend used to verify pairs
+    metric      -- `edit_distance.METRICS` metric used to verify pairs
+    dedup       -- search unique subdomains only and map the scores back
+                   onto every duplicate (see `win_domains.DomainStore.dedup`)
+    recall_sample -- domains scored exactly to measure recall, 0 skips it
+    sink        -- `win_store.ShardWriter` streaming the matrix to disk
+
+    Returns:
+    (`scipy.sparse.csr_matrix` of subdomains and their respective
+    similarities in the order of `domains`, or a `win_store.ShardedMatrix`
+    if a `sink` was given; `LshStats`)
+    """
+    start = time.perf_counter()
+    timer = PhaseTimer()
+    metric = edit_distance.metric_id(metric)
+
+    domains = as_store(domains, n)
+    inverse = None
+    if dedup:
+        domains, inverse, _ = domains.dedup()
+        if len(domains) == len(inverse):
+            # nothing to collapse
+            inverse = None
+
+    with timer.phase("signatures"):
+        signatures = minhash_signatures(domains, bands * rows, q, seed)
+
+    with timer.phase("banding"):
+        lengths = domains.lengths.astype(np.int64)
+        pair_rows, pair_cols = lsh_pairs(signatures, bands, rows, lengths,
+                                         max_bucket)
+    del signatures
+
+    # only pairs of the recall sample are held on to, the rest go straight
+    # to the matrix or the sink
+    sampled = np.zeros(len(domains), dtype=bool)
+    if recall_sample > 0:
+        sampled[recall_sample_ids(len(domains), recall_sample, seed)] = True
+
+    sim_mat = MatrixBuilder(len(domains)) if sink is None else sink
+    n_kept = 0
+    kept_rows = []
+    kept_cols = []
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        with timer.phase("verify"):
+            for i,j,scores in verify_pairs(pool, domains, pair_rows,
+                                           pair_cols, threshold, chunk_size,
+                                           backend, metric):
+                sim_mat.extend(i, j, scores)
+                n_kept += len(scores)
+                keep = sampled[i] | sampled[j]
+                kept_rows.append(i[keep])
+                kept_cols.append(j[keep])
+    finally:
+        if pool is not None:
+            # like `with Pool`, every block is consumed or of no use
+            pool.terminate()
+            pool.join()
+
+    kept_rows = np.concatenate(kept_rows) if kept_rows \
+                else np.empty(0, dtype=np.int64)
+    kept_cols = np.concatenate(kept_cols) if kept_cols \
+                else np.empty(0, dtype=np.int64)
+
+    stats = LshStats(n=len(domains), bands=bands, rows=rows, q=q,
+                     n_candidates=len(pair_rows), n_kept=n_kept)
+    if recall_sample > 0:
+        with timer.phase("recall"):
+            stats.recall, stats.recall_pairs = measure_recall(
+                domains, kept_rows, kept_cols, threshold, recall_sample,
+                seed, chunk_size, backend, metric)
+        stats.recall_sample = min(recall_sample, len(domains))
+
+    stats.phase_times = dict(timer.times)
+    stats.elapsed = round(time.perf_counter() - start, 3)
+
+    if sink is not None:
+        return sink.close(domains, inverse), stats
+    if inverse is not None:
+        return expand_duplicates(sim_mat.to_csr(), inverse), stats
+
+    return sim_mat.to_csr(), stats
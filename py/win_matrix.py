@@ -0,0 +1,230 @@
+"""Similarity matrix construction"""
+
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix, identity, triu
+
+class MatrixBuilder:
+    """Accumulates (row, column, score) triplets of every window in
+    preallocated COO buffers and converts them once to a sparse matrix
+
+    Rows and columns are global domain indices, i.e. the position of a domain
+    in the input stream, so the result does not depend on hashing or on how
+    the input was split into windows.
+    """
+    def __init__(self, n, capacity=4096):
+        """Non-default constructor
+
+        Positional Arguments:
+        n           -- total number of domains (matrix dimension)
+
+        Keyword Arguments:
+        capacity    -- number of triplets to preallocate
+        """
+        self.n = n
+        self.size = 0
+
+        index_dtype = np.int32 if n <= np.iinfo(np.int32).max else np.int64
+        capacity = max(1, capacity)
+        self.rows = np.empty(capacity, dtype=index_dtype)
+        self.cols = np.empty(capacity, dtype=index_dtype)
+        self.data = np.empty(capacity, dtype=np.float32)
+
+    def get_size(self):
+        """Getter"""
+        return self.size
+
+    def reserve(self, extra):
+        """Make room for `extra` more triplets, growing buffers geometrically
+
+        Positional Arguments:
+        extra -- number of triplets about to be added
+        """
+        needed = self.size + extra
+        capacity = len(self.data)
+        if needed <= capacity:
+            return
+
+        while capacity < needed:
+            capacity *= 2
+
+        for name in ("rows", "cols", "data"):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def extend(self, rows, cols, scores):
+        """Append triplets given as equally long arrays
+
+        Positional Arguments:
+        rows    -- global row indices
+        cols    -- global column indices
+        scores  -- similarity scores
+        """
+        count = len(scores)
+        self.reserve(count)
+
+        end = self.size + count
+        self.rows[self.size:end] = rows
+        self.cols[self.size:end] = cols
+        self.data[self.size:end] = scores
+        self.size = end
+
+    def add_pairs(self, pair_scores, offset=0):
+        """Append a stream of window index pairs and scores
+
+        Positional Arguments:
+        pair_scores -- ((i, j), score) with indices local to a window
+
+        Keyword Arguments:
+        offset      -- global index of the window's first domain
+
+        Returns:
+        number of triplets added
+        """
+        rows = []
+        cols = []
+        scores = []
+        for (i,j),score in pair_scores:
+            rows.append(i)
+            cols.append(j)
+            scores.append(score)
+
+        self.extend(np.asarray(rows, dtype=np.int64) + offset,
+                    np.asarray(cols, dtype=np.int64) + offset,
+                    scores)
+
+        return len(scores)
+
+    def add_blocks(self, blocks, offset=0):
+        """Append a stream of (i, j, score) array blocks
+
+        Positional Arguments:
+        blocks      -- (i, j, score) arrays with indices local to a window
+
+        Keyword Arguments:
+        offset      -- global index of the window's first domain
+
+        Returns:
+        number of triplets added
+        """
+        count = 0
+        for i,j,scores in blocks:
+            self.extend(i + offset, j + offset, scores)
+            count += len(scores)
+
+        return count
+
+    def get_state(self):
+        """Accumulated triplets, for checkpoints (see `set_state`)"""
+        return {"rows": self.rows[:self.size].copy(),
+                "cols": self.cols[:self.size].copy(),
+                "data": self.data[:self.size].copy()}
+
+    def set_state(self, state):
+        """Replace the accumulated triplets with those of `get_state`
+
+        Positional Arguments:
+        state -- dict returned by `get_state`
+        """
+        self.size = 0
+        self.extend(state["rows"], state["cols"], state["data"])
+
+    def to_csr(self):
+        """Convert the accumulated triplets to a `scipy.sparse.csr_matrix`"""
+        return coo_matrix((self.data[:self.size],
+                           (self.rows[:self.size], self.cols[:self.size])),
+                          shape=(self.n, self.n)).tocsr()
+
+def expand_duplicates(sim_mat, inverse):
+    """Map a matrix over unique domains back onto the original domains
+
+    Every occurrence of a domain takes over the scores of its representative,
+    and occurrences of the same domain score 1.0 against each other.
+
+    Positional Arguments:
+    sim_mat -- upper triangular similarity matrix over the unique domains
+    inverse -- representative index of every original domain (see
+               `win_domains.DomainStore.dedup`)
+
+    Returns:
+    upper triangular `scipy.sparse.csr_matrix` over the original domains
+    """
+    n = len(inverse)
+    n_unique = sim_mat.shape[0]
+
+    # occurrence matrix, row i has a single 1.0 at column inverse[i]
+    occurrences = csr_matrix((np.ones(n, dtype=np.float32),
+                              (np.arange(n), inverse)),
+                             shape=(n, n_unique))
+
+    # a symmetric view with 1.0 on the diagonal, every product entry is a
+    # single term so scores are copied, not summed
+    unique = csr_matrix(sim_mat, dtype=np.float32)
+    unique = unique + unique.T + identity(n_unique, dtype=np.float32,
+                                          format="csr")
+
+    return triu(occurrences @ unique @ occurrences.T, k=1, format="csr")
+
+def _occurrences(inverse):
+    """Original domains grouped by representative: (domains, group starts)"""
+    counts = np.bincount(inverse)
+    order = np.argsort(inverse, kind="stable")
+    return order, np.concatenate(([0], np.cumsum(counts))), counts
+
+def expand_triplets(rows, cols, scores, inverse):
+    """Map triplets over unique domains onto every occurrence of them, the
+    streaming counterpart of `expand_duplicates`
+
+    Positional Arguments:
+    rows    -- representative row indices
+    cols    -- representative column indices
+    scores  -- similarity scores
+    inverse -- representative index of every original domain
+
+    Returns:
+    (rows, cols, scores) arrays over the original domains, rows < cols
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    order, starts, counts = _occurrences(inverse)
+
+    # every triplet turns into row count x column count triplets
+    row_counts = counts[rows]
+    col_counts = counts[cols]
+    fanout = row_counts * col_counts
+    triplet = np.repeat(np.arange(len(rows)), fanout)
+    local = np.arange(fanout.sum()) \
+            - np.repeat(np.cumsum(fanout) - fanout, fanout)
+
+    i = order[starts[rows][triplet] + local // col_counts[triplet]]
+    j = order[starts[cols][triplet] + local % col_counts[triplet]]
+
+    return (np.minimum(i, j), np.maximum(i, j),
+            np.asarray(scores, dtype=np.float32)[triplet])
+
+def duplicate_triplets(inverse):
+    """Triplets scoring every pair of copies of the same domain 1.0
+
+    Positional Arguments:
+    inverse -- representative index of every original domain
+
+    Returns:
+    (rows, cols, scores) arrays over the original domains, rows < cols
+    """
+    order, starts, counts = _occurrences(inverse)
+
+    rows = []
+    cols = []
+    for group in np.flatnonzero(counts > 1).tolist():
+        copies = np.sort(order[starts[group]:starts[group + 1]])
+        i, j = np.triu_indices(len(copies), k=1)
+        rows.append(copies[i])
+        cols.append(copies[j])
+
+    if not rows:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.float32))
+
+    rows = np.concatenate(rows)
+    return rows, np.concatenate(cols), np.ones(len(rows), dtype=np.float32)
@@ -1,34 +1,27 @@
 """Domain name similarity using sliding windows and multiprocessing"""
 
-from itertools import combinations, tee
+from itertools import repeat
+from multiprocessing import Pool
+import os
+import pickle
 import time
 from types import GeneratorType
 
 import numpy as np
-from scipy.sparse import lil_matrix
 
 import edit_distance
-from sliding_window import SlidingWindow
-from win_stat import compute_stats
-
-def copy_generator(generator, num_copies=2):
-    """Generates multiple copies of a given generator
-
-    Positional Arguments:
-    generator -- types.GeneratorType iterable to be copied
-
-    Keyword Arguments:
-    num_copies -- quantity of copies to construct
-    """
-    gens: tuple = tee(generator, num_copies)
-    for gen in gens:
-        yield gen
+from sliding_window import SlidingWindow, TileSchedule, WindowController
+from win_domains import as_store
+from win_index import BKTree
+from win_matrix import MatrixBuilder, expand_duplicates
+from win_stat import StatAccumulator, print_stats
+from win_util import PhaseTimer
 
 def uniprocessed_work(function: callable, data: GeneratorType, threshold=0.70):
     """Helper for scoring pairs of domains
 
     Positional Arguments:
-    function    -- scoring function
+    function    -- scoring function, called with a pair and the threshold
     data        -- data to score (subdomains)
 
     Keyword Arguments:
@@ -39,76 +32,856 @@ def uniprocessed_work(function: callable, data: GeneratorType, threshold=0.70):
         e.g. (('domain1.com', 'domain2.com'), 0.900)
     """
     return ((pair, round(score, 3)) for pair,score in \
-            map(function, data) if score > threshold)
+            map(function, data, repeat(threshold)) if score > threshold)
+
+def qgram_bound(lengths, threshold: float, q: int = 1):
+    """Fewest q-grams a domain shares with any partner that can still score
+    above `threshold`, the count filter of `candidate_pairs` rules out
+    nothing for a domain where it is not positive
+
+    Positional Arguments:
+    lengths     -- domain lengths
+    threshold   -- minimum score to keep
+
+    Keyword Arguments:
+    q           -- q-gram length
+
+    Returns:
+    `int64` array, max_len - q + 1 - k * q per domain
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if threshold <= 0:
+        max_dists = lengths.copy()
+    else:
+        max_dists = ((1 - threshold) * lengths + 1e-6).astype(np.int64)
+
+    return lengths - q + 1 - max_dists * q
+
+def candidate_pairs(data, threshold: float, q: int = 1):
+    """Generate the pairs of a window that can still score above `threshold`
+
+    A pair needs an edit distance of at most k = (1 - threshold) * max_len to
+    pass. Domains are sorted by length so that the length filter
+    (|len_a - len_b| <= k) bounds every domain's partners to a contiguous
+    range, and a q-gram inverted index applies the count filter: two strings
+    within distance k share at least max_len - q + 1 - k * q q-grams.
+
+    Positional Arguments:
+    data        -- window of subdomains, a `win_domains.DomainStore` or a
+                   sequence of bytes
+    threshold   -- minimum score to keep
+
+    Keyword Arguments:
+    q           -- q-gram length (at most 8), 1 (character counts) prunes best
+                   at the thresholds we run
+
+    Returns:
+    (candidates, n_candidates) where `candidates[i]` is a sorted array of the
+    indices j > i that domain i has to be scored against
+    """
+    data = as_store(data)
+    n_data = len(data)
+    order = np.argsort(data.lengths, kind="stable")
+
+    lengths = data.lengths[order].astype(np.int64)
+    if threshold <= 0:
+        max_dists = lengths.copy()
+    else:
+        max_dists = ((1 - threshold) * lengths + 1e-6).astype(np.int64)
+    firsts = np.searchsorted(lengths, lengths - max_dists, side="left")
+    min_shared = qgram_bound(lengths, threshold, q)
+
+    # === BUILD Q-GRAM INDEX (positions in length order) ===
+    codes, gram_starts = data.qgram_codes(q)
+    n_grams = np.diff(gram_starts)
+    rank = np.empty(n_data, dtype=np.int64)
+    rank[order] = np.arange(n_data)
+    owners = np.repeat(rank, n_grams)
+    # domains shorter than q only have a padded stand-in gram
+    real = np.repeat(data.lengths >= q, n_grams)
+    owners = owners[real]
+    codes = codes[real]
+
+    # distinct (position, gram) entries and their counts, by position
+    sort = np.lexsort((codes, owners))
+    owners = owners[sort]
+    codes = codes[sort]
+    new_entry = np.ones(len(codes), dtype=bool)
+    new_entry[1:] = (owners[1:] != owners[:-1]) | (codes[1:] != codes[:-1])
+    entries = np.flatnonzero(new_entry)
+    gram_pos = owners[entries]
+    gram_code = codes[entries]
+    gram_count = np.diff(np.append(entries, len(codes)))
+    row_bounds = np.searchsorted(gram_pos, np.arange(n_data + 1))
+
+    # postings are the same entries by gram, then position
+    postings = np.lexsort((gram_pos, gram_code))
+    posting_pos = gram_pos[postings]
+    posting_count = gram_count[postings]
+    posting_code = gram_code[postings]
+    posting_lo = np.searchsorted(posting_code, gram_code, side="left")
+    posting_hi = np.searchsorted(posting_code, gram_code, side="right")
+
+    # === COUNT FILTER ===
+    rows = []
+    cols = []
+    for pos in range(n_data):
+        first = firsts[pos]
+        if first >= pos:
+            continue
+
+        if min_shared[pos] <= 0:
+            # too short for the count filter to rule anything out
+            matches = np.arange(first, pos)
+        else:
+            positions = []
+            shared = []
+            for gram in range(row_bounds[pos], row_bounds[pos + 1]):
+                lo, hi = posting_lo[gram], posting_hi[gram]
+                lo, hi = np.searchsorted(posting_pos[lo:hi], (first, pos)) + lo
+                if lo < hi:
+                    positions.append(posting_pos[lo:hi])
+                    shared.append(np.minimum(posting_count[lo:hi],
+                                             gram_count[gram]))
+            if not positions:
+                continue
+
+            counts = np.bincount(np.concatenate(positions) - first,
+                                 weights=np.concatenate(shared),
+                                 minlength=pos - first)
+            matches = np.flatnonzero(counts >= min_shared[pos]) + first
+
+        rows.append(np.full(len(matches), pos))
+        cols.append(matches)
+
+    # === MAP BACK TO WINDOW ORDER ===
+    if rows:
+        rows = order[np.concatenate(rows)]
+        cols = order[np.concatenate(cols)]
+    else:
+        rows = cols = np.empty(0, dtype=np.int64)
+    first_idx = np.minimum(rows, cols)
+    second_idx = np.maximum(rows, cols)
+
+    sort = np.lexsort((second_idx, first_idx))
+    first_idx = first_idx[sort]
+    second_idx = second_idx[sort]
+    bounds = np.searchsorted(first_idx, np.arange(n_data + 1))
+
+    candidates = [second_idx[bounds[i]:bounds[i + 1]] for i in range(n_data)]
+
+    return candidates, len(second_idx)
+
+def row_blocks(n_rows: int, chunk_size: int, candidates=None):
+    """Split the upper triangle of an `n_rows` x `n_rows` window into blocks
+    of consecutive rows holding roughly `chunk_size` pairs each
+
+    Positional Arguments:
+    n_rows      -- number of domains in the window
+    chunk_size  -- approximate number of pairs per block
+
+    Keyword Arguments:
+    candidates  -- per row candidates from `candidate_pairs`, None pairs each
+                   row with every domain after it
+
+    Returns:
+    Generator of (first_row, last_row) half-open row ranges
+    """
+    chunk_size = max(1, chunk_size)
+
+    start = 0
+    n_pairs = 0
+    for row in range(n_rows):
+        if candidates is None:
+            # row `row` is paired with every domain after it
+            n_pairs += n_rows - row - 1
+        else:
+            n_pairs += len(candidates[row])
+        if n_pairs >= chunk_size:
+            yield (start, row + 1)
+            start = row + 1
+            n_pairs = 0
+
+    if start < n_rows:
+        yield (start, n_rows)
+
+def score_window_block(task):
+    """Score every pair of a row block of a window's upper triangle
+
+    Positional Arguments:
+    task -- (start, rows, packed, lengths, threshold, backend, metric, pairs,
+            prune) where `packed` and `lengths` are the tail of the packed
+            window (see `edit_distance.pack_domains`) starting at the block's
+            first row `start`, `rows` is the number of rows in the block,
+            `pairs` holds (row, column) index arrays into the tail of the
+            candidates to score (or None to score every pair) and `prune`
+            puts every pair through the filters of `edit_distance.score_block`
+
+    Returns:
+    (i, j, score) arrays of the kept pairs, indexed by window position, and
+    the number of pairs scored
+    """
+    start, rows, packed, lengths, threshold, backend, metric, pairs, \
+        prune = task
+
+    n_scored = np.zeros(1, dtype=np.int64)
+    if pairs is None:
+        i,j,scores = edit_distance.score_block(packed[:rows], lengths[:rows],
+                                               packed, lengths, threshold,
+                                               backend, upper=True,
+                                               metric=metric, prune=prune,
+                                               n_scored=n_scored)
+    else:
+        i,j,scores = edit_distance.score_pairs(packed, lengths, pairs[0],
+                                               pairs[1], threshold, backend,
+                                               metric, prune=prune,
+                                               n_scored=n_scored)
+
+    return i + start, j + start, scores, int(n_scored[0])
+
+def rounded_blocks(blocks, n_scored=None):
+    """Round the scores of kernel blocks and tally the pairs they scored
 
-def process_windows(domains, n: int, threshold: int, flags: int) -> None:
+    Positional Arguments:
+    blocks      -- (i, j, score, number of pairs scored) of
+                   `score_window_block` or `tile_block`
+
+    Keyword Arguments:
+    n_scored    -- one element `int64` array the scored pairs are added to
+
+    Returns:
+    Generator of (i, j, score) arrays, scores rounded to 3 digits
+    """
+    for i,j,scores,block_scored in blocks:
+        if n_scored is not None:
+            n_scored[0] += block_scored
+        yield i, j, np.round(scores.astype(np.float64), 3)
+
+def block_pairs(blocks):
+    """Flatten (i, j, score) array blocks into a pair stream
+
+    Positional Arguments:
+    blocks -- (i, j, score) arrays
+
+    Returns:
+    Generator of index pairs and respective scores
+        e.g. ((0, 7), 0.900)
+    """
+    for i,j,scores in blocks:
+        yield from zip(zip(i.tolist(), j.tolist()), scores.tolist())
+
+def multiprocessed_work(pool, data, threshold=0.70, chunk_size=65536,
+                        backend=edit_distance.BACKEND_BIT_PARALLEL,
+                        candidates=None,
+                        metric=edit_distance.METRIC_LEVENSHTEIN,
+                        prune: bool = False, n_scored=None):
+    """Helper for scoring pairs of domains across a process pool, pair by
+    pair view of `window_blocks` (see it for the arguments)
+
+    Returns:
+    Generator of window index pairs and respective scores
+        e.g. ((0, 7), 0.900)
+    """
+    return block_pairs(window_blocks(pool, data, threshold, chunk_size,
+                                     backend, candidates, metric, prune,
+                                     n_scored))
+
+def window_blocks(pool, data, threshold=0.70, chunk_size=65536,
+                  backend=edit_distance.BACKEND_BIT_PARALLEL,
+                  candidates=None, metric=edit_distance.METRIC_LEVENSHTEIN,
+                  prune: bool = False, n_scored=None):
+    """Score the pairs of a window across a process pool, block by block
+
+    The window is packed into a fixed-width array and its upper triangle is
+    split into row blocks (see `row_blocks`) that are scored by the workers of
+    `pool` with the batch kernels of `edit_distance`. Blocks are merged back
+    in row order, so the pairs follow the order of `combinations(data, 2)`.
+    Pairs are reported by their indices into `data`, see `named_pairs` to get
+    the subdomains back.
+
+    Positional Arguments:
+    pool        -- `multiprocessing.Pool` to dispatch blocks to, None scores
+                   them in the calling process
+    data        -- data to score, a `win_domains.DomainStore` or a sequence
+                   of subdomains
+
+    Keyword Arguments:
+    threshold   -- minimum score to keep
+    chunk_size  -- approximate number of pairs per block
+    backend     -- `edit_distance` backend used to score pairs
+    candidates  -- per row candidates from `candidate_pairs`, None scores
+                   every pair
+    metric      -- `edit_distance.METRICS` metric used to score pairs
+    prune       -- skip the pairs the length and character count filters of
+                   `edit_distance.score_block` rule out, candidates included
+    n_scored    -- one element `int64` array the number of pairs actually
+                   scored is added to as blocks complete
+
+    Returns:
+    Generator of (i, j, score) arrays of the kept pairs, see `rounded_blocks`
+    """
+    packed, lengths = as_store(data).pack()
+
+    def block_pairs(start, end):
+        if candidates is None:
+            return None
+        block = candidates[start:end]
+        rows = np.repeat(np.arange(end - start, dtype=np.int64),
+                         [len(row) for row in block])
+        cols = np.concatenate(block).astype(np.int64) - start
+        return rows, cols
+
+    tasks = ((start, end - start, packed[start:], lengths[start:], threshold,
+              backend, metric, block_pairs(start, end), prune)
+             for start,end in row_blocks(len(data), chunk_size, candidates))
+
+    blocks = map(score_window_block, tasks) if pool is None \
+             else pool.imap(score_window_block, tasks)
+
+    return rounded_blocks(blocks, n_scored)
+
+def tile_block(task):
+    """Score a row block of a rectangular tile between two windows
+
+    Positional Arguments:
+    task -- (start, packed_a, lengths_a, packed_b, lengths_b, threshold,
+            backend, metric, prune) where `packed_a` and `lengths_a` are the
+            block's rows of the row window, starting at its row `start`, the
+            block is scored against all of `packed_b`, and `prune` puts every
+            pair through the filters of `edit_distance.score_block`
+
+    Returns:
+    (i, j, score) arrays of the kept pairs, indexed by position in the
+    respective window, and the number of pairs scored
+    """
+    start, packed_a, lengths_a, packed_b, lengths_b, threshold, backend, \
+        metric, prune = task
+
+    n_scored = np.zeros(1, dtype=np.int64)
+    i,j,scores = edit_distance.score_block(packed_a, lengths_a, packed_b,
+                                           lengths_b, threshold, backend,
+                                           metric=metric, prune=prune,
+                                           n_scored=n_scored)
+
+    return i + start, j, scores, int(n_scored[0])
+
+def tile_blocks(pool, block_a, block_b, threshold=0.70, chunk_size=65536,
+                backend=edit_distance.BACKEND_BIT_PARALLEL,
+                metric=edit_distance.METRIC_LEVENSHTEIN, prune: bool = False,
+                n_scored=None):
+    """Helper for scoring every pair between two different windows
+
+    Positional Arguments:
+    pool        -- `multiprocessing.Pool` to dispatch row blocks to, None
+                   scores them in the calling process
+    block_a     -- (packed, lengths) of the row window, see
+                   `edit_distance.pack_domains`
+    block_b     -- (packed, lengths) of the column window
+
+    Keyword Arguments:
+    threshold   -- minimum score to keep
+    chunk_size  -- approximate number of pairs per row block
+    backend     -- `edit_distance` backend used to score pairs
+    metric      -- `edit_distance.METRICS` metric used to score pairs
+    prune       -- skip the pairs the length and character count filters of
+                   `edit_distance.score_block` rule out
+    n_scored    -- one element `int64` array the number of pairs actually
+                   scored is added to as blocks complete
+
+    Returns:
+    Generator of (i, j, score) arrays of the kept pairs, i indexing the row
+    window and j the column window, see `rounded_blocks`
+    """
+    packed_a, lengths_a = block_a
+    packed_b, lengths_b = block_b
+
+    rows = max(1, chunk_size // max(1, len(lengths_b)))
+    # only the block's own rows are shipped with each task
+    tasks = ((start, packed_a[start:start + rows],
+              lengths_a[start:start + rows], packed_b, lengths_b, threshold,
+              backend, metric, prune)
+             for start in range(0, len(lengths_a), rows))
+
+    blocks = map(tile_block, tasks) if pool is None \
+             else pool.imap(tile_block, tasks)
+
+    return rounded_blocks(blocks, n_scored)
+
+def offset_blocks(blocks, row_offset: int, col_offset: int):
+    """Shift the window indices of (i, j, score) blocks to global indices
+
+    Positional Arguments:
+    blocks      -- (i, j, score) arrays with window indices
+    row_offset  -- global index of the row window's first domain
+    col_offset  -- global index of the column window's first domain
+
+    Returns:
+    Generator of (i, j, score) arrays with global indices
+    """
+    return ((i + row_offset, j + col_offset, scores)
+            for i,j,scores in blocks)
+
+def named_pairs(data, pair_scores):
+    """Resolve window index pairs to the subdomains they refer to
+
+    Positional Arguments:
+    data        -- window of subdomains, a `win_domains.DomainStore` or a
+                   sequence of bytes
+    pair_scores -- window index pairs and respective scores
+
+    Returns:
+    Generator of word pairs and respective scores
+    """
+    return (((data[i], data[j]), score) for (i,j),score in pair_scores)
+
+# index of the running kNN query, shipped once per worker process
+_knn_tree = None
+
+def init_knn_tree(tree):
+    """Pool initializer making the index available to `knn_block`
+
+    Positional Arguments:
+    tree -- `win_index.BKTree` over the corpus
+    """
+    global _knn_tree
+    _knn_tree = tree
+
+def knn_block(task):
+    """Answer a block of kNN queries against the shared index
+
+    Positional Arguments:
+    task -- (queries, excludes, k, threshold), `excludes` holds the node to
+            skip for each query or None
+
+    Returns:
+    list of neighbor lists, see `win_index.BKTree.nearest`
+    """
+    queries, excludes, k, threshold = task
+    return [_knn_tree.nearest(query, k, threshold, exclude)
+            for query,exclude in zip(queries, excludes)]
+
+def nearest_neighbors(domains, k: int = 10, queries=None,
+                      threshold: float = 0.0, workers: int = 1,
+                      chunk_size: int = 256, tree=None):
+    """Top-k most similar subdomains per query, without the n x n matrix
+
+    Positional Arguments:
+    domains     -- corpus subdomains
+
+    Keyword Arguments:
+    k           -- neighbors per query
+    queries     -- subdomains to look up, None queries every corpus domain
+                   against the rest of the corpus
+    threshold   -- minimum score to keep
+    workers     -- number of query processes, 1 queries in the calling process
+    chunk_size  -- queries handed to a worker at a time
+    tree        -- prebuilt `win_index.BKTree` over `domains`, built here if
+                   None
+
+    Returns:
+    (`int64` array [queries, k] of corpus indices, `float32` array [queries,
+    k] of scores), best first, missing neighbors have index -1 and score 0
+    """
+    if tree is None:
+        tree = BKTree(domains)
+
+    self_query = queries is None
+    queries = tree.domains if self_query else list(queries)
+
+    # a corpus domain is not its own neighbor
+    tasks = ((queries[start:start + chunk_size],
+              range(start, min(start + chunk_size, len(queries))) \
+              if self_query \
+              else [None] * len(queries[start:start + chunk_size]),
+              k, threshold)
+             for start in range(0, len(queries), chunk_size))
+
+    if workers > 1:
+        pool = Pool(workers, initializer=init_knn_tree, initargs=(tree,))
+        blocks = pool.imap(knn_block, tasks)
+    else:
+        pool = None
+        init_knn_tree(tree)
+        blocks = map(knn_block, tasks)
+
+    indices = np.full((len(queries), k), -1, dtype=np.int64)
+    scores = np.zeros((len(queries), k), dtype=np.float32)
+    row = 0
+    try:
+        for block in blocks:
+            for neighbors in block:
+                for col,(index,score) in enumerate(neighbors):
+                    indices[row, col] = index
+                    scores[row, col] = score
+                row += 1
+    finally:
+        if pool is not None:
+            # like `with Pool`, every block is consumed or of no use
+            pool.terminate()
+            pool.join()
+
+    return indices, scores
+
+def save_checkpoint(path: str, state: dict):
+    """Atomically write the loop state of `process_windows`
+
+    The state is pickled to a temporary file next to `path` and moved over
+    it, so an interrupted write leaves the previous checkpoint intact.
+
+    Positional Arguments:
+    path    -- checkpoint file
+    state   -- picklable loop state
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as outfile:
+        pickle.dump(state, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path: str):
+    """Load a checkpoint written by `save_checkpoint`
+
+    Positional Arguments:
+    path -- checkpoint file
+
+    Returns:
+    the loop state, or None if `path` does not exist
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rb") as infile:
+        return pickle.load(infile)
+
+def process_windows(domains, n: int, threshold: int, flags: int,
+                    workers: int = 1, chunk_size: int = 65536,
+                    backend: int = edit_distance.BACKEND_BIT_PARALLEL,
+                    prune: bool = True, q: int = 1, reporter=print_stats,
+                    cross_window: bool = True, win_min: int = 2000,
+                    win_max: int = 4000, controller=None,
+                    dedup: bool = True, metrics=None, sink=None,
+                    clusters=None, checkpoint: str = None,
+                    checkpoint_interval: float = 60.0, resume: bool = False,
+                    metric=edit_distance.METRIC_LEVENSHTEIN):
     """Main window processor that includes optional statisical computation
 
     Positional Arguments:
-    domains     -- input subdomains
+    domains     -- input subdomains, a `win_domains.DomainStore` or an
+                   iterable of bytes (copied into one); windows, pairs,
+                   statistics and the matrix refer to them by id
     n           -- total input subdomains
     threshold   -- minimum score to keep
     flags       -- window statistics flags, see `util.py` for list of supported
                    statistics
 
+    Keyword Arguments:
+    workers     -- number of scoring processes, 1 scores in the calling process
+    chunk_size  -- approximate number of pairs handed to a worker at a time
+    backend     -- `edit_distance` backend used to score pairs
+    prune       -- only score pairs that pass the length and character count
+                   filters, run by the kernels on every tile (see
+                   `edit_distance.score_block`)
+    q           -- q-gram length, above 1 the pairs of the window itself
+                   must also pass the q-gram count filter of
+                   `candidate_pairs` before the kernel filters. The filter
+                   can only rule pairs out at high thresholds (see
+                   `qgram_bound`) and building its index costs more than it
+                   saves on the bench corpora, so 1 skips it
+    reporter    -- callable handed each window's `win_stat.WindowStats` once it
+                   is processed, e.g. `win_stat.print_stats` or a
+                   `win_stat.JsonLinesReporter`; None disables reporting
+    cross_window -- also score every window against all earlier windows
+                    (see `sliding_window.TileSchedule`) so the whole upper
+                    triangle is covered, otherwise only pairs within a window
+                    are scored
+    win_min     -- smallest window (tile) size
+    win_max     -- largest window (tile) size
+    controller  -- `sliding_window.WindowController` sizing the windows from
+                   their wall time, None uses a default 10s latency target
+    dedup       -- window over unique subdomains only (see
+                   `win_domains.DomainStore.dedup`) and map the scores back
+                   onto every duplicate afterwards, duplicates score 1.0
+                   against each other without being computed; window
+                   statistics then cover unique subdomains
+    metrics     -- `win_stat.Metrics` accumulating the counters and phase
+                   times of every window, None keeps none
+    sink        -- `win_store.ShardWriter` streaming the matrix to disk
+                   instead of building it in memory
+    clusters    -- `win_cluster.Clusterer` joining the domains of every kept
+                   pair as it streams by, over all input domains
+    checkpoint  -- file the loop state and the matrix accumulated so far are
+                   written to (see `save_checkpoint`), after a tile once
+                   `checkpoint_interval` has passed and after every window
+                   once it has passed; None writes none
+    checkpoint_interval -- least seconds between two checkpoints
+    resume      -- continue from `checkpoint` if it exists, skipping every
+                   window and tile it completed; `domains` must be the same
+                   input, windows restored from it are not reported again
+    metric      -- name or id of the `edit_distance.METRICS` metric pairs are
+                   scored by; `prune` is skipped for metrics its filters do
+                   not bound (Jaro-Winkler, q-gram Jaccard), Damerau is only
+                   pruned by character counts
+
     Returns:
-    `scipy.lil_matrx` of subdomains and their respective similarities
+    (`scipy.sparse.csr_matrix` of subdomains and their respective
+    similarities, rows and columns follow the order of `domains`, or a
+    `win_store.ShardedMatrix` over the written shards if a `sink` was given;
+    list of `win_stat.WindowStats`, one per window)
     """
 
+    metric = edit_distance.metric_id(metric)
+    if metric == edit_distance.METRIC_DAMERAU:
+        # one transposition breaks up to q + 1 q-grams, characters are kept
+        q = 1
+    elif metric != edit_distance.METRIC_LEVENSHTEIN:
+        prune = False
+
+    domains = as_store(domains, n)
+    inverse = None
+    if dedup:
+        domains, inverse, _ = domains.dedup()
+        if len(domains) == len(inverse):
+            # nothing to collapse
+            inverse = None
+    n = len(domains)
+
     n_processed = 0
 
     current_window = 1
 
-    win_max = 4000
-    win_min = 2000
+    state = load_checkpoint(checkpoint) if checkpoint and resume else None
+    if state is not None:
+        if state["n"] != n or state["threshold"] != threshold \
+           or state["metric"] != metric:
+            raise ValueError(f"checkpoint at {checkpoint} was written for "
+                             f"{state['n']} domains at threshold "
+                             f"{state['threshold']} by metric "
+                             f"{state['metric']}, not {n} at {threshold} by "
+                             f"{metric}")
+        controller = state["controller"]
+
+    if controller is None:
+        controller = WindowController()
+    controller.set_cross_window(cross_window)
+
+    # keep a single window's pairs within the memory budget
+    cap = controller.memory_cap()
+    if cap is not None:
+        win_max = min(win_max, cap)
+        win_min = min(win_min, win_max)
 
     # make sure we don't compute on data we don't have
     if n <= win_max or n <= win_min:
         win_min = win_max = n
 
-    window = SlidingWindow(domains, win_min, win_min, win_max)
+    sim_mat = MatrixBuilder(n) if sink is None else sink
+    window_stats = []
+
+    schedule = TileSchedule()
+    # packed windows seen so far, needed by cross window tiles
+    packed_blocks = []
+
+    # tiles of the current window already scored, and the partial results
+    # of that window, restored by a mid-window resume
+    tiles_done = 0
+    partial = None
+
+    window_size = win_min
+    if state is not None:
+        n_processed = state["n_processed"]
+        current_window = state["current_window"]
+        window_size = state["window_size"]
+        window_stats = state["window_stats"]
+        tiles_done = state["tiles_done"]
+        partial = state["partial"]
+        sim_mat.set_state(state["sim_mat"])
+        if clusters is not None:
+            clusters.set_state(state["clusters"])
+        if metrics is not None:
+            for result in window_stats:
+                metrics.observe(result)
+
+        for offset,size in state["blocks"]:
+            schedule.add_block(offset, size)
+            if cross_window:
+                packed_blocks.append(domains[offset:offset + size].pack())
+
+    # windows are runs of consecutive domain ids
+    ids = iter(range(n_processed, n))
+    window = SlidingWindow(ids, window_size, win_min, win_max)
+
+    last_checkpoint = time.perf_counter()
+
+    def write_checkpoint(tiles_done, partial):
+        """Save the loop state, mid-window if `tiles_done` is nonzero"""
+        nonlocal last_checkpoint
+        blocks = schedule.get_blocks()
+        save_checkpoint(checkpoint, {
+            "n": n,
+            "threshold": threshold,
+            "metric": metric,
+            "n_processed": n_processed,
+            "current_window": current_window,
+            "window_size": window.get_size(),
+            "controller": controller,
+            # the current window's block is added again on resume
+            "blocks": blocks[:-1] if tiles_done else blocks,
+            "window_stats": window_stats,
+            "tiles_done": tiles_done,
+            "partial": partial,
+            "sim_mat": sim_mat.get_state(),
+            "clusters": None if clusters is None else clusters.get_state(),
+        })
+        last_checkpoint = time.perf_counter()
+
+    def checkpoint_due():
+        return checkpoint is not None and \
+               time.perf_counter() - last_checkpoint >= checkpoint_interval
+
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        # === BEGIN WINDOW PROCESSING === #
+        while n_processed < n:
+            assert window.get_size() <= n, \
+                   "window length > # total domains: " \
+                   f"({window.get_size()} > {n})"
+
+            timer = PhaseTimer()
+            window_start = time.perf_counter()
+
+            # === GENERATE UNIQUE PAIRS ===
+            n_uniq = int(window.get_size() * (window.get_size() - 1) / 2)
+
+            window_ids = list(window.get_data())
+            window_data = domains[window_ids[0]:window_ids[-1] + 1]
+
+            # === PRUNE PAIRS THAT CANNOT PASS ===
+            # the length and character count filters run inside the kernels
+            # on every pair as it is scored, the q-gram count filter of
+            # `candidate_pairs` narrows the window's own pairs down first
+            # where it can rule any out
+            candidates = None
+            n_scored = np.zeros(1, dtype=np.int64)
+            if prune and q > 1 and \
+               (qgram_bound(window_data.lengths, threshold, q) > 0).any():
+                with timer.phase("prune"):
+                    candidates,_ = candidate_pairs(window_data, threshold, q)
+
+            # === SCORE PAIRS OF DOMAINS ===
+            tiles = schedule.add_block(n_processed, len(window_data))
+            if cross_window:
+                packed_blocks.append(window_data.pack())
+
+            # one lazy stream per tile, nothing is scored until it is consumed
+            tile_scores = [offset_blocks(
+                window_blocks(pool, window_data, threshold, chunk_size,
+                              backend, candidates, metric, prune, n_scored),
+                n_processed, n_processed)]
+
+            if cross_window:
+                col = tiles[0][1]
+                for row,_ in tiles[1:]:
+                    row_offset, row_size = schedule.get_blocks()[row]
+                    tile_scores.append(offset_blocks(
+                        tile_blocks(pool, packed_blocks[row],
+                                    packed_blocks[col], threshold, chunk_size,
+                                    backend, metric, prune, n_scored),
+                        row_offset, n_processed))
 
-    # === BEGIN WINDOW PROCESSING === #
-    while n_processed < n:
-        assert window.get_size() <= n, \
-               "window length > # total domains: " \
-               f"({window.get_size()} > {n})"
+                    n_uniq += row_size * len(window_data)
 
-        # === GENERATE UNIQUE PAIRS ===
-        n_uniq = int(window.get_size() * (window.get_size() - 1) / 2)
+            # === POPULATE SIMILARITY MATRIX AND COMPUTE STATS ===
+            # one pass over the scores feeds both, scoring is lazy and runs
+            # inside it, so phases are told apart by timing each stage's
+            # generator: stats = observe - score,
+            # matrix = fill - the last stage
+            stats = StatAccumulator(flags)
+            n_inserted = 0
+            if partial is not None:
+                # resumed mid-window, the completed tiles are not scored again
+                stats = partial["stats"]
+                n_inserted = partial["n_inserted"]
+                n_scored[0] = partial["n_scored"]
+                timer.times = dict(partial["phase_times"])
+                window_start -= partial["elapsed"]
+                partial = None
 
-        print(f"  Window {current_window}\n"
-              f"    Size: {window.get_size()} Domains\n"
-              f"    Unique Pairs: {n_uniq}")
+            last_phase = "observe" if clusters is None else "cluster"
+            for tile,blocks in enumerate(tile_scores):
+                if tile < tiles_done:
+                    continue
 
-        unique_pairs = combinations(window.get_data(), r=2)
+                scored = timer.timed("score", blocks)
+                observed = timer.timed("observe",
+                                       stats.observe_blocks(scored))
+                if clusters is not None:
+                    observed = timer.timed("cluster",
+                                           clusters.observe_blocks(observed))
+                with timer.phase("fill"):
+                    n_inserted += sim_mat.add_blocks(observed)
 
-        # === SCORE PAIRS OF DOMAINS ===
-        pair_scores = uniprocessed_work(edit_distance.score_pair, unique_pairs,
-                                        threshold)
+                if checkpoint_due():
+                    write_checkpoint(tile + 1, {
+                        "stats": stats,
+                        "n_inserted": n_inserted,
+                        "n_scored": int(n_scored[0]),
+                        "phase_times": dict(timer.times),
+                        "elapsed": time.perf_counter() - window_start,
+                    })
+            tiles_done = 0
 
-        # needed for both stats and similarity computations
-        scores_for_stats, scores_for_sim_mat = copy_generator(pair_scores)
+            elapsed = time.perf_counter() - window_start
+            controller.observe(n_uniq, elapsed)
 
-        # === COMPUTE STATS ===
-        start = time.process_time()
-        compute_stats(scores_for_stats, flags)
+            # === REPORT WINDOW ===
+            result = stats.result(domains)
+            result.window = current_window
+            result.offset = n_processed
+            result.size = window.get_size()
+            result.n_pairs = n_uniq
+            result.n_scored = int(n_scored[0])
+            result.n_pruned = n_uniq - result.n_scored
+            result.n_inserted = n_inserted
+            result.elapsed = round(elapsed, 3)
+            result.phase_times = {
+                "prune": timer.get("prune"),
+                "score": timer.get("score"),
+                "stats": timer.get("observe") - timer.get("score"),
+                "matrix": timer.get("fill") - timer.get(last_phase),
+            }
+            if clusters is not None:
+                result.phase_times["cluster"] = timer.get("cluster") \
+                                                - timer.get("observe")
+            window_stats.append(result)
+            if metrics is not None:
+                metrics.observe(result)
+            if reporter is not None:
+                reporter(result)
 
-        # === POPULATE SIMILARITY MATRIX ===
-        sim_mat = lil_matrix((n,n), dtype=np.float32)
-        for pair_score in scores_for_sim_mat:
-            pair,score = pair_score
-            x,y = (hash(pair[0]) % window.get_size()), \
-                  (hash(pair[1]) % window.get_size())
+            # === PREPARE NEXT WINDOW ===
+            n_processed += window.get_size()
+            current_window += 1
+            window.slide(ids, n, n_processed, elapsed, controller)
 
-            sim_mat[x + n_processed, y + n_processed] = score
+            if checkpoint_due() \
+               or (checkpoint is not None and n_processed >= n):
+                write_checkpoint(0, None)
+    finally:
+        if pool is not None:
+            # like `with Pool`, every block is consumed or of no use
+            pool.terminate()
+            pool.join()
 
-        elapsed = round(time.process_time() - start, 3)
+    if clusters is not None:
+        # domains without any kept pair are singletons
+        clusters.grow(n)
+        if inverse is not None:
+            clusters.expand(inverse)
 
-        # === PREPARE NEXT WINDOW ===
-        n_processed += window.get_size()
-        current_window += 1
-        print(f"    ttc: {elapsed}s")
-        window.slide(domains, n, n_processed, elapsed)
+    if sink is not None:
+        return sink.close(domains, inverse), window_stats
+    if inverse is not None:
+        return expand_duplicates(sim_mat.to_csr(), inverse), window_stats
 
-    return sim_mat
+    return sim_mat.to_csr(), window_stats
@@ -0,0 +1,340 @@
+"""Long-running scoring service for live domain feeds
+
+Domains arrive one per line over stdin or a local socket and are queued,
+grouped into batches and scored, within the batch and against a sliding
+window of the most recent domains. Matches above the threshold are written
+back as JSON lines to whoever sent the newer domain:
+
+    {"domain": "...", "match": "...", "score": 0.875}
+
+The queue is bounded, so a producer faster than the scorer is paused
+instead of buffering without limit. Scoring runs on a thread pool, the
+`edit_distance` kernels release the GIL, so the window is shared between
+workers instead of being shipped to other processes per batch.
+
+    > python win_service.py --threshold 0.8 < queries.log
+    > python win_service.py --socket /tmp/tbsp.sock
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import edit_distance
+from win_util import remove_tld
+
+class ScoringService:
+    """Batches incoming domains and scores them against a sliding window of
+    recent ones
+
+    The window is a ring buffer of packed domains (see
+    `edit_distance.pack_domains`), so admitting a batch is a copy into it
+    instead of a repack of the whole window. `sliding_window.SlidingWindow`
+    is not reused, it pulls disjoint windows off a finite corpus while this
+    one overlaps every batch with the `history` domains before it.
+    """
+    def __init__(self, threshold: float = 0.7, history: int = 100000,
+                 batch_size: int = 256, max_delay: float = 0.05,
+                 workers: int = None, queue_size: int = 4096,
+                 backend: int = edit_distance.BACKEND_BIT_PARALLEL,
+                 width: int = 256):
+        """Non-default constructor
+
+        Keyword Arguments:
+        threshold   -- minimum score to emit
+        history     -- number of recent domains new ones are scored against
+        batch_size  -- largest batch scored at once
+        max_delay   -- seconds the first domain of a batch may wait for more
+        workers     -- scoring threads, defaults to the CPU count
+        queue_size  -- domains queued before producers are paused
+        backend     -- `edit_distance` backend used to score pairs
+        width       -- longest accepted subdomain, longer ones are dropped
+        """
+        self.threshold = threshold
+        self.history = history
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.workers = workers or os.cpu_count() or 1
+        self.backend = backend
+        self.width = width
+
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.executor = ThreadPoolExecutor(self.workers)
+
+        # ring buffer of the window, domain number k lives in slot k % history
+        self.packed = np.zeros((history, width), dtype=np.uint8)
+        self.lengths = np.zeros(history, dtype=np.int32)
+        self.domains = [None] * history
+        self.n_seen = 0
+
+        self.n_matches = 0
+        self.n_dropped = 0
+
+        # domains queued and scored so far, connections wait on the latter
+        # before hanging up
+        self.n_queued = 0
+        self.n_scored = 0
+        self.scored = asyncio.Condition()
+        self.stopped = False
+
+    def get_window_size(self):
+        """Number of domains currently in the window"""
+        return min(self.n_seen, self.history)
+
+    async def submit(self, domain: bytes, reply):
+        """Queue a domain, waiting while the queue is full
+
+        Positional Arguments:
+        domain  -- raw domain, its TLD is stripped here
+        reply   -- coroutine function called with each match line (bytes)
+        """
+        domain = remove_tld(domain)
+        if not domain:
+            return
+        if len(domain) > self.width:
+            self.n_dropped += 1
+            return
+
+        await self.queue.put((domain, reply))
+        self.n_queued += 1
+
+    async def wait_scored(self, count: int):
+        """Wait until the first `count` queued domains are scored, or the
+        scorer stopped
+
+        Positional Arguments:
+        count   -- number of queued domains to wait for
+        """
+        async with self.scored:
+            await self.scored.wait_for(lambda: self.n_scored >= count
+                                               or self.stopped)
+
+    async def next_batch(self):
+        """Wait for a domain, then collect more until the batch is full or
+        `max_delay` has passed"""
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_delay
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(),
+                                                    timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    def window_segments(self):
+        """Contiguous (slot start, slot stop, first domain number) runs of
+        the ring buffer, oldest first"""
+        size = self.get_window_size()
+        first = self.n_seen - size
+        start = first % self.history
+
+        if start + size <= self.history:
+            return [(start, start + size, first)]
+
+        return [(start, self.history, first),
+                (0, start + size - self.history,
+                 first + self.history - start)]
+
+    async def score_batch(self, batch):
+        """Score a batch against the window and itself, then admit it
+
+        Positional Arguments:
+        batch -- list of (subdomain, reply)
+
+        Returns:
+        list of (batch position, matched subdomain, score)
+        """
+        loop = asyncio.get_running_loop()
+        packed, lengths = edit_distance.pack_domains(
+            [domain for domain,_ in batch])
+        batch_packed = np.zeros((len(batch), self.width), dtype=np.uint8)
+        batch_packed[:, :packed.shape[1]] = packed
+
+        # split the window across the workers, plus the batch itself
+        tasks = []
+        for start,stop,number in self.window_segments():
+            step = max(1, -(-(stop - start) // self.workers))
+            for lo in range(start, stop, step):
+                hi = min(stop, lo + step)
+                tasks.append((number + lo - start, loop.run_in_executor(
+                    self.executor, edit_distance.score_block, batch_packed,
+                    lengths, self.packed[lo:hi], self.lengths[lo:hi],
+                    self.threshold, self.backend)))
+        tasks.append((self.n_seen, loop.run_in_executor(
+            self.executor, edit_distance.score_block, batch_packed, lengths,
+            batch_packed, lengths, self.threshold, self.backend, True)))
+
+        matches = []
+        for number,task in tasks:
+            i, j, scores = await task
+            # the newer domain of an in-batch pair is the second one
+            if number == self.n_seen:
+                matches.extend((position, batch[other][0], score)
+                               for other,position,score
+                               in zip(i.tolist(), j.tolist(),
+                                      scores.tolist()))
+            else:
+                # resolved now, admitting the batch may overwrite the slot
+                matches.extend((position,
+                                self.domains[(number + other) % self.history],
+                                score)
+                               for position,other,score
+                               in zip(i.tolist(), j.tolist(),
+                                      scores.tolist()))
+
+        for position,(domain,_) in enumerate(batch):
+            slot = (self.n_seen + position) % self.history
+            self.packed[slot] = batch_packed[position]
+            self.lengths[slot] = lengths[position]
+            self.domains[slot] = domain
+        self.n_seen += len(batch)
+
+        return matches
+
+    async def run(self):
+        """Score batches as they come in, forever"""
+        try:
+            while True:
+                batch = await self.next_batch()
+                matches = await self.score_batch(batch)
+
+                for position,match,score in matches:
+                    domain, reply = batch[position]
+                    # feeds are not guaranteed to be UTF-8
+                    line = json.dumps({
+                        "domain": domain.decode(errors="replace"),
+                        "match": match.decode(errors="replace"),
+                        "score": round(score, 3),
+                    })
+                    try:
+                        await reply(line.encode() + b"\n")
+                    except (BrokenPipeError, ConnectionError):
+                        # the sender went away, keep serving everyone else
+                        pass
+                self.n_matches += len(matches)
+
+                for _ in batch:
+                    self.queue.task_done()
+                async with self.scored:
+                    self.n_scored += len(batch)
+                    self.scored.notify_all()
+        finally:
+            # wake connections waiting on batches that will not be scored
+            self.stopped = True
+            async with self.scored:
+                self.scored.notify_all()
+
+    async def serve_stream(self, reader, writer):
+        """Submit every line of a connection, replying on the same one
+
+        Positional Arguments:
+        reader  -- `asyncio.StreamReader` of domains
+        writer  -- `asyncio.StreamWriter` matches are written to
+        """
+        async def reply(line):
+            if not writer.is_closing():
+                writer.write(line)
+                await writer.drain()
+
+        try:
+            while line := await reader.readline():
+                await self.submit(line, reply)
+            # answer what this connection queued before hanging up
+            await self.wait_scored(self.n_queued)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    async def serve_stdin(self, infile=None, outfile=None):
+        """Submit every line of stdin, writing matches to stdout
+
+        Regular files are not supported by asyncio's pipe transports, so
+        lines are read in chunks on a helper thread instead.
+
+        Keyword Arguments:
+        infile  -- binary file to read, defaults to stdin
+        outfile -- binary file to write, defaults to stdout
+        """
+        infile = infile or sys.stdin.buffer
+        outfile = outfile or sys.stdout.buffer
+        loop = asyncio.get_running_loop()
+
+        async def reply(line):
+            outfile.write(line)
+
+        while lines := await loop.run_in_executor(None, infile.readlines,
+                                                  1 << 16):
+            for line in lines:
+                await self.submit(line, reply)
+
+        # input is exhausted, answer what is still queued
+        await self.queue.join()
+        outfile.flush()
+
+async def serve(service: ScoringService, socket_path: str = None):
+    """Run the service on stdin/stdout or on a unix socket
+
+    Positional Arguments:
+    service     -- the scoring service
+
+    Keyword Arguments:
+    socket_path -- unix socket to listen on, None reads stdin
+    """
+    scorer = asyncio.create_task(service.run())
+
+    server = None
+    if socket_path is None:
+        feeder = asyncio.create_task(service.serve_stdin())
+    else:
+        server = await asyncio.start_unix_server(service.serve_stream,
+                                                 path=socket_path)
+        feeder = asyncio.create_task(server.serve_forever())
+
+    # the scorer only returns by failing, so whichever task finishes first
+    # ends the service and a failure is raised instead of waited on
+    done,_ = await asyncio.wait((scorer, feeder),
+                                return_when=asyncio.FIRST_COMPLETED)
+    for task in (scorer, feeder):
+        if task not in done:
+            task.cancel()
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+
+    for task in done:
+        task.result()
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket", help="unix socket to listen on, "
+                                         "stdin/stdout if omitted")
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--history", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--max-delay", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    async def run():
+        service = ScoringService(args.threshold, args.history,
+                                 args.batch_size, args.max_delay,
+                                 args.workers)
+        await serve(service, args.socket)
+
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 """Statistic computation module"""
 
+from dataclasses import asdict, dataclass, field
 from types import GeneratorType
 from enum import Enum
+import heapq
+import json
+from math import sqrt
 from statistics import fmean, stdev
 
 import numpy as np
@@ -14,78 +18,312 @@ class StatType(Enum):
     MIN = 8
     STD_DEV = 16
 
-def compute_stats(pair_scores: GeneratorType, flags: int) -> None:
-    """Compute a variety of statistics (see above for supported flags)
+class StatAccumulator:
+    """Single pass statistics over a stream of pair scores
 
-    PositionalArguments:
-    pair_scores -- unique pairs of a window with respective scores
-    flags -- bit mask of desired statistics to compute
+    Keeps a running count, Welford mean/variance, min, max and a bounded
+    min-heap of the top k pairs, so memory is O(k) regardless of the number of
+    pairs seen.
+    """
+    def __init__(self, flags: int, k: int = 5):
+        """Non-default constructor
+
+        Positional Arguments:
+        flags -- bit mask of desired statistics to compute
+
+        Keyword Arguments:
+        k     -- number of top scoring pairs to keep
+        """
+        self.flags = flags
+        self.k = k
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.top_k = []
+
+    def update(self, pair, score):
+        """Account for one scored pair
+
+        Positional Arguments:
+        pair  -- pair of domains (or of window indices)
+        score -- similarity of the pair
+        """
+        self.count += 1
+
+        delta = score - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (score - self.mean)
+
+        if self.min is None or score < self.min[1]:
+            self.min = (pair, score)
+        if self.max is None or score > self.max[1]:
+            self.max = (pair, score)
+
+        if self.flags & StatType.TOP_K.value != 0:
+            # `count` breaks ties so pairs are never compared
+            entry = (score, self.count, pair)
+            if len(self.top_k) < self.k:
+                heapq.heappush(self.top_k, entry)
+            elif score > self.top_k[0][0]:
+                heapq.heapreplace(self.top_k, entry)
+
+    def update_block(self, rows, cols, scores):
+        """Account for a block of scored pairs given as arrays, with the same
+        result as calling `update` on each pair in turn
+
+        Positional Arguments:
+        rows    -- first index of every pair
+        cols    -- second index of every pair
+        scores  -- similarity of every pair
+        """
+        scores = np.asarray(scores, dtype=np.float64)
+        count = len(scores)
+        if count == 0:
+            return
+
+        def pair(index):
+            return (int(rows[index]), int(cols[index]))
+
+        # Chan et al. merge of the block's mean and squared deviations
+        block_mean = float(scores.mean())
+        block_m2 = float(((scores - block_mean) ** 2).sum())
+        total = self.count + count
+        delta = block_mean - self.mean
+        self.m2 += block_m2 + delta * delta * self.count * count / total
+        self.mean += delta * count / total
+        first = self.count
+        self.count = total
+
+        # argmin/argmax pick the first of equal scores, like `update`
+        low = int(scores.argmin())
+        if self.min is None or scores[low] < self.min[1]:
+            self.min = (pair(low), float(scores[low]))
+        high = int(scores.argmax())
+        if self.max is None or scores[high] > self.max[1]:
+            self.max = (pair(high), float(scores[high]))
+
+        if self.flags & StatType.TOP_K.value != 0:
+            # only the block's k best (earliest first among ties) can enter
+            best = np.sort(np.argsort(-scores, kind="stable")[:self.k])
+            for index in best.tolist():
+                score = float(scores[index])
+                entry = (score, first + index + 1, pair(index))
+                if len(self.top_k) < self.k:
+                    heapq.heappush(self.top_k, entry)
+                elif score > self.top_k[0][0]:
+                    heapq.heapreplace(self.top_k, entry)
+
+    def observe_blocks(self, blocks):
+        """Account for a stream of (i, j, score) array blocks while passing
+        it through
+
+        Positional Arguments:
+        blocks -- (i, j, score) arrays, see `update_block`
+
+        Returns:
+        Generator over `blocks`
+        """
+        for block in blocks:
+            self.update_block(*block)
+            yield block
+
+    def observe(self, pair_scores):
+        """Account for a stream of scored pairs while passing it through
+
+        Positional Arguments:
+        pair_scores -- pairs with respective scores
+
+        Returns:
+        Generator over `pair_scores`
+        """
+        for pair_score in pair_scores:
+            self.update(*pair_score)
+            yield pair_score
+
+    def variance(self):
+        """Sample variance of the scores seen so far"""
+        return self.m2 / (self.count - 1)
+
+    def result(self, data=None):
+        """Collect the requested statistics into a `WindowStats` record
+
+        Keyword Arguments:
+        data -- window of subdomains, if given pairs are indices into it
+
+        Returns:
+        `WindowStats` with the statistics of `flags` filled in
+        """
+        def name(pair):
+            if data is None:
+                return pair
+            return (data[pair[0]], data[pair[1]])
+
+        stats = WindowStats(flags=self.flags, k=self.k, n_kept=self.count)
+
+        if self.flags & StatType.TOP_K.value != 0:
+            stats.top_k = [(name(pair), score)
+                           for score,_,pair in sorted(self.top_k)]
+        if self.flags & StatType.MAX.value != 0 and self.count > 0:
+            stats.max = (name(self.max[0]), self.max[1])
+        if self.flags & StatType.MIN.value != 0 and self.count > 0:
+            stats.min = (name(self.min[0]), self.min[1])
+        if self.flags & StatType.STD_DEV.value != 0 and self.count > 1:
+            stats.std_dev = sqrt(self.variance())
+        if self.flags & StatType.MEAN.value != 0 and self.count > 0:
+            stats.mean = self.mean
+
+        return stats
+
+@dataclass
+class WindowStats:
+    """Statistics of one processed window
+
+    Pairs are kept as pairs of subdomains (bytes) and only decoded by the
+    reporters. Statistics that were not requested or could not be computed
+    are None.
     """
-    pair_score_index = {idx:(ps[0], round(ps[1], 3))
-                        for idx,ps in enumerate(pair_scores)}
+    flags: int = 0
+    window: int = 0
+    offset: int = 0
+    size: int = 0
+    n_pairs: int = 0
+    n_pruned: int = 0
+    n_scored: int = 0
+    n_kept: int = 0
+    n_inserted: int = 0
+    elapsed: float = 0.0
+    phase_times: dict = field(default_factory=dict)
+    k: int = 5
+    top_k: list = field(default_factory=list)
+    max: tuple = None
+    min: tuple = None
+    mean: float = None
+    std_dev: float = None
+
+    def to_dict(self):
+        """JSON serializable view of the record"""
+        def decode(pair_score):
+            if pair_score is None:
+                return None
+            pair,score = pair_score
+            return [pair[0].decode(), pair[1].decode(), round(score, 3)]
+
+        record = asdict(self)
+        record["top_k"] = [decode(pair_score) for pair_score in self.top_k]
+        record["max"] = decode(self.max)
+        record["min"] = decode(self.min)
+        record["pairs_per_sec"] = self.n_scored / self.elapsed \
+                                  if self.elapsed > 0 else None
+
+        return record
 
-    scores = [pair[1] for pair in pair_score_index.values()]
-    len_scores = len(scores)
+class Metrics:
+    """Counters and phase times accumulated over every processed window
 
-    if flags & StatType.TOP_K.value != 0:
-        locs = win_top_k(scores)
+    Fed once per window from its `WindowStats`, so keeping it costs nothing
+    on the scoring hot path. Hand it to `win_proc.process_windows` as
+    `metrics`, or call `observe` from a reporter.
+    """
+    COUNTERS = ("windows", "generated", "pruned", "scored", "kept",
+                "inserted")
+
+    def __init__(self):
+        """Default constructor"""
+        self.counters = dict.fromkeys(Metrics.COUNTERS, 0)
+        self.phase_times = {}
+        self.elapsed = 0.0
+
+    def observe(self, stats: WindowStats):
+        """Account a processed window
+
+        Positional Arguments:
+        stats -- statistics of the window
+        """
+        self.counters["windows"] += 1
+        self.counters["generated"] += stats.n_pairs
+        self.counters["pruned"] += stats.n_pruned
+        self.counters["scored"] += stats.n_scored
+        self.counters["kept"] += stats.n_kept
+        self.counters["inserted"] += stats.n_inserted
+        self.elapsed += stats.elapsed
+        for phase,seconds in stats.phase_times.items():
+            self.phase_times[phase] = self.phase_times.get(phase, 0.0) \
+                                      + seconds
+
+    def get(self, counter: str):
+        """Getter
+
+        Positional Arguments:
+        counter -- one of `Metrics.COUNTERS`
+        """
+        return self.counters[counter]
+
+    def to_dict(self):
+        """JSON serializable view of the metrics"""
+        record = dict(self.counters)
+        record["elapsed"] = self.elapsed
+        record["phase_times"] = dict(self.phase_times)
+        record["pairs_per_sec"] = self.counters["scored"] / self.elapsed \
+                                  if self.elapsed > 0 else None
+
+        return record
+
+def print_stats(stats: WindowStats):
+    """Console reporter for `WindowStats`
+
+    Positional Arguments:
+    stats -- statistics of a window
+    """
+    print(f"  Window {stats.window}\n"
+          f"    Size: {stats.size} Domains\n"
+          f"    Unique Pairs: {stats.n_pairs}\n"
+          f"    Pruned Pairs: {stats.n_pruned}\n"
+          f"    Scored Pairs: {stats.n_scored}")
+
+    if stats.flags & StatType.TOP_K.value != 0:
         max_len = 0
-        for loc in locs:
-            pair,_ = pair_score_index[loc]
+        for pair,_ in stats.top_k:
             max_pair_len = max(len(pair[0]), len(pair[1]))
             if max_pair_len > max_len:
                 max_len = max_pair_len
 
-        print("    Top 5 Scores:")
-        for loc in locs:
-            pair,score = pair_score_index[loc]
+        print(f"    Top {stats.k} Scores:")
+        for pair,score in stats.top_k:
             print("      - {:{}} | {:{}} | {:.3f}".format(pair[0].decode(),
                                                      max_len,
                                                      pair[1].decode(),
                                                      max_len,
                                                      score))
 
-    if flags & StatType.MAX.value != 0:
-        if len_scores == 0:
+    if stats.flags & StatType.MAX.value != 0:
+        if stats.max is None:
             print("\x1b[33m+")
             print("| Warning: `max` stat not computed. Either the\n"
                   "| current window is empty or the threshold filtered\n"
                   "| all scores")
             print("+\x1b[0m")
-        elif len_scores == 1:
-            print("    Max Score:")
-            pair,score = pair_score_index[0]
-            print("      - {} | {} | {:.3f}".format(pair[0].decode(),
-                                                    pair[1].decode(),
-                                                    score))
         else:
             print("    Max Score:")
-            loc = win_max(scores)
-            pair,score = pair_score_index[loc]
+            pair,score = stats.max
             print("      - {} | {} | {:.3f}".format(pair[0].decode(),
                                                     pair[1].decode(),
                                                     score))
-    if flags & StatType.MIN.value != 0:
-        if len_scores == 0:
+    if stats.flags & StatType.MIN.value != 0:
+        if stats.min is None:
             print("\x1b[33m+")
             print("| Warning: `min` stat not computed. Either the current\n"
                   "| window is empty or the threshold filtered all scores")
             print("+\x1b[0m")
-        elif len_scores == 1:
-            print("    Min Score:")
-            pair,score = pair_score_index[0]
-            print("      - {} | {} | {:.3f}".format(pair[0].decode(),
-                                                    pair[1].decode(),
-                                                    score))
         else:
             print("    Min Score:")
-            loc = win_min(scores)
-            pair,score = pair_score_index[loc]
+            pair,score = stats.min
             print("      - {} | {} | {:.3f}".format(pair[0].decode(),
                                                     pair[1].decode(),
                                                     score))
-    if flags & StatType.STD_DEV.value != 0:
-        if len_scores < 2:
+    if stats.flags & StatType.STD_DEV.value != 0:
+        if stats.std_dev is None:
             print("\x1b[33m+")
             print("| Warning: `std_dev` stat not computed. Either the\n"
                   "| current window is empty or the threshold\n"
@@ -93,10 +331,10 @@ def compute_stats(pair_scores: GeneratorType, flags: int) -> None:
             print("+\x1b[0m")
         else:
             print("    Standard Deviation:")
-            print("      - {:.3f}".format(win_std_dev(scores)))
+            print("      - {:.3f}".format(stats.std_dev))
 
-    if flags & StatType.MEAN.value != 0:
-        if len_scores < 1:
+    if stats.flags & StatType.MEAN.value != 0:
+        if stats.mean is None:
             print("\x1b[33m+")
             print("| Warning: `mean` stat not computed. Either the\n"
                   "| current window is empty or the threshold filtered\n"
@@ -104,7 +342,50 @@ def compute_stats(pair_scores: GeneratorType, flags: int) -> None:
             print("+\x1b[0m")
         else:
             print("    Mean Score:")
-            print("      - {:.3f}".format(win_mean(scores)))
+            print("      - {:.3f}".format(stats.mean))
+
+    print(f"    ttc: {stats.elapsed}s")
+
+class JsonLinesReporter:
+    """Reporter writing one JSON object per window, e.g. for tracking window
+    throughput over time"""
+    def __init__(self, outfile):
+        """Non-default constructor
+
+        Positional Arguments:
+        outfile -- writable text file object
+        """
+        self.outfile = outfile
+
+    def __call__(self, stats: WindowStats):
+        """Write `stats` as a single line of JSON"""
+        self.outfile.write(json.dumps(stats.to_dict()) + "\n")
+        self.outfile.flush()
+
+def compute_stats(pair_scores: GeneratorType, flags: int,
+                  reporter=None) -> WindowStats:
+    """Compute a variety of statistics (see above for supported flags)
+
+    PositionalArguments:
+    pair_scores -- unique pairs of a window with respective scores
+    flags -- bit mask of desired statistics to compute
+
+    Keyword Arguments:
+    reporter -- callable handed the resulting `WindowStats`, e.g.
+                `print_stats`
+
+    Returns:
+    `WindowStats` of the pairs
+    """
+    stats = StatAccumulator(flags)
+    for pair,score in pair_scores:
+        stats.update(pair, round(score, 3))
+
+    result = stats.result()
+    if reporter is not None:
+        reporter(result)
+
+    return result
 
 def win_top_k(scores, k: int=5):
     """top k scores from window"""
@@ -0,0 +1,322 @@
+"""Out-of-core similarity matrix storage
+
+Above-threshold (i, j, score) triplets are streamed to a directory of
+memory-mappable `.npy` shards instead of being accumulated in memory:
+
+    manifest.json       -- matrix dimension and the row range of every shard
+    domains.buffer.npy  -- concatenated subdomains, the domain index
+    domains.offsets.npy -- subdomain i is buffer[offsets[i]:offsets[i + 1]]
+    shard_NNNNN.{rows,cols,data}.npy -- triplets of one shard, by (row, col)
+
+Shards are sorted when written, so a row range is a binary search and a
+contiguous slice of every overlapping shard.
+"""
+
+import json
+import os
+
+import numpy as np
+from scipy.sparse import coo_matrix
+
+from win_domains import as_store
+from win_matrix import duplicate_triplets, expand_triplets
+
+MANIFEST = "manifest.json"
+
+def _shard_path(path, name, array):
+    """Path of one array of a shard"""
+    return os.path.join(path, f"{name}.{array}.npy")
+
+class ShardWriter:
+    """Streams triplets to sorted on-disk shards
+
+    Has the `extend`/`add_pairs`/`add_blocks` interface of
+    `win_matrix.MatrixBuilder`, so it can stand in for it as the sink of
+    `win_proc.process_windows`.
+    """
+    def __init__(self, path, n, shard_size=1 << 22):
+        """Non-default constructor
+
+        Positional Arguments:
+        path        -- output directory, created if needed
+        n           -- total number of domains (matrix dimension)
+
+        Keyword Arguments:
+        shard_size  -- triplets buffered in memory before a shard is written
+        """
+        self.path = path
+        self.n = n
+        self.shard_size = max(1, shard_size)
+        self.size = 0
+        self.shards = []
+        self.next_shard = 0
+        self.pending = []
+        self.n_pending = 0
+
+        os.makedirs(path, exist_ok=True)
+
+    def get_size(self):
+        """Getter"""
+        return self.size
+
+    def extend(self, rows, cols, scores):
+        """Append triplets given as equally long arrays
+
+        Positional Arguments:
+        rows    -- global row indices
+        cols    -- global column indices
+        scores  -- similarity scores
+        """
+        count = len(scores)
+        if count == 0:
+            return
+
+        self.pending.append((np.asarray(rows, dtype=np.int64),
+                             np.asarray(cols, dtype=np.int64),
+                             np.asarray(scores, dtype=np.float32)))
+        self.size += count
+        self.n_pending += count
+        if self.n_pending >= self.shard_size:
+            self.flush()
+
+    def add_pairs(self, pair_scores, offset=0):
+        """Append a stream of window index pairs and scores
+
+        Positional Arguments:
+        pair_scores -- ((i, j), score) with indices local to a window
+
+        Keyword Arguments:
+        offset      -- global index of the window's first domain
+
+        Returns:
+        number of triplets added
+        """
+        rows = []
+        cols = []
+        scores = []
+        for (i,j),score in pair_scores:
+            rows.append(i)
+            cols.append(j)
+            scores.append(score)
+
+        self.extend(np.asarray(rows, dtype=np.int64) + offset,
+                    np.asarray(cols, dtype=np.int64) + offset, scores)
+
+        return len(scores)
+
+    def flush(self):
+        """Write the buffered triplets as one shard"""
+        if self.n_pending == 0:
+            return
+
+        rows, cols, data = (np.concatenate(arrays)
+                            for arrays in zip(*self.pending))
+        self.pending = []
+        self.n_pending = 0
+
+        order = np.lexsort((cols, rows))
+        name = f"shard_{self.next_shard:05d}"
+        self.next_shard += 1
+        index_dtype = np.int32 if self.n <= np.iinfo(np.int32).max \
+                      else np.int64
+        np.save(_shard_path(self.path, name, "rows"),
+                rows[order].astype(index_dtype))
+        np.save(_shard_path(self.path, name, "cols"),
+                cols[order].astype(index_dtype))
+        np.save(_shard_path(self.path, name, "data"), data[order])
+
+        self.shards.append({"name": name, "size": len(order),
+                            "row_min": int(rows[order[0]]),
+                            "row_max": int(rows[order[-1]])})
+
+    def add_blocks(self, blocks, offset=0):
+        """Append a stream of (i, j, score) array blocks
+
+        Positional Arguments:
+        blocks      -- (i, j, score) arrays with indices local to a window
+
+        Keyword Arguments:
+        offset      -- global index of the window's first domain
+
+        Returns:
+        number of triplets added
+        """
+        count = 0
+        for i,j,scores in blocks:
+            self.extend(i + offset, j + offset, scores)
+            count += len(scores)
+
+        return count
+
+    def get_state(self):
+        """Shards written so far, for checkpoints (see `set_state`)
+
+        Buffered triplets are flushed first, so the state is a few counters
+        and the shard list, not the triplets themselves.
+        """
+        self.flush()
+        return {"n": self.n, "size": self.size,
+                "shards": [dict(shard) for shard in self.shards],
+                "next_shard": self.next_shard}
+
+    def set_state(self, state):
+        """Continue from the shards of `get_state`, shards written after it
+        are overwritten
+
+        Positional Arguments:
+        state -- dict returned by `get_state`
+        """
+        self.n = state["n"]
+        self.size = state["size"]
+        self.shards = [dict(shard) for shard in state["shards"]]
+        self.next_shard = state["next_shard"]
+        self.pending = []
+        self.n_pending = 0
+
+    def close(self, domains, inverse=None):
+        """Write the last shard, the domain index and the manifest
+
+        Positional Arguments:
+        domains -- subdomains the triplet indices refer to, a
+                   `win_domains.DomainStore` or a sequence of bytes
+
+        Keyword Arguments:
+        inverse -- representative index of every original domain (see
+                   `win_domains.DomainStore.dedup`), the shards are then
+                   rewritten over the original domains with every duplicate
+                   filled in
+
+        Returns:
+        `ShardedMatrix` reading the written matrix
+        """
+        self.flush()
+
+        domains = as_store(domains)
+        if inverse is not None:
+            self._expand(inverse)
+            domains = domains.take(inverse)
+
+        buffer, offsets = domains.to_offsets()
+        np.save(os.path.join(self.path, "domains.buffer.npy"), buffer)
+        np.save(os.path.join(self.path, "domains.offsets.npy"), offsets)
+
+        # the manifest goes last, a directory without one is incomplete
+        tmp_path = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as outfile:
+            json.dump({"n": self.n, "size": self.size,
+                       "shards": self.shards}, outfile)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+
+        return ShardedMatrix(self.path)
+
+    def _expand(self, inverse):
+        """Rewrite the shards written so far over the original domains"""
+        unique_shards = self.shards
+        self.shards = []
+        self.size = 0
+        self.n = len(inverse)
+
+        # shard by shard, so only one unique shard is in memory at a time
+        for shard in unique_shards:
+            arrays = [np.load(_shard_path(self.path, shard["name"], array))
+                      for array in ("rows", "cols", "data")]
+            for name in ("rows", "cols", "data"):
+                os.unlink(_shard_path(self.path, shard["name"], name))
+            self.extend(*expand_triplets(*arrays, inverse))
+        self.extend(*duplicate_triplets(inverse))
+        self.flush()
+
+class ShardedMatrix:
+    """Lazy reader of a matrix written by `ShardWriter`
+
+    Shards are memory-mapped, only the slices a query touches are read.
+    """
+    def __init__(self, path):
+        """Non-default constructor
+
+        Positional Arguments:
+        path -- directory written by `ShardWriter.close`
+        """
+        self.path = path
+        with open(os.path.join(path, MANIFEST), encoding="utf-8") as infile:
+            manifest = json.load(infile)
+
+        self.n = manifest["n"]
+        self.nnz = manifest["size"]
+        self.shards = manifest["shards"]
+        self.shape = (self.n, self.n)
+
+        self.buffer = np.load(os.path.join(path, "domains.buffer.npy"),
+                              mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "domains.offsets.npy"),
+                               mmap_mode="r")
+
+    def get_domain(self, index: int):
+        """Getter
+
+        Positional Arguments:
+        index -- domain index
+        """
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]] \
+                   .tobytes()
+
+    def _arrays(self, shard):
+        """Memory-mapped (rows, cols, data) of a shard"""
+        return tuple(np.load(_shard_path(self.path, shard["name"], array),
+                             mmap_mode="r")
+                     for array in ("rows", "cols", "data"))
+
+    def triplets(self, start: int = 0, stop: int = None):
+        """(i, j, score) arrays of the rows in [start, stop)
+
+        Keyword Arguments:
+        start   -- first row
+        stop    -- row after the last, None reads to the end
+        """
+        stop = self.n if stop is None else stop
+        parts = []
+        for shard in self.shards:
+            if shard["row_max"] < start or shard["row_min"] >= stop:
+                continue
+            rows, cols, data = self._arrays(shard)
+            lo, hi = np.searchsorted(rows, [start, stop])
+            parts.append((np.asarray(rows[lo:hi], dtype=np.int64),
+                          np.asarray(cols[lo:hi], dtype=np.int64),
+                          np.asarray(data[lo:hi])))
+
+        if not parts:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                    np.empty(0, dtype=np.float32))
+
+        return tuple(np.concatenate(arrays) for arrays in zip(*parts))
+
+    def iter_triplets(self):
+        """Yield the (i, j, score) arrays of every shard in turn"""
+        for shard in self.shards:
+            rows, cols, data = self._arrays(shard)
+            yield (np.asarray(rows, dtype=np.int64),
+                   np.asarray(cols, dtype=np.int64), np.asarray(data))
+
+    def rows(self, start: int, stop: int):
+        """Rows [start, stop) as a `scipy.sparse.csr_matrix` of shape
+        (stop - start, n)
+        """
+        i, j, data = self.triplets(start, stop)
+        return coo_matrix((data, (i - start, j)),
+                          shape=(stop - start, self.n)).tocsr()
+
+    def block(self, row_start: int, row_stop: int, col_start: int,
+              col_stop: int):
+        """Block [row_start, row_stop) x [col_start, col_stop) as a
+        `scipy.sparse.csr_matrix`
+        """
+        i, j, data = self.triplets(row_start, row_stop)
+        keep = (j >= col_start) & (j < col_stop)
+        return coo_matrix((data[keep], (i[keep] - row_start,
+                                        j[keep] - col_start)),
+                          shape=(row_stop - row_start,
+                                 col_stop - col_start)).tocsr()
+
+    def to_csr(self):
+        """Load the whole matrix, only for matrices that fit in memory"""
+        return self.rows(0, self.n)
@@ -1,31 +1,30 @@
 """Various helper functions for topk computation"""
 
+from contextlib import contextmanager
+import cProfile
+import io
+import mmap
+import os
+import pstats
 import sys
+import time
 
 from math import tanh
 
-def remove_tld(d: str) -> str:
+import numpy as np
+
+def remove_tld(d):
     """Remove the TLD from a domain
 
     Positional Arguments:
-    d -- domain to be stripped
+    d -- domain to be stripped (str or bytes), surrounding whitespace and the
+         line terminator are dropped as well
     """
-    d_len = len(d)
-
-    r = d_len - 1
-    sub_d = list(d)
-
-    try:
-        while d[r] != ".":
-            sub_d.pop()
-            r -= 1
-
-        sub_d.pop() # for that pesky period
-    except IndexError:
-        # input does not have '.' and len > 0, so return as is
-        return d.strip()
+    d = d.strip()
+    dot = d.rfind(b"." if isinstance(d, bytes) else ".")
 
-    return "".join(sub_d)
+    # input without '.' is returned as is
+    return d if dot == -1 else d[:dot]
 
 def fetch_lines(file_path: str):
     """Read a file line by line
@@ -36,9 +35,162 @@ def fetch_lines(file_path: str):
     Returns:
     Generator of a files' lines
     """
-    with open(file_path, mode="r", encoding="utf-8") as infile:
+    with open(file_path, mode="rb") as infile:
         for line in infile:
-            yield remove_tld(line).encode("utf-8")
+            yield remove_tld(line)
+
+def load_public_suffixes(file_path: str):
+    """Read public suffixes, e.g. from the Public Suffix List
+
+    Comments, wildcard (`*.`) and exception (`!`) rules are skipped.
+
+    Positional Arguments:
+    file_path -- path to a file with one suffix per line
+
+    Returns:
+    set of suffixes as bytes, without leading period
+    """
+    suffixes = set()
+    with open(file_path, mode="rb") as infile:
+        for line in infile:
+            line = line.strip()
+            if not line or line.startswith((b"//", b"*", b"!")):
+                continue
+            suffixes.add(line.lower())
+
+    return suffixes
+
+def _suffix_starts(buf, dots, starts, ends, suffixes):
+    """Find where the longest multi-label public suffix of each line starts
+
+    Positional Arguments:
+    buf         -- raw file buffer
+    dots        -- sorted positions of every '.' in `buf`
+    starts      -- line start offsets
+    ends        -- line end offsets (exclusive)
+    suffixes    -- set of public suffixes (bytes)
+
+    Returns:
+    array of the '.' position preceding each line's matched suffix, -1 where
+    no multi-label suffix matched
+    """
+    cut = np.full(len(starts), -1, dtype=np.int64)
+
+    # group the suffixes by (labels, length) to compare them in bulk
+    groups = {}
+    for suffix in suffixes:
+        labels = suffix.count(b".") + 1
+        if labels > 1:
+            groups.setdefault((labels, len(suffix)), []).append(suffix)
+
+    last_dot = np.searchsorted(dots, ends) - 1
+    # longest suffixes first, so they win over their own tails
+    for labels,length in sorted(groups, reverse=True):
+        idx = last_dot - (labels - 1)
+        lines = np.flatnonzero((idx >= 0) & (cut < 0))
+        if len(lines) == 0:
+            continue
+        dot = dots[np.maximum(idx[lines], 0)]
+        fits = (dot >= starts[lines]) & (ends[lines] - dot - 1 == length)
+        lines = lines[fits]
+        dot = dot[fits]
+        if len(lines) == 0:
+            continue
+
+        labels_bytes = buf[dot[:, None] + 1 + np.arange(length)]
+        found = np.isin(labels_bytes.view(f"S{length}").ravel(),
+                        np.array(groups[(labels, length)], dtype=f"S{length}"))
+        cut[lines[found]] = dot[found]
+
+    return cut
+
+def load_domains(file_path: str, public_suffixes=None):
+    """Bulk load a domain file without building per-line Python objects
+
+    The file is memory-mapped and line and TLD boundaries are found with
+    NumPy over the raw buffer. Line terminators (including `\\r\\n`) and
+    surrounding blanks are dropped, lines are otherwise kept as-is (lower
+    casing is up to the feed).
+
+    Positional Arguments:
+    file_path       -- path to file to be read
+
+    Keyword Arguments:
+    public_suffixes -- set of public suffixes (see `load_public_suffixes`),
+                       a line ending in one of them loses the whole suffix
+                       (e.g. `co.uk`) instead of only its last label
+
+    Returns:
+    (`uint8` array of the concatenated subdomains, `int64` array of offsets
+    where subdomain i is buffer[offsets[i]:offsets[i + 1]])
+    """
+    with open(file_path, mode="rb") as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return np.empty(0, dtype=np.uint8), np.zeros(1, dtype=np.int64)
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            buf = np.frombuffer(mapped, dtype=np.uint8)
+            try:
+                result = _split_domains(buf, public_suffixes)
+            finally:
+                # the mapping cannot close while a view of it is alive
+                del buf
+
+    return result
+
+def _split_domains(buf, public_suffixes):
+    """Find subdomain boundaries in a raw buffer, see `load_domains`"""
+    # === LINE BOUNDARIES ===
+    ends = np.flatnonzero(buf == ord("\n"))
+    if len(buf) > 0 and buf[-1] != ord("\n"):
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate(([0], ends[:-1] + 1)).astype(np.int64)
+
+    # trim blanks (incl. '\r') at both ends of every line, most lines have
+    # none so this only loops over the few that do
+    blanks = np.frombuffer(b" \t\r\v\f", dtype=np.uint8)
+    lines = np.flatnonzero(ends > starts)
+    while len(lines) > 0:
+        lines = lines[np.isin(buf[ends[lines] - 1], blanks)]
+        ends[lines] -= 1
+        lines = lines[ends[lines] > starts[lines]]
+    lines = np.flatnonzero(ends > starts)
+    while len(lines) > 0:
+        lines = lines[np.isin(buf[starts[lines]], blanks)]
+        starts[lines] += 1
+        lines = lines[ends[lines] > starts[lines]]
+
+    # === TLD BOUNDARIES ===
+    dots = np.flatnonzero(buf == ord("."))
+    last_dot = np.searchsorted(dots, ends) - 1
+    cut = np.append(dots, -1)[last_dot]
+    cut = np.where(cut >= starts, cut, ends)
+
+    if public_suffixes:
+        suffix_cut = _suffix_starts(buf, dots, starts, ends, public_suffixes)
+        cut = np.where(suffix_cut >= 0, suffix_cut, cut)
+    ends = cut
+
+    # === PACK ===
+    lengths = ends - starts
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    gather = np.arange(offsets[-1], dtype=np.int64) \
+             + np.repeat(starts - offsets[:-1], lengths)
+
+    return buf[gather], offsets
+
+def iter_domains(buffer, offsets):
+    """Yield the subdomains of a `load_domains` buffer as bytes
+
+    Positional Arguments:
+    buffer  -- concatenated subdomains
+    offsets -- subdomain offsets into `buffer`
+
+    Returns:
+    Generator of subdomains
+    """
+    raw = buffer.tobytes()
+    for start,end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        yield raw[start:end]
 
 def is_iterable(iterable):
     """Check whether a sequence of data can be iterated
@@ -69,14 +221,19 @@ def take(iterable, size):
         print("passed object is not iterable. Aborting...")
         sys.exit(1)
 
+    if size <= 0:
+        return
+
+    # stop right after the last item, pulling one more would drop it from a
+    # shared iterator
     cnt = 0
     for elem in iterable:
-        if cnt == size:
-            break
-
         yield elem
         cnt += 1
 
+        if cnt == size:
+            break
+
 def modified_tanh(k, x, c):
     """Modified Hyperbolic Tangent Function to best adapt to all response
     times
@@ -91,3 +248,87 @@ def modified_tanh(k, x, c):
     scale to be applied to next window size
     """
     return tanh(-k * (x - c))
+
+class PhaseTimer:
+    """Accumulates wall-clock time per named phase of a window"""
+    def __init__(self):
+        """Default constructor"""
+        self.times = {}
+
+    def add(self, phase, seconds):
+        """Account `seconds` to `phase`"""
+        self.times[phase] = self.times.get(phase, 0.0) + seconds
+
+    def get(self, phase):
+        """Total seconds spent in `phase` so far"""
+        return self.times.get(phase, 0.0)
+
+    def reset(self):
+        """Forget all recorded times"""
+        self.times = {}
+
+    @contextmanager
+    def phase(self, phase):
+        """Time the body of a `with` statement
+
+        Positional Arguments:
+        phase -- name to account the time to
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    def timed(self, phase, iterable):
+        """Time the work done by a lazy iterable, i.e. only the time spent
+        producing its items, not the time its consumer spends on them
+
+        Positional Arguments:
+        phase       -- name to account the time to
+        iterable    -- iterable to pass through
+
+        Returns:
+        Generator over `iterable`
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(phase, time.perf_counter() - start)
+                return
+            self.add(phase, time.perf_counter() - start)
+            yield item
+
+@contextmanager
+def profiled(outfile=None, sort: str = "cumulative", limit: int = 25):
+    """Run the body of a `with` statement under cProfile
+
+    The Cython kernels only show up as their own entries when the extension
+    was built with profiling hooks (`TBSP_PROFILE=1 python setup.py`, see
+    `edit_distance.PROFILED`), otherwise their time is folded into callers.
+
+    Keyword Arguments:
+    outfile -- path to dump the raw stats to (for `pstats`/snakeviz), None
+               prints the top entries instead
+    sort    -- `pstats` sort key of the printed entries
+    limit   -- number of printed entries
+
+    Returns:
+    the `cProfile.Profile`, enabled for the duration of the body
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if outfile is not None:
+            profiler.dump_stats(outfile)
+        else:
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats(sort) \
+                                                 .print_stats(limit)
+            print(report.getvalue())
@@ -0,0 +1,101 @@
+"""Bounded-memory views of large similarity matrices
+
+The matrix is never densified: its triplets are binned into a fixed
+resolution density grid, and smoothing and plotting work on that grid.
+"""
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from scipy.sparse import coo_matrix
+
+def iter_triplets(sim_mat):
+    """Yield (i, j, score) arrays of a matrix
+
+    Positional Arguments:
+    sim_mat -- `scipy.sparse` matrix or `win_store.ShardedMatrix`
+
+    Returns:
+    Generator of (rows, cols, scores), one per shard for on-disk matrices
+    """
+    if hasattr(sim_mat, "iter_triplets"):
+        yield from sim_mat.iter_triplets()
+        return
+
+    sim_mat = coo_matrix(sim_mat)
+    yield sim_mat.row, sim_mat.col, sim_mat.data
+
+def density_grid(sim_mat, resolution: int = 2048):
+    """Downsample a matrix to at most `resolution` x `resolution` cells
+
+    Each cell holds the mean score of the matrix block it covers, zeros
+    included, i.e. what averaging the dense matrix would give. Matrices of
+    at most `resolution` domains map one to one.
+
+    Positional Arguments:
+    sim_mat     -- `scipy.sparse` matrix or `win_store.ShardedMatrix`
+
+    Keyword Arguments:
+    resolution  -- largest grid side
+
+    Returns:
+    `float64` array [cells, cells]
+    """
+    n = sim_mat.shape[0]
+    cells = max(1, min(resolution, n))
+
+    grid = np.zeros(cells * cells, dtype=np.float64)
+    for rows,cols,scores in iter_triplets(sim_mat):
+        cell = np.asarray(rows, dtype=np.int64) * cells // n * cells \
+               + np.asarray(cols, dtype=np.int64) * cells // n
+        grid += np.bincount(cell, weights=scores, minlength=cells * cells)
+    grid = grid.reshape(cells, cells)
+
+    # domains per cell along each axis, the last cells may cover fewer
+    edges = -(-np.arange(cells + 1) * n // cells)
+    span = np.diff(edges)
+
+    return grid / np.outer(span, span) if n > 0 else grid
+
+def smooth_grid(grid, sigma: float, n: int):
+    """Gaussian smoothing of a density grid
+
+    Positional Arguments:
+    grid    -- grid from `density_grid`
+    sigma   -- standard deviation in domains, as if the full matrix was
+               smoothed
+    n       -- number of domains the grid covers
+
+    Returns:
+    smoothed grid
+    """
+    scale = len(grid) / n if n > 0 else 1.0
+    return gaussian_filter(grid, sigma=sigma * scale, mode="constant",
+                           cval=0.0)
+
+def plot_heatmap(grid, n: int, title: str = "Similarity Matrix Viz",
+                 ax=None):
+    """Render a density grid as a heatmap with domain index axes
+
+    Positional Arguments:
+    grid    -- grid from `density_grid` or `smooth_grid`
+    n       -- number of domains the grid covers
+
+    Keyword Arguments:
+    title   -- plot title
+    ax      -- matplotlib axes to draw on, a new figure if None
+
+    Returns:
+    the matplotlib axes
+    """
+    # only needed for plotting
+    import matplotlib.pyplot as plt
+
+    if ax is None:
+        _,ax = plt.subplots()
+
+    image = ax.imshow(grid, cmap="hot", extent=(0, n, n, 0),
+                      interpolation="nearest")
+    ax.figure.colorbar(image, ax=ax)
+    ax.set_title(title)
+
+    return ax
@@ -1,12 +1,30 @@
-"""Cython source builder"""
+"""Cython source builder
+
+Profiling hooks are compiled out by default. Opt in through the environment:
+    TBSP_PROFILE=1  -- function level hooks, the kernels show up in cProfile
+    TBSP_LINETRACE=1 -- line level tracing as well (e.g. for line_profiler),
+                        much slower
+"""
+import os
 import sys
 
 from setuptools import setup, Extension
 from Cython.Build import cythonize
 
-ext_options = {"compiler_directives": {"profile": True, "language_level": 3}}
+linetrace = os.environ.get("TBSP_LINETRACE", "0") == "1"
+profile = linetrace or os.environ.get("TBSP_PROFILE", "0") == "1"
+
+ext_options = {
+    "compiler_directives": {"profile": profile, "linetrace": linetrace,
+                            "language_level": 3},
+    "compile_time_env": {"PROFILE_BUILD": profile},
+    # the generated C depends on the variant, not only on the .pyx
+    "force": True,
+}
 
-extensions = [Extension("edit_distance", ["py/edit_distance.pyx"])]
+macros = [("CYTHON_TRACE_NOGIL", "1")] if linetrace else []
+extensions = [Extension("edit_distance", ["py/edit_distance.pyx"],
+                        define_macros=macros)]
 setup(
     ext_modules=cythonize(extensions, **ext_options),
     script_args=["build_ext", "--build-lib=py", "--build-temp=build"]